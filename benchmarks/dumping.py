@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Benchmark dumping batches from the local staging table: 'table' staging
+(copy the batch into a table of its own for pg_dump) versus 'export' (dump an
+empty table, with a COPY of the batch as its data).
+
+Fills the local staging table with synthetic records (see generate.py) and
+dumps every batch to a file with both methods, reporting per batch the wall
+time, the WAL written, the size of the staged copy and the size of the dump.
+
+Note: this clobbers the local staging table.
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine, MetaData
+from sqlalchemy.sql import text
+
+from parkeerrechten import settings
+from parkeerrechten import models
+from parkeerrechten import run_import
+from parkeerrechten import dump_database
+
+from benchmarks import generate
+
+LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
+logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+logger = logging.getLogger('benchmark_dumping')
+
+
+def _fill_local_table(conn, args):
+    conn.execute(text(
+        '''DROP TABLE IF EXISTS "{}";'''.format(settings.LOCAL_TABLE)
+    ))
+    md = MetaData()
+    dp_table = models.get_backup_table_def(md, settings.LOCAL_TABLE)
+    md.create_all(conn)
+
+    settings.LOAD_MODE = 'copy'
+    store_rows = run_import._local_loader(dp_table)
+    for rows in generate.synthetic_records(
+            generate.parse_date('20170801'), args.days, args.rows_per_day):
+        store_rows(conn, rows)
+    conn.execute(text('''ANALYZE "{}";'''.format(settings.LOCAL_TABLE)))
+
+
+def _wal_position(conn):
+    return conn.execute(text('SELECT pg_current_wal_lsn();')).scalar()
+
+
+def _time_dump(conn, staging, batch_name, dump_file):
+    """Dump batch with staging method, return its measurements."""
+    staged = {'bytes': 0}
+
+    def dump(schema):
+        staged['bytes'] = conn.execute(text(
+            '''SELECT pg_total_relation_size('"{}"."{}"');'''.format(
+                schema, settings.TARGET_TABLE))).scalar()
+        dump_database._pg_dump(dump_file, schema)
+
+    wal_start = _wal_position(conn)
+    t0 = time.perf_counter()
+    if staging == 'export':
+        template = dump_database._export_template(conn)
+        dump_database._export_to_file(dump_file, batch_name, template)
+    else:
+        dump_database._dump_in_schema(batch_name, dump)
+    seconds = time.perf_counter() - t0
+    wal_bytes = conn.execute(
+        text('SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), :start);'),
+        {'start': wal_start}).scalar()
+
+    return {
+        'seconds': seconds,
+        'wal_bytes': int(wal_bytes),
+        'staged_bytes': staged['bytes'],
+        'dump_bytes': os.path.getsize(dump_file),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--days', type=int, default=3)
+    parser.add_argument('--rows-per-day', type=int, default=500000)
+    parser.add_argument('--output', help='file to write results (JSON) to')
+    args = parser.parse_args()
+
+    results = {'days': args.days, 'rows_per_day': args.rows_per_day, 'batches': {}}
+    with create_engine(settings.DATAPUNT_DB_URL).connect() as conn, \
+            tempfile.TemporaryDirectory() as work_dir:
+        _fill_local_table(conn, args)
+        batch_names = [row[0] for row in conn.execute(text(
+            '''SELECT DISTINCT "VER_BATCH_NAAM" FROM "{}" ORDER BY 1;'''.format(
+                settings.LOCAL_TABLE)))]
+
+        for batch_name in batch_names:
+            results['batches'][batch_name] = {}
+            for staging in ['table', 'export']:
+                dump_file = os.path.join(work_dir, '{}_{}.dump'.format(batch_name, staging))
+                result = _time_dump(conn, staging, batch_name, dump_file)
+                results['batches'][batch_name][staging] = result
+                logger.info(
+                    '%s %-6s: %.2f seconds, %d MiB WAL, %d MiB staged, %d MiB dump',
+                    batch_name, staging, result['seconds'], result['wal_bytes'] // 2**20,
+                    result['staged_bytes'] // 2**20, result['dump_bytes'] // 2**20)
+                os.remove(dump_file)
+
+        conn.execute(text(
+            '''DROP TABLE IF EXISTS "{}";'''.format(settings.LOCAL_TABLE)
+        ))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.info('Results written to %s', args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Time the import, dump and restore steps end to end.
+
+Fills the NPR stand-in with synthetic records (see generate.py), then runs
+`run_import`, `dump_database` and `restore_database` against it with the
+object store replaced by a local directory (see parkeerrechten/fakeswift.py,
+optionally with added latency and limited bandwidth). The timings (and the metrics the
+steps record) are written as JSON, which can be compared to the results of an
+earlier run (e.g. of another commit) with --compare.
+
+Note: this clobbers the NPR stand-in and the local database tables.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.sql import text
+
+from parkeerrechten import settings
+from parkeerrechten import metrics
+from parkeerrechten import objectstore
+from parkeerrechten import run_import
+from parkeerrechten import dump_database
+from parkeerrechten import restore_database
+
+from benchmarks import generate
+
+LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
+logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+logger = logging.getLogger('benchmark_endtoend')
+
+_BACKUP_DIR = '/tmp/backups/'
+STAGES = ['run_import', 'dump_database', 'restore_database']
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _reset_local_db(dp_conn):
+    for table_name in [
+            settings.LOCAL_TABLE, settings.TARGET_TABLE, settings.CHECKPOINT_TABLE]:
+        dp_conn.execute(text('''DROP TABLE IF EXISTS "{}";'''.format(table_name)))
+
+
+def run_benchmark(args):
+    settings.DEBUG = False
+    settings.BATCH_SIZE = args.batch_size
+    # Import everything in one run.
+    settings.N_DAYS_PER_RUN = args.days + 1
+
+    npr_engine = create_engine(settings.DATAPUNT_TEST_DB_URL)
+    dp_engine = create_engine(settings.DATAPUNT_DB_URL)
+
+    with npr_engine.connect() as npr_conn:
+        n_rows = generate.fill_standin(
+            npr_conn, args.first_day, args.days, args.rows_per_day,
+            args.orphan_fraction, args.seed)
+
+    # Dumps left by earlier runs would be uploaded instead of dumped again.
+    shutil.rmtree(_BACKUP_DIR, ignore_errors=True)
+    os.makedirs(_BACKUP_DIR)
+    timings = {}
+    metrics.reset()
+    with tempfile.TemporaryDirectory() as store_dir:
+        settings.OBJECTSTORE_FAKE_DIR = store_dir
+        settings.OBJECTSTORE_FAKE_LATENCY = args.latency
+        settings.OBJECTSTORE_FAKE_BANDWIDTH = args.bandwidth
+        objectstore.get_pool.cache_clear()
+        with objectstore.connection() as conn:
+            conn.put_container(settings.OBJECT_STORE_CONTAINER)
+        try:
+            with npr_engine.connect() as npr_conn, dp_engine.connect() as dp_conn:
+                _reset_local_db(dp_conn)
+
+                t0 = time.time()
+                run_import._run_import(
+                    ['--orphans', '--workers', str(args.workers)], npr_conn, dp_conn)
+                run_import._run_import(
+                    ['--workers', str(args.workers)], npr_conn, dp_conn)
+                timings['run_import'] = time.time() - t0
+
+                t0 = time.time()
+                dump_database._dump_database(dp_conn)
+                timings['dump_database'] = time.time() - t0
+
+                t0 = time.time()
+                restore_database._restore_database([], dp_conn)
+                timings['restore_database'] = time.time() - t0
+
+                n_restored = dp_conn.execute(text(
+                    '''SELECT COUNT(*) FROM "{}";'''.format(settings.TARGET_TABLE)
+                )).scalar()
+                dump_bytes = sum(
+                    object_['bytes'] for object_ in objectstore._get_full_container_list(
+                        settings.OBJECT_STORE_CONTAINER))
+        finally:
+            settings.OBJECTSTORE_FAKE_DIR = ''
+            objectstore.get_pool.cache_clear()
+
+    if n_restored != n_rows:
+        logger.error('Restored %d records, expected %d', n_restored, n_rows)
+
+    return {
+        'commit': _git_commit(),
+        'rows': n_rows,
+        'days': args.days,
+        'rows_per_day': args.rows_per_day,
+        'restored_rows': n_restored,
+        'dump_bytes': dump_bytes,
+        'settings': {
+            name: getattr(settings, name) for name in [
+                'BATCH_SIZE', 'FETCH_MODE', 'STREAM_CHUNK_SIZE', 'LOAD_MODE',
+                'PIPELINE_DEPTH', 'PAGE_SIZE_MODE']
+        },
+        'workers': args.workers,
+        'objectstore': {'latency': args.latency, 'bandwidth': args.bandwidth},
+        'seconds': timings,
+        'rows_per_second': {
+            stage: n_rows / seconds for stage, seconds in timings.items()},
+        'metrics': metrics.report(),
+    }
+
+
+def compare(result, baseline):
+    """Log the timings of `result` relative to those of `baseline`."""
+    logger.info(
+        'Comparing %s (this run) with %s (baseline)',
+        result['commit'], baseline['commit'])
+    if result['rows'] != baseline['rows']:
+        logger.warning(
+            'Runs differ in size: %d versus %d records', result['rows'], baseline['rows'])
+    for stage in STAGES:
+        new, old = result['seconds'][stage], baseline['seconds'][stage]
+        logger.info(
+            '%-16s %8.2fs vs %8.2fs (%+.1f%%)', stage, new, old, (new - old) / old * 100)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--first-day', type=generate.parse_date, default='20170801')
+    parser.add_argument('--days', type=int, default=3)
+    parser.add_argument('--rows-per-day', type=int, default=100000)
+    parser.add_argument('--orphan-fraction', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=50000)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument(
+        '--latency', type=float, default=0.0,
+        help='object store latency per request (seconds)')
+    parser.add_argument(
+        '--bandwidth', type=int, default=0,
+        help='object store bandwidth per transfer (bytes/s, 0 is unlimited)')
+    parser.add_argument(
+        '--output', default='benchmark-results.json', help='file to write results to')
+    parser.add_argument(
+        '--compare', help='results file of an earlier run to compare with')
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    for stage in STAGES:
+        logger.info(
+            '%-16s %8.2f seconds (%.0f rows/s)', stage,
+            result['seconds'][stage], result['rows_per_second'][stage])
+
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2, default=str)
+    logger.info('Results written to %s', args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Generate synthetic parkeerrechten in the NPR stand-in database.
+
+Produces records with the columns of `models.get_backup_table_def` and
+plausible values: one batch per day (VER_BATCH_NAAM is the date), start and
+end times within that day, amounts with VAT, a fraction of orphaned records
+(batch 'Leeg') and NULLs where NPR has them. Records are loaded with COPY in
+chunks, so millions of records per day do not need to fit in memory.
+
+Note: this clobbers the NPR stand-in table, never point it at NPR itself.
+"""
+import argparse
+import datetime
+import logging
+import random
+import time
+from decimal import Decimal
+
+from sqlalchemy import create_engine, MetaData
+from sqlalchemy.sql import text
+
+from parkeerrechten import settings
+from parkeerrechten import models
+from parkeerrechten import copyload
+
+LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
+logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+logger = logging.getLogger('benchmark_generate')
+
+FIRST_ID = 9000000000
+CHUNK_SIZE = 50000
+
+_PROVIDERS = [
+    ('02068', 'Cale Parkeerautomaten'),
+    ('02042', 'Parkmobile Group'),
+    ('02044', 'Yellowbrick'),
+    ('02047', 'SMS Parking'),
+]
+_AREAS = [
+    ('T14B_U06', 'T14_COMBI T14A combi ma-vr 09-19'),
+    ('T14B', 'T12A ma-za 09-24 zo 12-24'),
+    ('T03A', 'Centrum ma-zo 09-24'),
+    ('T11A', 'Oud-West ma-za 09-24'),
+]
+_PURPOSES = [
+    ('BETAALDP', 'BetaaldParkeren'),
+    ('VERGUNP', 'Stadsbrede vergunningen'),
+]
+
+
+def _timestamp(day, seconds):
+    return (day + datetime.timedelta(seconds=seconds)).strftime('%Y%m%d%H%M%S')
+
+
+def synthetic_record(rng, record_id, day, batch_name):
+    """
+    Generate a single record, batch_name is usually the date of `day`.
+    """
+    start = rng.randrange(7 * 3600, 23 * 3600)
+    end = start + rng.randrange(5 * 60, 4 * 3600)
+    amount = Decimal(rng.randrange(0, 2000)) / 100
+    vat = (amount * Decimal('0.21')).quantize(Decimal('0.01'))
+    provider = rng.choice(_PROVIDERS)
+    area = rng.choice(_AREAS)
+    purpose = rng.choice(_PURPOSES)
+
+    return {
+        'VERW_RECHT_ID': Decimal(record_id),
+        'LAND_C_V_RECHT': rng.choice([None, 'NL', 'NL', 'NL', 'D', 'B']),
+        'VERK_P_V_RECHT': Decimal(rng.choice([-1, rng.randrange(10000, 20000)])),
+        'VERK_PUNT_OMS': None,
+        'B_TYD_V_RECHT': _timestamp(day, start),
+        'E_TYD_V_RECHT': _timestamp(day, end),
+        'E_TYD_R_AANP': None,
+        'BEDRAG_V_RECHT': amount,
+        'BTW_V_RECHT': vat,
+        'BEDR_V_RECHT_B': amount,
+        'BTW_V_RECHT_BER': vat,
+        'BEDR_V_RECHT_H': Decimal('0.00'),
+        'BTW_V_RECHT_HER': Decimal('0.00'),
+        'TYD_HERBEREK': None,
+        'RECHTV_V_RECHT': provider[0],
+        'RECHTV_INT_OMS': provider[1],
+        'GEB_BEH_V_RECHT': 363,
+        'GEBIEDS_BEH_OMS': 'Amsterdam',
+        'GEB_C_V_RECHT': area[0],
+        'GEBIED_OMS': area[1],
+        'REG_TYD_V_RECHT': _timestamp(day, start - rng.randrange(0, 600)),
+        'COORD_V_RECHT': None,
+        'GEBR_DOEL_RECHT': purpose[0],
+        'GEBR_DOEL_OMS': purpose[1],
+        'R_TYD_E_TYD_VR': _timestamp(day, end),
+        'VER_BATCH_ID': 1500 + day.toordinal() % 1000,
+        'VER_BATCH_NAAM': batch_name,
+        'KENM_RECHTV_INT': '{:032x}'.format(rng.getrandbits(128)),
+    }
+
+
+def synthetic_records(
+        first_day, n_days, rows_per_day, orphan_fraction=0.0, seed=0,
+        chunk_size=CHUNK_SIZE):
+    """
+    Generate records, in chunks, for `n_days` consecutive days.
+    """
+    rng = random.Random(seed)
+    record_id = FIRST_ID
+    for d in range(n_days):
+        day = first_day + datetime.timedelta(days=d)
+        batch_name = day.strftime('%Y%m%d')
+
+        chunk = []
+        for _ in range(rows_per_day):
+            orphan = rng.random() < orphan_fraction
+            chunk.append(synthetic_record(
+                rng, record_id, day, 'Leeg' if orphan else batch_name))
+            record_id += 1
+
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def fill_standin(conn, first_day, n_days, rows_per_day, orphan_fraction=0.0, seed=0):
+    """
+    Replace the contents of the NPR stand-in with synthetic records.
+    """
+    conn.execute(text(
+        '''DROP TABLE IF EXISTS "{}";'''.format(settings.NPR_TABLE)
+    ))
+    md = MetaData()
+    table = models.get_backup_table_def(md, settings.NPR_TABLE)
+    md.create_all(conn)
+
+    loader = copyload.CopyLoader(table)
+    n_rows = 0
+    t0 = time.time()
+    for chunk in synthetic_records(first_day, n_days, rows_per_day, orphan_fraction, seed):
+        n_rows += loader.load(conn, chunk)
+    logger.info('Generated %d records in %.2f seconds', n_rows, time.time() - t0)
+
+    # NPR has an index on the record id, mimic that.
+    conn.execute(text(
+        '''CREATE INDEX ON "{}" ("VER_BATCH_NAAM", "VERW_RECHT_ID");'''.format(
+            settings.NPR_TABLE)
+    ))
+    conn.execute(text('''ANALYZE "{}";'''.format(settings.NPR_TABLE)))
+
+    return n_rows
+
+
+def parse_date(s):
+    return datetime.datetime.strptime(s, '%Y%m%d')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--first-day', type=parse_date, default='20170801')
+    parser.add_argument('--days', type=int, default=3)
+    parser.add_argument('--rows-per-day', type=int, default=100000)
+    parser.add_argument('--orphan-fraction', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with create_engine(settings.DATAPUNT_TEST_DB_URL).connect() as conn:
+        fill_standin(
+            conn, args.first_day, args.days, args.rows_per_day,
+            args.orphan_fraction, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Benchmark loading records into the local staging table: INSERT versus COPY.
+
+Generates synthetic pages of records (see generate.py) and stores them in the
+local database with both load modes of `run_import`, reporting rows per
+second for each.
+
+Note: this clobbers the local staging table.
+"""
+import argparse
+import logging
+import time
+
+from sqlalchemy import create_engine, MetaData
+from sqlalchemy.sql import text
+
+from parkeerrechten import settings
+from parkeerrechten import models
+from parkeerrechten import run_import
+
+from benchmarks import generate
+
+LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
+logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+logger = logging.getLogger('benchmark_loading')
+
+
+def _time_load_mode(conn, load_mode, pages):
+    conn.execute(text(
+        '''DROP TABLE IF EXISTS "{}";'''.format(settings.LOCAL_TABLE)
+    ))
+    md = MetaData()
+    dp_table = models.get_backup_table_def(md, settings.LOCAL_TABLE)
+    md.create_all(conn)
+
+    settings.LOAD_MODE = load_mode
+    store_rows = run_import._local_loader(dp_table)
+
+    t0 = time.perf_counter()
+    for rows in pages:
+        store_rows(conn, rows)
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--batch-size', type=int, default=50000)
+    args = parser.parse_args()
+
+    pages = list(generate.synthetic_records(
+        generate.parse_date('20170812'), 1, args.rows, chunk_size=args.batch_size))
+
+    with create_engine(settings.DATAPUNT_DB_URL).connect() as conn:
+        results = {}
+        for load_mode in ['insert', 'copy']:
+            dt = _time_load_mode(conn, load_mode, pages)
+            results[load_mode] = args.rows / dt
+            logger.info(
+                '%s: %d records in %.2f seconds, %.0f rows/s',
+                load_mode, args.rows, dt, results[load_mode])
+
+        conn.execute(text(
+            '''DROP TABLE IF EXISTS "{}";'''.format(settings.LOCAL_TABLE)
+        ))
+
+    logger.info('COPY speed-up: %.2fx', results['copy'] / results['insert'])
+
+
+if __name__ == '__main__':
+    main()
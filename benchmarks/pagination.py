@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Benchmark OFFSET versus keyset pagination of the NPR batch reads.
+
+Fills the NPR stand-in database with synthetic records for a single batch and
+times every page read by `batched_selection_iterator` (LIMIT/OFFSET) and by
+`keyset_selection_iterator`. With OFFSET the per-page latency grows with the
+offset, with keyset pagination it should stay flat.
+
+Note: this clobbers the NPR stand-in table, never point it at NPR itself.
+"""
+import argparse
+import logging
+import time
+
+from sqlalchemy import create_engine, select, asc, MetaData
+from sqlalchemy.sql import literal
+
+from parkeerrechten import settings
+from parkeerrechten import models
+from parkeerrechten import run_import
+
+from benchmarks import generate
+
+LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
+logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+logger = logging.getLogger('benchmark_pagination')
+
+BATCH_NAME = '20170801'
+
+
+def _time_pages(iterator):
+    """Return list of (first row number, seconds) for each page."""
+    timings = []
+    n_seen = 0
+    while True:
+        t0 = time.perf_counter()
+        try:
+            rows = next(iterator)
+        except StopIteration:
+            break
+        timings.append((n_seen, time.perf_counter() - t0))
+        n_seen += len(rows)
+
+    return timings
+
+
+def _report(name, timings, n_report):
+    step = max(1, len(timings) // n_report)
+    logger.info('%s: %d pages', name, len(timings))
+    for offset, dt in timings[::step]:
+        logger.info('%s: page at row %9d took %8.2f ms', name, offset, dt * 1000)
+    total = sum(dt for _, dt in timings)
+    logger.info('%s: total %.2f seconds', name, total)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--batch-size', type=int, default=50000)
+    parser.add_argument(
+        '--report', type=int, default=10, help='number of pages to report')
+    args = parser.parse_args()
+
+    with create_engine(settings.DATAPUNT_TEST_DB_URL).connect() as conn:
+        logger.info('Generating %d records in the NPR stand-in', args.rows)
+        generate.fill_standin(conn, generate.parse_date(BATCH_NAME), 1, args.rows)
+        view = models.get_backup_table_def(MetaData(), settings.NPR_TABLE)
+
+        selection = (
+            select([view])
+            .where(view.c.VER_BATCH_NAAM == literal(BATCH_NAME))
+            .order_by(asc(view.c.VERW_RECHT_ID))
+        )
+
+        offset_timings = _time_pages(run_import.batched_selection_iterator(
+            conn, selection, args.batch_size))
+        keyset_timings = _time_pages(run_import.keyset_selection_iterator(
+            conn, selection, view.c.VERW_RECHT_ID, args.batch_size))
+
+    t_offset = _report('offset', offset_timings, args.report)
+    t_keyset = _report('keyset', keyset_timings, args.report)
+    logger.info('Keyset pagination speed-up: %.2fx', t_offset / t_keyset)
+
+
+if __name__ == '__main__':
+    main()
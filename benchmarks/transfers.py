@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Benchmark object store listing, upload and download against the local stand-in.
+
+Uses the directory backed Swift stand-in (parkeerrechten/fakeswift.py) with
+the given per-request latency, per-transfer bandwidth and listing page limit,
+so the effect of changes to `objectstore` can be measured offline:
+
+  * listing a container of --objects dumps (full, and one month by prefix),
+  * uploading a --size bytes dump (segmented above the segment threshold),
+  * downloading it again (to a file, and streamed).
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+
+from parkeerrechten import settings
+from parkeerrechten import objectstore
+from parkeerrechten import namecheck
+
+LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
+logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+logger = logging.getLogger('benchmark_transfers')
+
+CONTAINER = 'benchmark'
+
+
+def _timed(timings, name, f, *args, **kwargs):
+    t0 = time.perf_counter()
+    result = f(*args, **kwargs)
+    timings[name] = time.perf_counter() - t0
+    logger.info('%-20s %8.3f seconds', name, timings[name])
+    return result
+
+
+def run_benchmark(args, store_dir, work_dir):
+    settings.OBJECTSTORE_FAKE_DIR = store_dir
+    settings.OBJECTSTORE_FAKE_LATENCY = 0
+    settings.OBJECTSTORE_FAKE_BANDWIDTH = 0
+    settings.OBJECTSTORE_LISTING_LIMIT = args.page_limit
+    objectstore.get_pool.cache_clear()
+
+    # Fill the container with small dumps, one per day (without latency).
+    conn = objectstore._new_conn()
+    conn.put_container(CONTAINER)
+    day = time.mktime(time.strptime('20100101', '%Y%m%d'))
+    for i in range(args.objects):
+        batch_name = time.strftime('%Y%m%d', time.localtime(day + i * 86400))
+        conn.put_object(
+            CONTAINER, namecheck.file_name_for_batch_name(batch_name), contents=b'x')
+
+    file_path = os.path.join(work_dir, '20170801_BENCHMARK.dump')
+    with open(file_path, 'wb') as f:
+        for _ in range(0, args.size, 2**20):
+            f.write(os.urandom(min(2**20, args.size - f.tell())))
+
+    settings.OBJECTSTORE_FAKE_LATENCY = args.latency
+    settings.OBJECTSTORE_FAKE_BANDWIDTH = args.bandwidth
+    objectstore.get_pool.cache_clear()
+
+    timings = {}
+    _timed(timings, 'list_full', objectstore._get_full_container_list, CONTAINER)
+    prefix = '2010/01/' if settings.OBJECT_LAYOUT == 'sharded' else '201001'
+    _timed(timings, 'list_month', objectstore._get_full_container_list,
+           CONTAINER, prefix=prefix)
+    _timed(timings, 'upload', objectstore.upload_file, CONTAINER, file_path)
+    _timed(timings, 'download', objectstore.copy_file_from_objectstore,
+           CONTAINER, os.path.basename(file_path), os.path.join(work_dir, 'download'))
+    _timed(timings, 'download_streamed', lambda: sum(
+        len(chunk) for chunk in objectstore.iter_object(
+            CONTAINER, os.path.basename(file_path))))
+
+    settings.OBJECTSTORE_FAKE_DIR = ''
+    objectstore.get_pool.cache_clear()
+
+    return {
+        'objects': args.objects,
+        'size': args.size,
+        'latency': args.latency,
+        'bandwidth': args.bandwidth,
+        'page_limit': args.page_limit,
+        'settings': {
+            name: getattr(settings, name) for name in [
+                'OBJECT_LAYOUT', 'OBJECTSTORE_LISTING_LIMIT', 'OBJECTSTORE_CHUNK_SIZE',
+                'OBJECTSTORE_POOL_SIZE',
+                'OBJECTSTORE_SEGMENT_THRESHOLD', 'OBJECTSTORE_SEGMENT_SIZE',
+                'OBJECTSTORE_UPLOAD_CONCURRENCY']
+        },
+        'seconds': timings,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--objects', type=int, default=3000)
+    parser.add_argument('--size', type=int, default=64 * 2**20, help='dump size (bytes)')
+    parser.add_argument(
+        '--latency', type=float, default=0.02, help='latency per request (seconds)')
+    parser.add_argument(
+        '--bandwidth', type=int, default=50 * 2**20,
+        help='bandwidth per transfer (bytes/s, 0 is unlimited)')
+    parser.add_argument(
+        '--page-limit', type=int, default=1000, help='objects per listing request')
+    parser.add_argument('--output', help='file to write results (JSON) to')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as store_dir, \
+            tempfile.TemporaryDirectory() as work_dir:
+        result = run_benchmark(args, store_dir, work_dir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+        logger.info('Results written to %s', args.output)
+
+
+if __name__ == '__main__':
+    main()
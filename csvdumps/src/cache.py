@@ -0,0 +1,83 @@
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+TMP_PREFIX = ".tmp-"
+
+
+class DownloadCache:
+    """
+    Downloaded dumps, keyed by object name and ETag, at most max_bytes in size.
+
+    Uses the same layout as the cache of the parkeerrechten backup scripts
+    (parkeerrechten/downloadcache.py), so both can share a cache directory.
+    The least recently used files are evicted when the cache is full.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name, etag):
+        key = hashlib.sha256(f"{name}\n{etag}".encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key)
+
+    def copy_to(self, name, etag, destination):
+        """
+        Copy the cached object to destination, returns whether it was cached
+        """
+        path = self.path(name, etag)
+        try:
+            os.utime(path)  # mark as recently used
+            size = os.path.getsize(path)
+        except OSError:
+            self.misses += 1
+            return False
+
+        shutil.copyfile(path, destination)
+        self.hits += 1
+        self.bytes_saved += size
+        logger.info(f"Cache hit for {name} ({size} bytes)")
+        return True
+
+    def store(self, name, etag, file_path):
+        tmp_path = os.path.join(self.directory, TMP_PREFIX + uuid.uuid4().hex)
+        try:
+            shutil.copyfile(file_path, tmp_path)
+            os.replace(tmp_path, self.path(name, etag))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+
+    def evict(self):
+        entries = [
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(self.directory)
+            if entry.is_file() and not entry.name.startswith(TMP_PREFIX)
+        ]
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            logger.info(f"Evicted {path} ({size} bytes) from download cache")
+
+    def log_stats(self):
+        logger.info(
+            f"Download cache: {self.hits} hits, {self.misses} misses, "
+            f"{round(self.bytes_saved / 1024 / 1024, 2)} MB not downloaded"
+        )
@@ -11,6 +11,8 @@ from typing import NamedTuple
 import objectstore
 import psycopg2
 
+from cache import DownloadCache
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
@@ -21,6 +23,11 @@ logging.basicConfig(
 )
 
 
+def basename(name):
+    """Object name without its prefix (e.g. 2017/08/)"""
+    return name.rpartition("/")[2]
+
+
 class Config(NamedTuple):
     output_dir: str
     container: str
@@ -28,6 +35,8 @@ class Config(NamedTuple):
     database_name: str
     database_user: str
     database_password: str
+    cache_dir: str
+    cache_max_bytes: int
 
 
 class Exporter:
@@ -39,9 +48,18 @@ class Exporter:
             database_name=os.getenv("DATABASE_NAME"),
             database_user=os.getenv("DATABASE_USER"),
             database_password=os.getenv("DATABASE_PASSWORD"),
+            cache_dir=os.getenv("CACHE_DIR", ""),
+            cache_max_bytes=int(os.getenv("CACHE_MAX_BYTES", str(10 * 1024 ** 3))),
         )
         logging.debug(f"Config: {self.config}")
 
+        # Optional local cache of downloaded dumps
+        self.cache = None
+        if self.config.cache_dir:
+            self.cache = DownloadCache(
+                self.config.cache_dir, self.config.cache_max_bytes
+            )
+
         # Setup the connection to the objectstore
         self.objectstore_conn = objectstore.get_connection()
 
@@ -72,10 +90,11 @@ class Exporter:
         """
         List files from a container
         If a pattern has been given it will only return messages matching this pattern
+        (matched against the base name, dumps can be stored as YYYY/MM/<name>)
         """
         files = objectstore.get_full_container_list(self.objectstore_conn, container)
         if pattern:
-            return [file for file in files if re.match(pattern, file["name"])]
+            return [file for file in files if re.match(pattern, basename(file["name"]))]
         return files
 
     def download_file(self, container, file, destination=None, overwrite=False):
@@ -88,6 +107,10 @@ class Exporter:
             logger.info(f"Skipping file: {destination} since it exists")
             return
 
+        # The listing holds the ETag of the object as its hash
+        if self.cache and self.cache.copy_to(file["name"], file["hash"], path):
+            return path
+
         size_mb = round(file["bytes"] / 1024 / 1024, 2)
         logger.info(f"Downloading {file} - {size_mb} MB")
         headers, body = self.objectstore_conn.get_object(container, file["name"])
@@ -95,6 +118,9 @@ class Exporter:
             logger.info(f"Writing to {path}")
             f.write(body)
 
+        if self.cache:
+            self.cache.store(file["name"], headers["etag"].strip('"'), path)
+
         return path
 
     def restore_table(self, file):
@@ -104,6 +130,7 @@ class Exporter:
         command = [
             "pg_restore",
             "--clean",
+            "--if-exists",
             "-h",
             self.config.database_host,
             "-d",
@@ -119,7 +146,7 @@ class Exporter:
             output = subprocess.run(
                 command,
                 capture_output=True,
-                check=False,
+                check=True,
                 env={"PGPASSWORD": self.config.database_password},
             )
         except subprocess.CalledProcessError as e:
@@ -167,10 +194,12 @@ if __name__ == "__main__":
     output_files = exporter.list_files(output_container, r"\d+_NPR_BACKUP.csv")
 
     for file in input_files:
+        # The CSV gets the prefix of the dump, CSVs written before the dumps
+        # moved to a prefix are recognised by their base name.
         base, ext = os.path.splitext(file["name"])
         output_file = f"{base}.csv"
 
-        if any([x for x in output_files if x["name"] == output_file]):
+        if any([x for x in output_files if basename(x["name"]) == basename(output_file)]):
             logger.info(
                 f"Skipping {file['name']} since the output file {output_file} exists"
             )
@@ -186,7 +215,10 @@ if __name__ == "__main__":
         csv_path = exporter.dump_table_csv(table_name, output_file)
 
         # Upload the CSV file
-        exporter.upload_file(output_container, csv_path, os.path.basename(output_file))
+        exporter.upload_file(output_container, csv_path, output_file)
 
         os.remove(csv_path)
         os.remove(dump_path)
+
+    if exporter.cache:
+        exporter.cache.log_stats()
@@ -21,7 +21,9 @@ setup(
         'console_scripts': [
             'run_import = parkeerrechten.run_import:main',
             'dump_database = parkeerrechten.dump_database:main',
-            'restore_database = parkeerrechten.restore_database:main'
+            'restore_database = parkeerrechten.restore_database:main',
+            'resync_inventory = parkeerrechten.resync_inventory:main',
+            'migrate_object_layout = parkeerrechten.migrate_layout:main'
         ],
     },
     install_requires=[
@@ -1,64 +1,145 @@
 import logging
 
-from sqlalchemy import select, asc, distinct, Table, MetaData
-from sqlalchemy.exc import NoSuchTableError
+from sqlalchemy import select, asc, distinct
+from sqlalchemy.sql import text
+from . import inventory
 from . import objectstore
+from . import schema
+from . import checkpoint
+from . import metrics
 from . import settings
 from . import namecheck
+from . import partitions
 
 LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
 logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
-def get_batch_names_in_objectstore(include_leeg):
-    """Get a list of days for which PG dumps are present"""
+def get_batch_names_in_objectstore(include_leeg, start_date=None, end_date=None):
+    """
+    Get a list of days for which PG dumps are present
+
+    In the sharded layout a date range (start_date and end_date) limits the
+    listing to the directories of the months in that range.
+    """
     logger.info('Checking the object store for existing back-ups.')
 
-    contents = objectstore._get_full_container_list(
-        settings.OBJECT_STORE_CONTAINER)
+    prefixes = None
+    if settings.OBJECT_LAYOUT == 'sharded' and not inventory.is_enabled():
+        prefixes = namecheck.month_prefixes(start_date, end_date)
+
+    with metrics.timer('objectstore_list_seconds'):
+        if prefixes is None:
+            contents = inventory.get_container_list(
+                settings.OBJECT_STORE_CONTAINER, objectstore._get_full_container_list,
+                objectstore.connection)
+        else:
+            contents = objectstore.get_container_list_for_prefixes(
+                settings.OBJECT_STORE_CONTAINER, prefixes)
     batches = []
     for object_ in contents:
         if namecheck.is_batch_file(object_['name'], include_leeg=include_leeg):
             batches.append(namecheck.extract_batch_name(object_['name']))
 
+    if start_date is not None or end_date is not None:
+        batches = namecheck.filter_batch_names_by_date(batches, start_date, end_date)
     return batches
 
 
-def get_batch_names_in_database(
-        connection, table_or_view_name, include_leeg=False, require_table=True):
-    """
-    Query for all distinct batchnames in database (be it NPR, local or test).
-    """
-    # Introspect the database for table definition, define selection.
-    md = MetaData()
-    try:
-        view = Table(
-            table_or_view_name, md, autoload=True, autoload_with=connection)
-    except NoSuchTableError:
-        if require_table:
-            raise
-        else:
-            # This happens when the local database is checked the first time
-            # during the import process (which could entail several calls to
-            # the run_import.py script). If the local database is not yet
-            # initialized, there are no backed-up batches and we return an
-            # empty list.
-            return []
-
+def _distinct_batch_names(connection, table_or_view_name, start_date, end_date):
+    view = schema.get_table(connection, table_or_view_name)
     selection = (
         select([distinct(view.c.VER_BATCH_NAAM)])
         .order_by(asc(view.c.VER_BATCH_NAAM))
     )
+    if start_date is not None:
+        selection = selection.where(view.c.VER_BATCH_NAAM >= start_date)
+    if end_date is not None:
+        selection = selection.where(view.c.VER_BATCH_NAAM <= end_date)
 
+    return [row[0] for row in connection.execute(selection).fetchall()]
+
+
+def _skip_scan_batch_names(connection, table_name, start_date, end_date):
+    """
+    Loose index scan for the distinct batch names: one index lookup per
+    batch (for the next larger name) instead of sorting all records.
+    """
+    window = []
+    if start_date is not None:
+        window.append('AND "VER_BATCH_NAAM" >= :start_date')
+    if end_date is not None:
+        window.append('AND "VER_BATCH_NAAM" <= :end_date')
+    window = ' '.join(window)
+
+    sql = '''
+        WITH RECURSIVE batch_names AS (
+            (SELECT "VER_BATCH_NAAM" AS name FROM "{table}"
+             WHERE "VER_BATCH_NAAM" IS NOT NULL {window}
+             ORDER BY "VER_BATCH_NAAM" LIMIT 1)
+            UNION ALL
+            SELECT (SELECT "VER_BATCH_NAAM" FROM "{table}"
+                    WHERE "VER_BATCH_NAAM" > batch_names.name {window}
+                    ORDER BY "VER_BATCH_NAAM" LIMIT 1)
+            FROM batch_names WHERE batch_names.name IS NOT NULL
+        )
+        SELECT name FROM batch_names WHERE name IS NOT NULL;'''.format(
+        table=table_name, window=window)
+    rows = connection.execute(
+        text(sql), {'start_date': start_date, 'end_date': end_date}).fetchall()
+
+    return [row[0] for row in rows]
+
+
+def get_batch_names_in_database(
+        connection, table_or_view_name, include_leeg=False, require_table=True,
+        completed_only=False, start_date=None, end_date=None):
+    """
+    Query for all distinct batchnames in database (be it NPR, local or test).
+
+    For a partitioned (local) table the partitions are listed instead. With
+    `completed_only` batches with an unfinished import (according to
+    the checkpoints in the local database) are left out. Batch names are
+    limited to the range start_date up to and including end_date, when
+    given (which includes Leeg if there is no end date).
+
+    With BATCH_NAMES_QUERY 'skipscan' the names are found with a loose index
+    scan on PostgreSQL (see `models.create_batch_name_index`).
+    """
+    # Get (cached) table definition, define selection.
+    if not require_table and not connection.dialect.has_table(
+            connection, table_or_view_name):
+        # This happens when the local database is checked the first time
+        # during the import process (which could entail several calls to
+        # the run_import.py script). If the local database is not yet
+        # initialized, there are no backed-up batches and we return an
+        # empty list.
+        return []
     # We expect maximum on the order of a few hundred days (for the NPR
     # database, the local database used during testing and importing
     # should have only on the order of tens of batches).
-    unvalidated_batchnames = [
-        row[0] for row in connection.execute(selection).fetchall()]
+    with metrics.timer('batch_names_query_seconds', table=table_or_view_name):
+        if partitions.is_partitioned(connection, table_or_view_name):
+            unvalidated_batchnames = [
+                bn for bn in partitions.get_batch_names(connection, table_or_view_name)
+                if (start_date is None or bn >= start_date) and
+                (end_date is None or bn <= end_date)
+            ]
+        elif (settings.BATCH_NAMES_QUERY == 'skipscan' and
+                connection.dialect.name == 'postgresql'):
+            unvalidated_batchnames = _skip_scan_batch_names(
+                connection, table_or_view_name, start_date, end_date)
+        else:
+            unvalidated_batchnames = _distinct_batch_names(
+                connection, table_or_view_name, start_date, end_date)
 
     # Validate that we have only dates as batch names.
     batch_names = namecheck.filter_batch_names(
         unvalidated_batchnames, include_leeg=include_leeg)
 
+    if completed_only:
+        incomplete = set(checkpoint.get_incomplete_batch_names(connection))
+        batch_names = [bn for bn in batch_names if bn not in incomplete]
+
     return batch_names
@@ -0,0 +1,81 @@
+"""
+Import checkpoints (high-water marks) for batches in the local database.
+
+For every batch being imported we record the last VERW_RECHT_ID that was
+committed to the local table and whether the batch is complete. Records and
+checkpoint are committed in the same transaction, so an interrupted import
+can resume exactly where it stopped.
+"""
+from sqlalchemy import MetaData, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql import text
+
+from . import settings
+from . import models
+
+
+def _get_table():
+    return models.get_checkpoint_table_def(MetaData(), settings.CHECKPOINT_TABLE)
+
+
+def create_table(dp_conn):
+    """Create checkpoint table if needed."""
+    _get_table().create(dp_conn, checkfirst=True)
+
+
+def drop_table(dp_conn):
+    """Forget all checkpoints."""
+    dp_conn.execute(text(
+        '''DROP TABLE IF EXISTS "{}";'''.format(settings.CHECKPOINT_TABLE)
+    ))
+
+
+def save(dp_conn, batch_name, last_key, complete=False):
+    """Record the last committed VERW_RECHT_ID for a batch."""
+    table = _get_table()
+    statement = insert(table).values(
+        VER_BATCH_NAAM=batch_name, LAST_VERW_RECHT_ID=last_key, COMPLETE=complete)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.VER_BATCH_NAAM],
+        set_={
+            'LAST_VERW_RECHT_ID': statement.excluded.LAST_VERW_RECHT_ID,
+            'COMPLETE': statement.excluded.COMPLETE,
+        }
+    )
+    dp_conn.execute(statement)
+
+
+def forget(dp_conn, batch_names):
+    """Remove the checkpoints of batches (e.g. once they are backed up)."""
+    if not dp_conn.dialect.has_table(dp_conn, settings.CHECKPOINT_TABLE):
+        return
+
+    table = _get_table()
+    dp_conn.execute(table.delete().where(table.c.VER_BATCH_NAAM.in_(batch_names)))
+
+
+def get_resume_key(dp_conn, batch_name):
+    """
+    Get last committed VERW_RECHT_ID of an incomplete batch (None otherwise).
+    """
+    table = _get_table()
+    row = dp_conn.execute(
+        select([table.c.LAST_VERW_RECHT_ID])
+        .where(table.c.VER_BATCH_NAAM == batch_name)
+        .where(table.c.COMPLETE.is_(False))
+    ).fetchone()
+
+    return None if row is None else row[0]
+
+
+def get_incomplete_batch_names(dp_conn):
+    """List the batches of which the import did not finish."""
+    if not dp_conn.dialect.has_table(dp_conn, settings.CHECKPOINT_TABLE):
+        return []
+
+    table = _get_table()
+    rows = dp_conn.execute(
+        select([table.c.VER_BATCH_NAAM]).where(table.c.COMPLETE.is_(False))
+    ).fetchall()
+
+    return [row[0] for row in rows]
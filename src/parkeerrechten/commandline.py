@@ -35,6 +35,14 @@ def check_date_args(args):
             raise ValidationError('startdate cannot be after enddate')
 
 
+def check_workers_arg(args):
+    """
+    Validate that the number of workers is sensible.
+    """
+    if args.workers < 1:
+        raise ValidationError('Need at least one worker')
+
+
 def parse_args(raw_args, include_orphans_option):
     """
     Parse the commandline options to this script.
@@ -55,10 +63,15 @@ def parse_args(raw_args, include_orphans_option):
             '--orphans', action='store_true',
             help='Download records that have no batch name.')
 
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='Number of batches to process concurrently (default 1)')
+
     # Parse command line arguments, check their values.
     args = parser.parse_args(raw_args)
     try:
         check_date_args(args)
+        check_workers_arg(args)
     except(ValidationError, ValueError) as e:
         logger.error('Commandline argument(s) are wrong')
         raise e
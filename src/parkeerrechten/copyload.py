@@ -0,0 +1,69 @@
+"""
+Bulk load records into the local PostgreSQL database using COPY.
+"""
+import io
+from decimal import Decimal
+
+NULL = '\\N'
+
+# Characters that have a special meaning in the COPY text format.
+_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+})
+
+
+def format_value(value):
+    """
+    Format a single value for the PostgreSQL COPY text format.
+    """
+    if value is None:
+        return NULL
+    elif isinstance(value, Decimal):
+        # Avoid exponent notation, e.g. Decimal('1E+1') for 10.
+        return format(value, 'f')
+    else:
+        return str(value).translate(_ESCAPES)
+
+
+class CopyLoader:
+    """
+    Load rows into a table with COPY ... FROM STDIN.
+
+    The in-memory buffer is re-used between calls to `load`, so a loader
+    should be created once per table and used for all pages of a batch.
+    """
+    def __init__(self, table):
+        self.columns = [column.name for column in table.columns]
+        self.sql = '''COPY "{}" ({}) FROM STDIN WITH (FORMAT text, ENCODING 'UTF8')'''.format(
+            table.name, ', '.join('"{}"'.format(c) for c in self.columns))
+        self.buffer = io.BytesIO()
+
+    def _fill_buffer(self, rows):
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+        lines = []
+        for row in rows:
+            lines.append('\t'.join(format_value(row[c]) for c in self.columns))
+            lines.append('\n')
+        self.buffer.write(''.join(lines).encode('utf-8'))
+
+        self.buffer.seek(0)
+
+    def load(self, connection, rows):
+        """
+        Load rows (mappings of column name to value) using connection.
+        """
+        self._fill_buffer(rows)
+
+        with connection.begin():
+            cursor = connection.connection.cursor()
+            try:
+                cursor.copy_expert(self.sql, self.buffer)
+            finally:
+                cursor.close()
+
+        return len(rows)
@@ -0,0 +1,132 @@
+"""
+Local cache of downloaded object store objects.
+
+Restores (and re-exports) download the same daily dumps again and again.
+Downloads are kept in a cache directory, keyed by object name and ETag (so a
+replaced object is never served from the cache), up to a maximum total size.
+When the cache is full the least recently used files are evicted; a cache
+hit updates the modification time of the file, which serves as its last use.
+"""
+import functools
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+from contextlib import contextmanager
+
+from . import settings
+from . import metrics
+
+LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
+logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+_TMP_PREFIX = '.tmp-'
+
+
+def _link_or_copy(source, destination):
+    """Hard link source to destination (same file system), else copy it."""
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class DownloadCache:
+    """
+    Cache of downloaded objects in `directory`, at most `max_bytes` in size.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name, etag):
+        key = hashlib.sha256('{}\n{}'.format(name, etag).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key)
+
+    def lookup(self, name, etag):
+        """
+        Get path of cached copy of object `name` with `etag`, None if absent.
+        """
+        path = self.path(name, etag)
+        try:
+            os.utime(path)  # mark as recently used
+            size = os.path.getsize(path)
+        except OSError:
+            metrics.inc('download_cache_misses_total')
+            return None
+
+        metrics.inc('download_cache_hits_total')
+        metrics.inc('download_cache_bytes_saved_total', size)
+        logger.info('Cache hit for %s (%d bytes)', name, size)
+        return path
+
+    def copy_to(self, name, etag, destination):
+        """Copy cached object to destination, return whether it was cached."""
+        path = self.lookup(name, etag)
+        if path is None:
+            return False
+        _link_or_copy(path, destination)
+        return True
+
+    @contextmanager
+    def writer(self, name, etag):
+        """
+        File to write object `name` with `etag` to, it is added to the cache
+        when the with block completes without errors.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=_TMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                yield f
+            os.replace(tmp_path, self.path(name, etag))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def store(self, name, etag, file_path):
+        """Add downloaded file (object `name` with `etag`) to the cache."""
+        tmp_path = os.path.join(self.directory, _TMP_PREFIX + uuid.uuid4().hex)
+        try:
+            _link_or_copy(file_path, tmp_path)
+            os.replace(tmp_path, self.path(name, etag))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used files until the cache fits its maximum size."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(_TMP_PREFIX) or not entry.is_file():
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue  # evicted by another process
+            total -= size
+            metrics.inc('download_cache_evictions_total')
+            logger.info('Evicted %s (%d bytes) from download cache', path, size)
+
+        metrics.set_gauge('download_cache_bytes', total)
+
+
+@functools.lru_cache(maxsize=None)
+def get_cache():
+    """The configured download cache, None if it is disabled."""
+    if not settings.DOWNLOAD_CACHE_DIR:
+        return None
+    return DownloadCache(settings.DOWNLOAD_CACHE_DIR, settings.DOWNLOAD_CACHE_MAX_BYTES)
@@ -3,9 +3,15 @@
 Dump local parkeerrechten database in daily batches.
 """
 import sys
+import functools
+import json
 import logging
 import os
+import shutil
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from sqlalchemy import create_engine
 from sqlalchemy.sql import text
@@ -13,6 +19,11 @@ from sqlalchemy.sql import text
 from . import settings
 from . import objectstore
 from . import backup
+from . import checkpoint
+from . import metrics
+from . import namecheck
+from . import pgarchive
+from . import partitions
 
 DP_ENGINE = create_engine(settings.DATAPUNT_DB_URL)
 
@@ -21,25 +32,392 @@ logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
 logger = logging.getLogger('dump_database')
 
 
-def _pg_dump(filename):
-    """Construct pg_dump commandline and execute it."""
-    cmd = [
+def _pg_dump_command(schema=None):
+    table = '"{}"'.format(settings.TARGET_TABLE)
+    if schema is not None:
+        table = '"{}".{}'.format(schema, table)
+    return [
         'pg_dump',
         '--host=database',
         '--username=parkeerrechten',
         '--port=5432',
         '--no-password',  # use .pgpass (or fail)
         '--format=c',
-        '--table="{}"'.format(settings.TARGET_TABLE),
+        '--table={}'.format(table),
         '--exclude-table=auth*',
         '--dbname=parkeerrechten',
     ]
 
+
+@contextmanager
+def _dump_file(filename):
+    """
+    Open dump file for writing. It only gets its name once the with block
+    completes, so a dump file on disk is complete (see `_is_dumped`).
+    """
+    tmp_path = filename + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as outfile:
+            yield outfile
+        os.replace(tmp_path, filename)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _dump_record(batch_name, n_rows):
+    return {'batch_name': batch_name, 'staging': settings.DUMP_STAGING, 'rows': n_rows}
+
+
+def _record_dump(dump_file, batch_name, n_rows):
+    """Record what produced the dump, next to it (see `_is_dumped`)."""
+    with open(dump_file + '.json', 'w') as f:
+        json.dump(_dump_record(batch_name, n_rows), f)
+
+
+def _remove_dump(dump_file):
+    os.remove(dump_file)
+    if os.path.exists(dump_file + '.json'):
+        os.remove(dump_file + '.json')
+
+
+def _count_rows(batch_name):
+    with DP_ENGINE.connect() as conn:
+        return conn.execute(
+            text('''SELECT COUNT(*) FROM "{}" WHERE "VER_BATCH_NAAM" = :batch_name;'''.format(
+                settings.LOCAL_TABLE)),
+            {'batch_name': batch_name}
+        ).scalar()
+
+
+def _is_dumped(dump_file, batch_name):
+    """
+    Check for a dump left on disk by a previous run (of which the upload
+    failed, or that kept its dumps), it is uploaded instead of dumping the
+    batch again. An identical dump is needed for SKIP_UPLOADED to recognise
+    an upload that did reach the object store: pg_dump archives record the
+    time they were made.
+
+    The dump is only used if its record (see `_record_dump`) shows it was
+    made of this batch, as it is in the local table now, the same way
+    (DUMP_STAGING). Any other dump is removed.
+    """
+    if not os.path.exists(dump_file):
+        return False
+
+    try:
+        with open(dump_file + '.json', 'r') as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        record = None
+    if record is not None and record == _dump_record(batch_name, _count_rows(batch_name)):
+        logger.info('Using dump of a previous run: %s', dump_file)
+        return True
+
+    logger.info('Removing dump of a previous run, not made of this batch: %s', dump_file)
+    _remove_dump(dump_file)
+    return False
+
+
+def _public_archive(p, cmd, schema):
+    """
+    Read the output of pg_dump process `p` with the table dumped from
+    staging schema moved to public, so it restores like any other dump.
+    """
+    try:
+        return pgarchive.rename_schema(p.stdout, schema, 'public')
+    except pgarchive.ArchiveError:
+        # Most likely pg_dump failed, its return code tells.
+        p.stdout.close()
+        if p.wait() != 0:
+            raise subprocess.CalledProcessError(p.returncode, cmd)
+        raise
+
+
+def _pg_dump(filename, schema=None):
+    """Construct pg_dump commandline and execute it."""
+    cmd = _pg_dump_command(schema)
+
     logger.info('Running command: %s', cmd)
-    with open(filename, 'wb') as outfile:
-        p = subprocess.Popen(cmd, stdout=outfile)
-    p.wait()
-    logger.info('Return code: %d', p.returncode)
+    with metrics.timer('pg_dump_seconds'):
+        with _dump_file(filename) as outfile:
+            if schema is None:
+                p = subprocess.Popen(cmd, stdout=outfile)
+            else:
+                p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+                try:
+                    shutil.copyfileobj(_public_archive(p, cmd, schema), outfile)
+                finally:
+                    p.stdout.close()
+            p.wait()
+            logger.info('Return code: %d', p.returncode)
+            if p.returncode != 0:
+                raise subprocess.CalledProcessError(p.returncode, cmd)
+
+
+def _pg_dump_to_objectstore(file_name, schema=None):
+    """
+    Run pg_dump and upload its output while it is produced, no local file.
+
+    The upload is aborted (nothing becomes visible in the object store) if
+    pg_dump fails.
+    """
+    cmd = _pg_dump_command(schema)
+
+    def check_return_code():
+        if p.wait() != 0:
+            raise subprocess.CalledProcessError(p.returncode, cmd)
+
+    logger.info('Running command: %s (streaming to %s)', cmd, file_name)
+    with metrics.timer('pg_dump_seconds'):
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        try:
+            stream = p.stdout if schema is None else _public_archive(p, cmd, schema)
+            n_bytes, md5 = objectstore.upload_stream(
+                settings.OBJECT_STORE_CONTAINER, file_name, stream,
+                check=check_return_code)
+        finally:
+            # On failure pg_dump gets a broken pipe, no need to kill it.
+            p.stdout.close()
+            p.wait()
+    logger.info(
+        'Return code: %d, uploaded %d bytes (MD5 %s)', p.returncode, n_bytes, md5)
+
+
+def _dump_via_files(batch_names, dump_batch, remove_dumps):
+    """
+    Dump batches to local files, a few at a time, then upload those dumps
+    concurrently. Returns the dumps that could not be uploaded.
+    """
+    if remove_dumps:
+        logger.info('Removing database dumps from local storage immediately.')
+    else:
+        logger.info('Not removing database dumps from local storage.')
+
+    group_size = settings.OBJECTSTORE_POOL_SIZE
+    failed = []
+    for i in range(0, len(batch_names), group_size):
+        uploads = []
+        for batch_name in batch_names[i:i + group_size]:
+            dump_file = _dump_file_path(batch_name)
+            if not _is_dumped(dump_file, batch_name):
+                try:
+                    n_rows = dump_batch(batch_name, functools.partial(_pg_dump, dump_file))
+                except Exception:
+                    logger.exception('Dumping %s failed', batch_name)
+                    failed.append(dump_file)
+                    continue
+                _record_dump(dump_file, batch_name, n_rows)
+            uploads.append(objectstore.upload(
+                settings.OBJECT_STORE_CONTAINER, dump_file,
+                namecheck.file_name_for_batch_name(batch_name)))
+
+        # Upload to the object store.
+        results = objectstore.transfer_many(uploads)
+
+        for result in results:
+            if not result.ok:
+                logger.error(
+                    'Upload of %s failed: %s', result.transfer.path, result.result)
+                failed.append(result.transfer.path)
+            elif remove_dumps:
+                _remove_dump(result.transfer.path)
+
+    return failed
+
+
+def _dump_via_stream(batch_names, dump_batch):
+    """
+    Dump batches straight into the object store. Returns the dumps that
+    could not be uploaded.
+    """
+    failed = []
+    for batch_name in batch_names:
+        file_name = namecheck.file_name_for_batch_name(batch_name)
+        try:
+            dump_batch(batch_name, functools.partial(_pg_dump_to_objectstore, file_name))
+        except Exception:
+            logger.exception('Backing up %s failed', batch_name)
+            failed.append(file_name)
+
+    return failed
+
+
+def _export_template(dp_conn):
+    """
+    Dump an empty TARGET_TABLE with the columns of the local table, the
+    template of the dumps of all exported batches (see `_export`).
+    """
+    dp_conn.execute(text(
+        '''CREATE TABLE "{}" AS SELECT * FROM "{}" WITH NO DATA;'''.format(
+            settings.TARGET_TABLE, settings.LOCAL_TABLE)
+    ))
+    try:
+        cmd = _pg_dump_command() + ['--encoding=UTF8']
+        logger.info('Running command: %s (export template)', cmd)
+        return subprocess.check_output(cmd)
+    finally:
+        dp_conn.execute(text('''DROP TABLE "{}";'''.format(settings.TARGET_TABLE)))
+
+
+def _export(out, batch_name, template):
+    """
+    Write dump of batch to `out` without a copy of its rows: the template
+    (see `_export_template`) with a COPY of the batch from the local table
+    as its data. Returns the number of rows.
+    """
+    writer = pgarchive.ArchiveWriter(template, out)
+    with DP_ENGINE.connect() as conn:
+        # Copy a batch's partition as a whole, else select it.
+        if partitions.is_partitioned(conn, settings.LOCAL_TABLE):
+            source = '"{}"'.format(
+                partitions.partition_name(settings.LOCAL_TABLE, batch_name))
+        else:
+            source = '''(SELECT * FROM "{}" WHERE "VER_BATCH_NAAM" = '{}')'''.format(
+                settings.LOCAL_TABLE, batch_name)
+
+        cursor = conn.connection.cursor()
+        try:
+            cursor.copy_expert(
+                '''COPY {} TO STDOUT WITH (FORMAT text, ENCODING 'UTF8')'''.format(source),
+                writer)
+            n_rows = cursor.rowcount
+        finally:
+            cursor.close()
+    writer.close()
+    return n_rows
+
+
+def _export_to_file(filename, batch_name, template):
+    with metrics.timer('pg_dump_seconds'):
+        with _dump_file(filename) as outfile:
+            n_rows = _export(outfile, batch_name, template)
+    logger.info('Exported %s (%d rows) to %s', batch_name, n_rows, filename)
+    return n_rows
+
+
+def _export_to_objectstore(file_name, batch_name, template):
+    """
+    Export batch and upload the dump while it is produced, no local file.
+    """
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def export():
+        try:
+            with os.fdopen(write_fd, 'wb') as out:
+                _export(out, batch_name, template)
+        except Exception as e:
+            errors.append(e)
+
+    def check_export():
+        thread.join()
+        if errors:
+            raise errors[0]
+
+    with metrics.timer('pg_dump_seconds'):
+        thread = threading.Thread(target=export, name='export-' + batch_name)
+        thread.start()
+        stream = os.fdopen(read_fd, 'rb')
+        try:
+            n_bytes, md5 = objectstore.upload_stream(
+                settings.OBJECT_STORE_CONTAINER, file_name, stream, check=check_export)
+        finally:
+            # On failure the export gets a broken pipe.
+            stream.close()
+            thread.join()
+    logger.info('Exported %s, uploaded %d bytes (MD5 %s)', batch_name, n_bytes, md5)
+
+
+def _dump_file_path(batch_name):
+    return os.path.join(
+        '/', 'tmp', 'backups', batch_name + '_' + settings.BASENAME + '.dump')
+
+
+def _dump_in_schema(batch_name, pg_dump):
+    """
+    Stage batch in a schema of its own (with its own connection, so batches
+    can be dumped concurrently) and dump it from there. Returns the number
+    of rows.
+
+    The dump holds the table as public."TARGET_TABLE" (see `_public_archive`),
+    it restores like the dumps of batches staged in public.
+    """
+    schema = namecheck.schema_for_batch_name(batch_name)
+    drop_schema = 'DROP SCHEMA IF EXISTS "{}" CASCADE;'.format(schema)
+    create_table = text(
+        """
+        CREATE TABLE "{}"."{}" AS SELECT * FROM "{}" WHERE
+        "VER_BATCH_NAAM" = :batch_name """.format(
+            schema, settings.TARGET_TABLE, settings.LOCAL_TABLE
+        )
+    )
+
+    logger.debug('Backing up batch: %s (in schema %s)', batch_name, schema)
+    with DP_ENGINE.connect() as conn:
+        conn.execute(drop_schema)  # left-overs from previous failed runs
+        conn.execute('CREATE SCHEMA "{}";'.format(schema))
+        try:
+            n_rows = conn.execute(create_table, {'batch_name': batch_name}).rowcount
+            pg_dump(schema)
+        finally:
+            conn.execute(drop_schema)
+    return n_rows
+
+
+def _back_up_batch(batch_name, remove_dumps, template=None):
+    """
+    Dump batch and upload it: exported with the template (see
+    `_export_template`) if given, else from a schema of its own. Returns the
+    dump that could not be uploaded (None if all went well).
+    """
+    file_name = namecheck.file_name_for_batch_name(batch_name)
+    if settings.DUMP_MODE == 'stream':
+        if template is not None:
+            dump = functools.partial(_export_to_objectstore, file_name, batch_name, template)
+        else:
+            dump = functools.partial(_dump_in_schema, batch_name, functools.partial(
+                _pg_dump_to_objectstore, file_name))
+        try:
+            dump()
+        except Exception:
+            logger.exception('Backing up %s failed', batch_name)
+            return file_name
+        return None
+
+    dump_file = _dump_file_path(batch_name)
+    if template is not None:
+        dump = functools.partial(_export_to_file, dump_file, batch_name, template)
+    else:
+        dump = functools.partial(_dump_in_schema, batch_name, functools.partial(
+            _pg_dump, dump_file))
+    try:
+        if not _is_dumped(dump_file, batch_name):
+            _record_dump(dump_file, batch_name, dump())
+        ok, msg = objectstore.upload_file(
+            settings.OBJECT_STORE_CONTAINER, dump_file, file_name)
+    except Exception as e:
+        ok, msg = False, e
+    if not ok:
+        logger.error('Upload of %s failed: %s', dump_file, msg)
+        return dump_file
+    if remove_dumps:
+        _remove_dump(dump_file)
+    return None
+
+
+def _dump_concurrently(batch_names, remove_dumps, template=None):
+    """
+    Dump and upload DUMP_CONCURRENCY batches at a time, so uploads overlap
+    with the next dumps. Returns the dumps that could not be uploaded.
+    """
+    with ThreadPoolExecutor(max_workers=settings.DUMP_CONCURRENCY) as executor:
+        results = list(executor.map(
+            lambda batch_name: _back_up_batch(batch_name, remove_dumps, template),
+            batch_names))
+
+    return [result for result in results if result is not None]
 
 
 def _back_up_batches(dp_conn, batch_names, remove_dumps):
@@ -60,36 +438,70 @@ def _back_up_batches(dp_conn, batch_names, remove_dumps):
     except:
         pass
 
-    if remove_dumps:
-        logger.info('Removing database dumps from local storage immediately.')
-    else:
-        logger.info('Not removing database dumps from local storage.')
-
-    # Go over the batches in the local database and dump them.
-    for batch_name in batch_names:
+    def dump_batch(batch_name, pg_dump):
         logger.debug('Backing up batch: %s', batch_name)
-        dump_file = os.path.join(
-            '/', 'tmp', 'backups', batch_name + '_' + settings.BASENAME + '.dump')
-
         # Create temporary tables and dump them (views will not work).
-        dp_conn.execute(create_table, {'batch_name': batch_name})
-        _pg_dump(dump_file)
-        dp_conn.execute(drop_table, {'batch_name': batch_name})
+        n_rows = dp_conn.execute(create_table, {'batch_name': batch_name}).rowcount
+        try:
+            pg_dump()
+        finally:
+            dp_conn.execute(drop_table, {'batch_name': batch_name})
+        return n_rows
 
-        # Upload to the object store.
-        objectstore.upload_file(settings.OBJECT_STORE_CONTAINER, dump_file)
+    # Go over the batches in the local database and dump them.
+    if settings.DUMP_STAGING == 'export':
+        # Batches are exported from the local table, nothing is staged.
+        failed = _dump_concurrently(batch_names, remove_dumps, _export_template(dp_conn))
+    elif settings.DUMP_CONCURRENCY > 1:
+        failed = _dump_concurrently(batch_names, remove_dumps)
+    elif settings.DUMP_MODE == 'stream':
+        failed = _dump_via_stream(batch_names, dump_batch)
+    else:
+        failed = _dump_via_files(batch_names, dump_batch, remove_dumps)
+
+    if failed:
+        # Keep the local table, the next run retries these batches. Of a
+        # partitioned table only the partitions of these batches are kept.
+        if partitions.is_partitioned(dp_conn, settings.LOCAL_TABLE):
+            failed_batches = set(
+                namecheck.extract_batch_name(file_name) for file_name in failed)
+            _remove_batches(
+                dp_conn, [name for name in batch_names if name not in failed_batches])
+        return failed
 
-        # Remove local dump.
-        if remove_dumps:
-            os.remove(dump_file)
+    incomplete = checkpoint.get_incomplete_batch_names(dp_conn)
+    if incomplete:
+        # An import was interrupted, keep its rows and checkpoints so it can
+        # resume, throw away only the batches that were backed up.
+        logger.info('Keeping local table for incomplete batches: %s', incomplete)
+        _remove_batches(dp_conn, batch_names)
+        return failed
 
-    # Throw away local database table
+    # Throw away local database table (and the import checkpoints with it)
     dp_conn.execute("""DROP TABLE "{}";""".format(settings.LOCAL_TABLE))
+    checkpoint.drop_table(dp_conn)
+
+    return failed
+
+
+def _remove_batches(dp_conn, batch_names):
+    """Remove batches, and their checkpoints, from the local table."""
+    if partitions.is_partitioned(dp_conn, settings.LOCAL_TABLE):
+        for batch_name in batch_names:
+            partitions.drop_partition(dp_conn, settings.LOCAL_TABLE, batch_name)
+    else:
+        dp_conn.execute(
+            text('''DELETE FROM "{}" WHERE "VER_BATCH_NAAM" IN :batch_names;'''.format(
+                settings.LOCAL_TABLE)),
+            {'batch_names': tuple(batch_names)})
+    checkpoint.forget(dp_conn, batch_names)
 
 
 def _dump_database(dp_conn, remove_dumps=True):
     """
     Check for back-ups to perform and run database dump process.
+
+    Returns the dumps that could not be uploaded (the local table is kept).
     """
     # check that we have any table dumping to do:
     if not DP_ENGINE.has_table(settings.LOCAL_TABLE):
@@ -98,7 +510,7 @@ def _dump_database(dp_conn, remove_dumps=True):
 
     # connect to database, retrieve batches
     batch_names = backup.get_batch_names_in_database(
-        dp_conn, settings.LOCAL_TABLE, True)
+        dp_conn, settings.LOCAL_TABLE, True, completed_only=True)
     logger.info('Batches in local database (to potentially back up): %s', batch_names)
 
     # connect to object store and see which batches are available
@@ -107,10 +519,15 @@ def _dump_database(dp_conn, remove_dumps=True):
 
     batch_names = list(set(batch_names) - set(backed_up))
     if batch_names:
-        _back_up_batches(dp_conn, batch_names, remove_dumps=remove_dumps)
-        logger.info('Made the required backups, exiting.')
+        failed = _back_up_batches(dp_conn, batch_names, remove_dumps=remove_dumps)
+        if failed:
+            logger.error('Dumps that could not be uploaded: %s', failed)
+        else:
+            logger.info('Made the required backups, exiting.')
+        return failed
     else:
         logger.info('No new backups need to be made, exiting.')
+        return []
 
 
 def main():
@@ -120,8 +537,11 @@ def main():
     logger.info('Starting the NPR database dumper script')
     logger.info('Script was started with command: %s', sys.argv)
     logger.info('Dumping to table: {}'.format(settings.TARGET_TABLE))
-    with DP_ENGINE.connect() as dp_conn:
-        _dump_database(dp_conn)
+    with metrics.run('dump_database'):
+        with DP_ENGINE.connect() as dp_conn:
+            failed = _dump_database(dp_conn)
+        if failed:
+            sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,271 @@
+"""
+Stand-in for the object store (Swift) on top of a local directory.
+
+Implements the swiftclient Connection calls used by the backup scripts (and
+the csvdumps exporter): container listings with markers, prefixes and a page
+limit, plain and static large object uploads and downloads, HEAD, COPY and
+DELETE. Per-request latency and a throughput cap per transfer can be set, so
+changes to listing, upload and download can be benchmarked offline and
+reproducibly. Set BACKUP_OBJECTSTORE_FAKE_DIR to use it instead of the real
+object store.
+
+Layout: <root>/<container>/data/<quoted object name> holds the contents,
+<root>/<container>/meta/<quoted object name> the headers as JSON.
+"""
+import hashlib
+import json
+import os
+import time
+from email.utils import formatdate
+from urllib.parse import quote, unquote
+
+from swiftclient.exceptions import ClientException
+
+DEFAULT_PAGE_LIMIT = 10000
+
+
+def _read_contents(contents, content_length=None):
+    """Read object contents (bytes, str or file-like) as bytes chunks."""
+    if isinstance(contents, str):
+        contents = contents.encode('utf-8')
+    if isinstance(contents, bytes):
+        yield contents[:content_length]
+        return
+
+    remaining = content_length
+    while remaining is None or remaining > 0:
+        size = 2**16 if remaining is None else min(2**16, remaining)
+        chunk = contents.read(size)
+        if not chunk:
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
+
+
+class FakeSwiftConnection:
+    """
+    Directory backed object store, with the interface of a swiftclient
+    Connection.
+
+    `latency` (seconds) is added to every request, `bandwidth` (bytes per
+    second, None for no limit) caps the throughput of every transfer and
+    `page_limit` is the largest listing (limit) allowed, as Swift's
+    container_listing_limit.
+    """
+    def __init__(self, root, latency=0.0, bandwidth=None, page_limit=DEFAULT_PAGE_LIMIT):
+        self.root = root
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.page_limit = page_limit
+        self.n_requests = 0
+
+    # -- helpers --
+
+    def _request(self):
+        self.n_requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _throttle(self, n_bytes):
+        if self.bandwidth:
+            time.sleep(n_bytes / self.bandwidth)
+
+    def _container_dir(self, container, must_exist=True):
+        path = os.path.join(self.root, container)
+        if must_exist and not os.path.isdir(path):
+            raise ClientException(
+                'Container not found', http_status=404, http_path='/' + container)
+        return path
+
+    def _paths(self, container, name):
+        container_dir = self._container_dir(container)
+        quoted = quote(name, safe='')
+        return (
+            os.path.join(container_dir, 'data', quoted),
+            os.path.join(container_dir, 'meta', quoted),
+        )
+
+    def _headers(self, container, name):
+        _, meta_path = self._paths(container, name)
+        try:
+            with open(meta_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise ClientException(
+                'Object not found', http_status=404,
+                http_path='/{}/{}'.format(container, name))
+
+    def _store(self, container, name, chunks, headers, etag=None):
+        """
+        Store object. With `etag` given, the data must have that MD5 (else
+        422, like Swift, and an existing object is left as it was).
+        """
+        data_path, meta_path = self._paths(container, name)
+        md5 = hashlib.md5()
+        n_bytes = 0
+        tmp_path = data_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for chunk in chunks:
+                self._throttle(len(chunk))
+                f.write(chunk)
+                md5.update(chunk)
+                n_bytes += len(chunk)
+        if etag and etag != md5.hexdigest():
+            os.remove(tmp_path)
+            raise ClientException('Unprocessable Entity', http_status=422)
+        os.replace(tmp_path, data_path)
+
+        headers = dict(headers)
+        headers.setdefault('etag', md5.hexdigest())
+        headers.setdefault('content-length', str(n_bytes))
+        headers['last-modified'] = formatdate(usegmt=True)
+        headers['x-timestamp'] = '{:.5f}'.format(time.time())
+        with open(meta_path, 'w') as f:
+            json.dump(headers, f)
+        return headers['etag']
+
+    def _segments(self, container, name):
+        """Manifest (list of segment entries) of a static large object."""
+        data_path, _ = self._paths(container, name)
+        with open(data_path, 'r') as f:
+            return json.load(f)
+
+    def _body(self, container, name, headers, chunk_size):
+        data_path, _ = self._paths(container, name)
+        if headers.get('x-static-large-object') == 'True':
+            for segment in self._segments(container, name):
+                segment_container, segment_name = segment['name'][1:].split('/', 1)
+                segment_path, _ = self._paths(segment_container, segment_name)
+                yield from self._file_chunks(segment_path, chunk_size)
+        else:
+            yield from self._file_chunks(data_path, chunk_size)
+
+    def _file_chunks(self, path, chunk_size):
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                self._throttle(len(chunk))
+                yield chunk
+
+    # -- swiftclient Connection interface --
+
+    def get_auth(self):
+        return 'file://' + os.path.abspath(self.root), 'fake-token'
+
+    def close(self):
+        pass
+
+    def put_container(self, container, headers=None):
+        self._request()
+        container_dir = self._container_dir(container, must_exist=False)
+        os.makedirs(os.path.join(container_dir, 'data'), exist_ok=True)
+        os.makedirs(os.path.join(container_dir, 'meta'), exist_ok=True)
+
+    def get_container(self, container, marker=None, limit=None, prefix=None,
+                      full_listing=False, **kwargs):
+        self._request()
+        data_dir = os.path.join(self._container_dir(container), 'data')
+        names = sorted(
+            unquote(quoted) for quoted in os.listdir(data_dir)
+            if not quoted.endswith('.tmp'))
+        if marker:
+            names = [name for name in names if name > marker]
+        if prefix:
+            names = [name for name in names if name.startswith(prefix)]
+        if not full_listing:
+            if limit and limit > self.page_limit:
+                raise ClientException(
+                    'Maximum limit is {}'.format(self.page_limit),
+                    http_status=412, http_path='/' + container)
+            names = names[:limit or self.page_limit]
+
+        listing = []
+        for name in names:
+            headers = self._headers(container, name)
+            listing.append({
+                'name': name,
+                'bytes': int(headers['content-length']),
+                'hash': headers['etag'].strip('"'),
+                'last_modified': headers['last-modified'],
+                'content_type': headers.get('content-type', 'application/octet-stream'),
+            })
+        return {'x-container-object-count': str(len(listing))}, listing
+
+    def put_object(self, container, obj, contents=None, content_length=None,
+                   etag=None, content_type=None, headers=None, query_string=None,
+                   **kwargs):
+        self._request()
+        object_headers = {
+            key.lower(): value for key, value in (headers or {}).items()
+            if key.lower().startswith('x-object-meta-')
+        }
+        object_headers['content-type'] = content_type or 'application/octet-stream'
+
+        if query_string == 'multipart-manifest=put':
+            manifest = json.loads(b''.join(_read_contents(contents)).decode('utf-8'))
+            segments, md5, size = [], hashlib.md5(), 0
+            for entry in manifest:
+                segment_container, segment_name = entry['path'][1:].split('/', 1)
+                segment_headers = self._headers(segment_container, segment_name)
+                if entry.get('etag') and entry['etag'] != segment_headers['etag']:
+                    raise ClientException('Segment ETag mismatch', http_status=400)
+                segments.append({
+                    'name': entry['path'],
+                    'hash': segment_headers['etag'],
+                    'bytes': int(segment_headers['content-length']),
+                })
+                md5.update(segment_headers['etag'].encode('ascii'))
+                size += int(segment_headers['content-length'])
+
+            object_headers.update({
+                'x-static-large-object': 'True',
+                'etag': '"{}"'.format(md5.hexdigest()),
+                'content-length': str(size),
+            })
+            self._store(
+                container, obj, [json.dumps(segments).encode('utf-8')], object_headers)
+            return md5.hexdigest()
+
+        return self._store(
+            container, obj, _read_contents(contents, content_length), object_headers,
+            etag=etag)
+
+    def head_object(self, container, obj, headers=None, **kwargs):
+        self._request()
+        return self._headers(container, obj)
+
+    def get_object(self, container, obj, resp_chunk_size=None, query_string=None,
+                   **kwargs):
+        self._request()
+        headers = self._headers(container, obj)
+        if query_string == 'multipart-manifest=get':
+            return headers, json.dumps(self._segments(container, obj)).encode('utf-8')
+
+        chunks = self._body(container, obj, headers, resp_chunk_size or 2**16)
+        if resp_chunk_size:
+            return headers, chunks
+        return headers, b''.join(chunks)
+
+    def copy_object(self, container, obj, destination=None, headers=None, **kwargs):
+        self._request()
+        object_headers = self._headers(container, obj)
+        destination_container, destination_name = destination[1:].split('/', 1)
+        chunks = self._body(container, obj, object_headers, 2**16)
+        object_headers.pop('x-static-large-object', None)
+        object_headers.pop('etag', None)
+        object_headers.pop('content-length', None)
+        self._store(destination_container, destination_name, chunks, object_headers)
+
+    def delete_object(self, container, obj, query_string=None, **kwargs):
+        self._request()
+        data_path, meta_path = self._paths(container, obj)
+        headers = self._headers(container, obj)
+        if (query_string == 'multipart-manifest=delete' and
+                headers.get('x-static-large-object') == 'True'):
+            for segment in self._segments(container, obj):
+                self.delete_object(*segment['name'][1:].split('/', 1))
+        os.remove(data_path)
+        os.remove(meta_path)
@@ -0,0 +1,283 @@
+"""
+Persisted inventory (manifest) of the objects in the object store container.
+
+Listing the full container gets slower as the daily dumps pile up. Instead we
+keep a manifest of the objects seen so far, locally and/or as an object in
+the container, and only list objects that sort after the last known dump
+(new dumps have later dates, so later names). Uploads and moves through
+`objectstore` are recorded whatever their names: appended to a local
+journal, which the next refresh merges into the manifest. Objects deleted
+(or added) otherwise are not noticed this way, run the `resync_inventory`
+script when the manifest is suspect.
+
+The manifest is only written by a refresh (or resync), with the journal
+locked, so processes on one host do not lose each other's additions.
+Processes on other hosts sharing the manifest object may still overwrite
+each other's refresh, objects that sort after the marker are listed again
+by the next one.
+
+The object store is not imported here, the functions that need it are given
+the listing function (`objectstore._get_full_container_list`) and
+`objectstore.connection`.
+"""
+import fcntl
+import json
+import logging
+import os
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+from swiftclient.exceptions import ClientException
+
+from . import settings
+from . import namecheck
+
+LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
+logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+def is_enabled():
+    return bool(settings.INVENTORY_FILE or settings.INVENTORY_OBJECT)
+
+
+def _next_marker(objects):
+    """
+    Get listing marker: the last dump with a date in its name.
+
+    Note: 'Leeg' dumps (and other objects) sort after the dated dumps, these
+    are listed again on every refresh, but they are few. Only dumps in the
+    configured layout count: new dumps are named that way, while names in
+    the other layout (e.g. 20170801_... versus 2017/08/...) sort differently.
+    """
+    sharded = settings.OBJECT_LAYOUT == 'sharded'
+    dated = [
+        name for name in objects
+        if namecheck.is_batch_file(name, include_leeg=False) and
+        namecheck.is_sharded(name) == sharded
+    ]
+    return max(dated) if dated else None
+
+
+def _fold(manifest, listing):
+    """Add listed objects to manifest, return whether anything changed."""
+    changed = False
+    for object_ in listing:
+        name = object_['name']
+        if name == settings.INVENTORY_OBJECT:
+            continue
+
+        entry = {
+            'bytes': object_.get('bytes'),
+            'hash': object_.get('hash'),
+            'last_modified': object_.get('last_modified'),
+        }
+        if manifest['objects'].get(name) != entry:
+            manifest['objects'][name] = entry
+            changed = True
+
+    manifest['marker'] = _next_marker(manifest['objects'])
+    return changed
+
+
+def _journal_path():
+    if settings.INVENTORY_JOURNAL:
+        return settings.INVENTORY_JOURNAL
+    if settings.INVENTORY_FILE:
+        return settings.INVENTORY_FILE + '.journal'
+    return os.path.join('/', 'tmp', 'backups', 'inventory.journal')
+
+
+@contextmanager
+def _locked_journal():
+    """
+    Open the journal, locked against other threads and processes (every
+    open of the file gets a lock of its own).
+    """
+    path = _journal_path()
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'a+') as journal:
+        fcntl.flock(journal, fcntl.LOCK_EX)
+        try:
+            yield journal
+        finally:
+            journal.flush()
+            fcntl.flock(journal, fcntl.LOCK_UN)
+
+
+def _read_journal(journal, container):
+    """
+    Read the journal, return the entries of container and the lines of
+    other containers.
+    """
+    journal.seek(0)
+    entries, others = [], []
+    for line in journal:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue  # cut short by a killed process
+        if entry.get('container') == container:
+            entries.append(entry)
+        else:
+            others.append(line)
+    return entries, others
+
+
+def _rewrite_journal(journal, lines):
+    journal.seek(0)
+    journal.truncate()
+    journal.writelines(lines)
+
+
+def _fold_journal(manifest, entries):
+    """Apply journal entries to manifest, return whether anything changed."""
+    changed = False
+    for entry in entries:
+        if entry['removed'] is not None:
+            changed = manifest['objects'].pop(entry['removed'], None) is not None or changed
+        changed = _fold(manifest, [entry['object']]) or changed
+    return changed
+
+
+def _load(container, connection):
+    """Load manifest from local file, else from the object store."""
+    if settings.INVENTORY_FILE:
+        try:
+            with open(settings.INVENTORY_FILE, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            pass
+        else:
+            if manifest.get('container') == container:
+                return manifest
+
+    if settings.INVENTORY_OBJECT:
+        try:
+            with connection() as conn:
+                _, content = conn.get_object(container, settings.INVENTORY_OBJECT)
+            manifest = json.loads(content.decode('utf-8'))
+        except (ClientException, ValueError):
+            pass
+        else:
+            if manifest.get('container') == container:
+                return manifest
+
+    return None
+
+
+def _save(container, manifest, connection):
+    content = json.dumps(manifest, sort_keys=True)
+
+    if settings.INVENTORY_FILE:
+        directory = os.path.dirname(settings.INVENTORY_FILE)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = settings.INVENTORY_FILE + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, settings.INVENTORY_FILE)
+
+    if settings.INVENTORY_OBJECT:
+        with connection() as conn:
+            conn.put_object(
+                container, settings.INVENTORY_OBJECT, contents=content.encode('utf-8'),
+                content_type='application/json')
+
+
+def _as_listing(manifest):
+    return [
+        dict(name=name, **entry)
+        for name, entry in sorted(manifest['objects'].items())
+    ]
+
+
+def _listing_entry(name, headers):
+    """Listing entry of object `name` from the headers of a HEAD request."""
+    last_modified = headers.get('last-modified')
+    if last_modified:
+        # As in container listings (UTC, no zone).
+        last_modified = parsedate_to_datetime(last_modified).strftime(
+            '%Y-%m-%dT%H:%M:%S.%f')
+    return {
+        'name': name,
+        'bytes': int(headers.get('content-length', 0)),
+        'hash': headers.get('etag', '').strip('"'),
+        'last_modified': last_modified,
+    }
+
+
+def _resync(container, list_container, connection, journal):
+    logger.info('Rebuilding inventory of %s from full listing.', container)
+    _, others = _read_journal(journal, container)
+    manifest = {'container': container, 'marker': None, 'objects': {}}
+    _fold(manifest, list_container(container))
+    _save(container, manifest, connection)
+    # The full listing holds what was journaled before it.
+    _rewrite_journal(journal, others)
+
+    return _as_listing(manifest)
+
+
+def resync(container, list_container, connection):
+    """
+    Rebuild the manifest from a full listing of the container.
+    """
+    with _locked_journal() as journal:
+        return _resync(container, list_container, connection, journal)
+
+
+def refresh(container, list_container, connection):
+    """
+    Update the manifest with objects added since the last refresh: listed
+    after the marker, or recorded in the journal.
+    """
+    with _locked_journal() as journal:
+        manifest = _load(container, connection)
+        if manifest is None:
+            return _resync(container, list_container, connection, journal)
+
+        logger.info(
+            'Listing objects in %s after %s (inventory).', container, manifest['marker'])
+        kwargs = {} if manifest['marker'] is None else {'marker': manifest['marker']}
+        changed = _fold(manifest, list_container(container, **kwargs))
+        entries, others = _read_journal(journal, container)
+        if _fold_journal(manifest, entries) or changed:
+            _save(container, manifest, connection)
+        # Only now the manifest holds the journaled objects.
+        _rewrite_journal(journal, others)
+
+        return _as_listing(manifest)
+
+
+def add(container, name, headers, removed=None):
+    """
+    Record uploaded object `name` (with the headers of a HEAD request), and
+    the removal of object `removed` (the old name of a moved object), in the
+    journal for the next refresh.
+
+    Needed because these names need not sort after the listing marker (a
+    retried upload, a backfill).
+    """
+    if not is_enabled():
+        return
+
+    entry = {
+        'container': container,
+        'object': _listing_entry(name, headers),
+        'removed': removed,
+    }
+    with _locked_journal() as journal:
+        journal.write(json.dumps(entry, sort_keys=True) + '\n')
+
+
+def get_container_list(container, list_container, connection):
+    """
+    List objects in container, using the inventory if it is enabled.
+    """
+    if is_enabled():
+        return refresh(container, list_container, connection)
+    else:
+        return list_container(container)
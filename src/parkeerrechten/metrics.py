@@ -0,0 +1,178 @@
+"""
+Metrics (counters, gauges and histograms) for import, dump and restore runs.
+
+At the end of a run the metrics are written to the directory configured in
+the settings: as a Prometheus textfile (<job>.prom, for the node exporter
+textfile collector) and as a JSON run report (<job>.json).
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from . import settings
+
+LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
+logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+PREFIX = 'parkeerrechten_'
+DEFAULT_BUCKETS = (
+    0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+
+
+def _key(name, labels):
+    return (PREFIX + name, tuple(sorted(labels.items())))
+
+
+def inc(name, value=1, **labels):
+    """Increase counter `name` (with given labels) by `value`."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """Set gauge `name` (with given labels) to `value`."""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    """Add observation `value` to histogram `name` (with given labels)."""
+    key = _key(name, labels)
+    with _lock:
+        if key not in _histograms:
+            _histograms[key] = {
+                'buckets': [0] * len(DEFAULT_BUCKETS), 'sum': 0.0, 'count': 0}
+        histogram = _histograms[key]
+        for i, upper_bound in enumerate(DEFAULT_BUCKETS):
+            if value <= upper_bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observe the duration (seconds) of the with block in histogram `name`."""
+    t0 = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - t0, **labels)
+
+
+def reset():
+    """Forget all metrics."""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    formatted = []
+    for label, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        formatted.append('{}="{}"'.format(label, value))
+    return '{' + ','.join(formatted) + '}'
+
+
+def render_prometheus():
+    """Render all metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        for metrics, metric_type in [(_counters, 'counter'), (_gauges, 'gauge')]:
+            typed = set()
+            for (name, labels), value in sorted(metrics.items()):
+                if name not in typed:
+                    lines.append('# TYPE {} {}'.format(name, metric_type))
+                    typed.add(name)
+                lines.append('{}{} {}'.format(name, _format_labels(labels), value))
+
+        typed = set()
+        for (name, labels), histogram in sorted(_histograms.items()):
+            if name not in typed:
+                lines.append('# TYPE {} histogram'.format(name))
+                typed.add(name)
+            for upper_bound, count in zip(DEFAULT_BUCKETS, histogram['buckets']):
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(labels + (('le', upper_bound),)), count))
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(labels + (('le', '+Inf'),)), histogram['count']))
+            lines.append('{}_sum{} {}'.format(
+                name, _format_labels(labels), histogram['sum']))
+            lines.append('{}_count{} {}'.format(
+                name, _format_labels(labels), histogram['count']))
+
+    return '\n'.join(lines) + '\n'
+
+
+def report():
+    """Summarize all metrics as a JSON serializable dictionary."""
+    def entries(metrics, extra):
+        return [
+            dict(name=name, labels=dict(labels), **extra(value))
+            for (name, labels), value in sorted(metrics.items())
+        ]
+
+    with _lock:
+        return {
+            'counters': entries(_counters, lambda v: {'value': v}),
+            'gauges': entries(_gauges, lambda v: {'value': v}),
+            'histograms': entries(_histograms, lambda h: {
+                'count': h['count'], 'sum': h['sum']}),
+        }
+
+
+def _write_atomically(path, content):
+    # The textfile collector may read at any time, never show partial files.
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def write_reports(job):
+    """Write Prometheus textfile and JSON report for `job` (if configured)."""
+    if not settings.METRICS_DIR:
+        return
+
+    os.makedirs(settings.METRICS_DIR, exist_ok=True)
+    _write_atomically(
+        os.path.join(settings.METRICS_DIR, job + '.prom'), render_prometheus())
+    _write_atomically(
+        os.path.join(settings.METRICS_DIR, job + '.json'),
+        json.dumps(dict(job=job, **report()), indent=2))
+    logger.info('Wrote metrics for %s to %s', job, settings.METRICS_DIR)
+
+
+@contextmanager
+def run(job):
+    """
+    Record duration and outcome of the with block as a run of `job`, then
+    write the reports.
+    """
+    t0 = time.time()
+    success = False
+    try:
+        yield
+        success = True
+    except SystemExit as e:
+        success = not e.code
+        raise
+    finally:
+        set_gauge('run_duration_seconds', time.time() - t0, job=job)
+        set_gauge('run_success', int(success), job=job)
+        set_gauge('run_end_timestamp_seconds', time.time(), job=job)
+        write_reports(job)
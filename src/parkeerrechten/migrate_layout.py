@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Move the dumps in the object store to the configured layout.
+
+Renames every dump that is not named according to BACKUP_OBJECT_LAYOUT
+(e.g. 20170801_<basename>.dump becomes 2017/08/20170801_<basename>.dump in
+the sharded layout), several at a time. Run it after changing the layout,
+before the next dump or restore. It can safely be run again.
+"""
+import argparse
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from . import settings
+from . import objectstore
+from . import inventory
+from . import namecheck
+
+LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
+logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
+logger = logging.getLogger('migrate_layout')
+
+
+def plan_moves(object_names, layout):
+    """
+    List (old name, new name) pairs of the dumps not named according to layout.
+    """
+    moves = []
+    for name in object_names:
+        if not namecheck.is_batch_file(name, include_leeg=True):
+            continue
+        new_name = namecheck.file_name_for_batch_name(
+            namecheck.extract_batch_name(name), layout=layout)
+        if new_name != name:
+            moves.append((name, new_name))
+    return moves
+
+
+def _move(container, old_name, new_name):
+    try:
+        objectstore.move_object(container, old_name, new_name)
+    except Exception:
+        logger.exception('Moving %s to %s failed', old_name, new_name)
+        return False
+    logger.info('Moved %s to %s', old_name, new_name)
+    return True
+
+
+def migrate(container, layout, dry_run=False):
+    """
+    Move dumps in container to layout, return the number of failed moves.
+    """
+    listing = objectstore._get_full_container_list(container)
+    moves = plan_moves([object_['name'] for object_ in listing], layout)
+    logger.info('%d of %d objects to move to the %s layout', len(moves), len(listing), layout)
+    if dry_run or not moves:
+        for old_name, new_name in moves:
+            logger.info('Would move %s to %s', old_name, new_name)
+        return 0
+
+    with ThreadPoolExecutor(max_workers=settings.OBJECTSTORE_POOL_SIZE) as executor:
+        moved = list(executor.map(lambda move: _move(container, *move), moves))
+
+    # The inventory does not notice deleted objects.
+    if inventory.is_enabled():
+        inventory.resync(
+            container, objectstore._get_full_container_list, objectstore.connection)
+
+    return moved.count(False)
+
+
+def main():
+    """
+    Script entrypoint, move the dumps to the configured layout.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--dry-run', action='store_true', help='only log the objects to move')
+    args = parser.parse_args()
+
+    n_failed = migrate(
+        settings.OBJECT_STORE_CONTAINER, settings.OBJECT_LAYOUT, dry_run=args.dry_run)
+    if n_failed:
+        logger.error('%d objects could not be moved', n_failed)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
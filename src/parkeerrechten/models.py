@@ -3,14 +3,20 @@ Queries for the Parkeerrechten database as hosted by Datapunt.
 """
 # TODO: check whether we have to be explicit about encodings
 from sqlalchemy import Table, Column, types
+from sqlalchemy.sql import text
 
 
-def get_backup_table_def(metadata, table_name):
+def get_backup_table_def(metadata, table_name, partitioned=False):
     """
     Get SQLAlchemy core table definition to mirror that of NPR.
 
-    Note: for local db during import and testing.
+    Note: for local db during import and testing. A `partitioned` table (for
+    the local db) is LIST partitioned by VER_BATCH_NAAM, see partitions.py.
     """
+    kwargs = {}
+    if partitioned:
+        kwargs['postgresql_partition_by'] = 'LIST ("VER_BATCH_NAAM")'
+
     # the comments at the end of the lines are correcponding NPR datatypes
 
     table = Table(table_name, metadata,
@@ -41,7 +47,50 @@ def get_backup_table_def(metadata, table_name):
         Column('R_TYD_E_TYD_VR', types.String(14)),       # varchar
         Column('VER_BATCH_ID', types.Integer()),          # int 10
         Column('VER_BATCH_NAAM', types.String(12)),       # varchar
-        Column('KENM_RECHTV_INT', types.Unicode(40))      # nvarchar
+        Column('KENM_RECHTV_INT', types.Unicode(40)),     # nvarchar
+        **kwargs
+    )
+
+    return table
+
+
+def create_batch_name_index(connection, table_name):
+    """
+    Index VER_BATCH_NAAM of a local (or restored) table, if not indexed yet.
+
+    Note: create after bulk loading, it makes listing the batches a loose
+    index scan (see backup.get_batch_names_in_database).
+    """
+    connection.execute(text(
+        '''CREATE INDEX IF NOT EXISTS "{0}_VER_BATCH_NAAM_idx" ON "{0}" ("VER_BATCH_NAAM");'''
+        .format(table_name)
+    ))
+
+
+def get_checkpoint_table_def(metadata, table_name):
+    """
+    Get SQLAlchemy core table definition for import checkpoints.
+
+    Note: for local db during import, one row per (partially) imported batch.
+    """
+    table = Table(table_name, metadata,
+        Column('VER_BATCH_NAAM', types.String(12), primary_key=True),  # noqa
+        Column('LAST_VERW_RECHT_ID', types.Numeric(10, 0)),
+        Column('COMPLETE', types.Boolean(), nullable=False, default=False)
+    )
+
+    return table
+
+
+def get_watermark_table_def(metadata, table_name):
+    """
+    Get SQLAlchemy core table definition for the batch discovery watermark.
+
+    Note: for local db, one row per NPR table (see watermark.py).
+    """
+    table = Table(table_name, metadata,
+        Column('TABLE_NAME', types.String(128), primary_key=True),  # noqa
+        Column('VER_BATCH_NAAM', types.String(12), nullable=False)
     )
 
     return table
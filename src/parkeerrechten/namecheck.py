@@ -5,6 +5,7 @@ import logging
 import time
 
 from . settings import BACKUP_FILE_BASENAME
+from . import settings
 
 LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
 logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
@@ -51,28 +52,79 @@ def filter_batch_names_by_date(batch_names, start_date, end_date):
     return batch_names
 
 
+def shard_prefix(batch_name):
+    """
+    Prefix (YYYY/MM/) of the backup file of a dated batch in the sharded layout.
+    """
+    return '{}/{}/'.format(batch_name[:4], batch_name[4:6])
+
+
 def is_batch_file(file_name, include_leeg):
     """
-    Retun True if batch file name is valid.
+    Retun True if batch file name is valid (in the flat or sharded layout).
     """
     # TODO: name of function is wrong, refactor or rename!
     end = '_' + BACKUP_FILE_BASENAME + '.dump'
-    if file_name.endswith(end):
-        return is_batch_name(file_name[:-len(end)], include_leeg)
-    else:
+    prefix, _, base_name = file_name.rpartition('/')
+    if not base_name.endswith(end):
         return False
 
+    batch_name = base_name[:-len(end)]
+    if not is_batch_name(batch_name, include_leeg):
+        return False
+    # A sharded file must be in the directory of its date.
+    return not prefix or (batch_name != 'Leeg' and prefix + '/' == shard_prefix(batch_name))
+
+
+def is_sharded(file_name):
+    """Return True if (valid) batch file name is in the sharded layout."""
+    return '/' in file_name
+
 
 def extract_batch_name(file_name):
     """Extract batch name from a filename (only call with valid file names"""
     end = '_' + BACKUP_FILE_BASENAME + '.dump'
-    return file_name[:-len(end)]
+    return file_name.rpartition('/')[2][:-len(end)]
 
 
-def file_name_for_batch_name(batch_name):
+def file_name_for_batch_name(batch_name, layout=None):
     """
     Generate a backup filename from a batch_name.
+
+    In the 'sharded' layout dated batches go in a directory per month
+    (YYYY/MM/YYYYMMDD_<basename>.dump), the default is the configured layout.
     """
     if not is_batch_name(batch_name, include_leeg=True):
         raise ValueError('{} is not a batch name'.format(batch_name))
-    return batch_name + '_' + BACKUP_FILE_BASENAME + '.dump'
+    file_name = batch_name + '_' + BACKUP_FILE_BASENAME + '.dump'
+
+    layout = layout or settings.OBJECT_LAYOUT
+    if layout == 'sharded' and batch_name != 'Leeg':
+        return shard_prefix(batch_name) + file_name
+    return file_name
+
+
+def schema_for_batch_name(batch_name):
+    """
+    Name of the database schema a batch is staged in when dumping batches
+    concurrently (and restored into, before it is moved to TARGET_TABLE).
+    """
+    if not is_batch_name(batch_name, include_leeg=True):
+        raise ValueError('{} is not a batch name'.format(batch_name))
+    return 'dump_' + batch_name.lower()
+
+
+def month_prefixes(start_date, end_date):
+    """
+    Prefixes (YYYY/MM/) of the sharded layout that hold batches from
+    start_date up to and including end_date, None if the range is open.
+    """
+    if start_date is None or end_date is None:
+        return None
+
+    year, month = int(start_date[:4]), int(start_date[4:6])
+    prefixes = []
+    while '{:04d}{:02d}'.format(year, month) <= end_date[:6]:
+        prefixes.append('{:04d}/{:02d}/'.format(year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return prefixes
@@ -1,13 +1,29 @@
 """Retrieve file from remote objectstore.
 
 """
+import functools
+import hashlib
+import io
+import json
 import logging
 import os
-from functools import lru_cache
+import queue
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from swiftclient.client import Connection
 from swiftclient.exceptions import ClientException
+from swiftclient.utils import LengthWrapper
 from . settings import OBJECTSTORE_CONFIG as config
+from . import settings
+from . import metrics
+from . import downloadcache
+from . import fakeswift
+from . import inventory
 
 log = logging.getLogger(__name__)
 
@@ -28,22 +44,218 @@ os_connect = {
 }
 
 
-@lru_cache(maxsize=None)
-def get_conn():
+# Large object ETags are not the MD5 of the contents, so it is stored as well
+# (with the SHA-256, to recognise a dump that is already uploaded).
+MD5_HEADER = 'X-Object-Meta-Content-Md5'
+SHA256_HEADER = 'X-Object-Meta-Content-Sha256'
+
+
+class DownloadError(Exception):
+    pass
+
+
+class UploadError(Exception):
+    pass
+
+
+Transfer = namedtuple('Transfer', ['direction', 'container', 'name', 'path'])
+TransferResult = namedtuple('TransferResult', ['transfer', 'ok', 'result', 'seconds'])
+
+
+def _new_conn(**kwargs):
+    if settings.OBJECTSTORE_FAKE_DIR:
+        return fakeswift.FakeSwiftConnection(
+            settings.OBJECTSTORE_FAKE_DIR,
+            latency=settings.OBJECTSTORE_FAKE_LATENCY,
+            bandwidth=settings.OBJECTSTORE_FAKE_BANDWIDTH or None,
+            page_limit=settings.OBJECTSTORE_FAKE_PAGE_LIMIT
+        )
     assert config['key']
-    return Connection(**os_connect)
+    return Connection(**dict(os_connect, **kwargs))
+
+
+class ConnectionPool:
+    """
+    Bounded pool of object store connections, safe to use from many threads.
+
+    A swiftclient Connection must not be used by two threads at once, so each
+    caller gets a connection of its own for the duration of the with block.
+    At most `size` connections exist, callers wait when all are in use. New
+    connections reuse the token of an authenticated one instead of logging in
+    again (swiftclient re-authenticates by itself when the token expires).
+    """
+    def __init__(self, size, factory=None):
+        self.size = size
+        self._factory = factory or _new_conn
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._auth_lock = threading.Lock()
+        self._auth = None
+
+    def _connect(self):
+        # Log in once, other threads wait for (and then use) the token.
+        with self._auth_lock:
+            if self._auth is None:
+                conn = self._factory()
+                self._auth = conn.get_auth()
+                return conn
+
+        url, token = self._auth
+        return self._factory(preauthurl=url, preauthtoken=token)
+
+    @contextmanager
+    def connection(self):
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+
+            try:
+                yield conn
+            except ClientException:
+                # The object store answered, the connection itself is fine.
+                self._idle.put(conn)
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            else:
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+
+@functools.lru_cache(maxsize=None)
+def get_pool():
+    return ConnectionPool(settings.OBJECTSTORE_POOL_SIZE)
+
+
+def connection():
+    """
+    Object store connection for use within a with block (by one thread).
+    """
+    return get_pool().connection()
+
+
+def _record_transfer(direction, n_bytes, seconds):
+    metrics.inc('objectstore_transfers_total', direction=direction)
+    metrics.inc('objectstore_bytes_total', n_bytes, direction=direction)
+    metrics.observe('objectstore_transfer_seconds', seconds, direction=direction)
+
+
+def _is_large_object(headers):
+    """Segmented objects have an ETag that is not the MD5 of the contents."""
+    return (
+        headers.get('x-static-large-object', '').lower() == 'true' or
+        'x-object-manifest' in headers
+    )
+
+
+def _check_etag(name, headers, md5):
+    etag = headers.get('etag', '').strip('"')
+    if etag and not _is_large_object(headers) and etag != md5.hexdigest():
+        raise DownloadError('ETag mismatch for {}: expected {}, got {}'.format(
+            name, etag, md5.hexdigest()))
+
+
+def _stream_to_file(destination, headers, chunks):
+    """
+    Write chunks to a temporary file, verify ETag, move it to destination.
+    """
+    md5 = hashlib.md5()
+    n_bytes = 0
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(destination),
+        prefix='.' + os.path.basename(destination) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                md5.update(chunk)
+                n_bytes += len(chunk)
+
+        _check_etag(destination, headers, md5)
+        os.replace(tmp_path, destination)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    return n_bytes
+
+
+def _get_etag(container, file_name):
+    with connection() as conn:
+        return conn.head_object(container, file_name).get('etag', '').strip('"')
 
 
 def copy_file_from_objectstore(container, file_name, download_dir):
     os.makedirs(download_dir, exist_ok=True)
     destination = os.path.join(download_dir, file_name)
-    log.info("Download file {} to {}".format(file_name, destination))
     os.makedirs(os.path.dirname(destination), exist_ok=True)
-    with open(destination, 'wb') as f:
-        f.write(get_conn().get_object(container, file_name)[1])
+
+    cache = downloadcache.get_cache()
+    if cache is not None and cache.copy_to(
+            file_name, _get_etag(container, file_name), destination):
+        log.info("Copied file {} from download cache to {}".format(file_name, destination))
+        return destination
+
+    log.info("Download file {} to {}".format(file_name, destination))
+    t0 = time.time()
+    with connection() as conn:
+        headers, chunks = conn.get_object(
+            container, file_name, resp_chunk_size=settings.OBJECTSTORE_CHUNK_SIZE)
+        n_bytes = _stream_to_file(destination, headers, chunks)
+    _record_transfer('download', n_bytes, time.time() - t0)
+
+    if cache is not None:
+        cache.store(file_name, headers.get('etag', '').strip('"'), destination)
     return destination
 
 
+def _iter_download(container, file_name):
+    t0 = time.time()
+    md5 = hashlib.md5()
+    n_bytes = 0
+    with connection() as conn:
+        headers, chunks = conn.get_object(
+            container, file_name, resp_chunk_size=settings.OBJECTSTORE_CHUNK_SIZE)
+        for chunk in chunks:
+            md5.update(chunk)
+            n_bytes += len(chunk)
+            yield chunk
+
+    _check_etag(file_name, headers, md5)
+    _record_transfer('download', n_bytes, time.time() - t0)
+
+
+def iter_object(container, file_name):
+    """
+    Yield the contents of an object in chunks. Raises DownloadError after the
+    last chunk if the contents do not match the ETag.
+
+    With the download cache enabled the object is read from (or, while it is
+    downloaded, written to) the cache.
+    """
+    cache = downloadcache.get_cache()
+    if cache is None:
+        yield from _iter_download(container, file_name)
+        return
+
+    etag = _get_etag(container, file_name)
+    path = cache.lookup(file_name, etag)
+    if path is not None:
+        with open(path, 'rb') as f:
+            yield from iter(functools.partial(f.read, settings.OBJECTSTORE_CHUNK_SIZE), b'')
+        return
+
+    with cache.writer(file_name, etag) as f:
+        for chunk in _iter_download(container, file_name):
+            f.write(chunk)
+            yield chunk
+
+
 def fetch_import_file_names(container, folder=None):
     files = []
     for file_object in _get_full_container_list(container, prefix=folder):
@@ -60,39 +272,464 @@ def _get_full_container_list(container_name, **kwargs):
     :param kwargs:
     :return:
     """
-    limit = 10000
+    limit = settings.OBJECTSTORE_LISTING_LIMIT
     kwargs['limit'] = limit
     seed = []
-    _, page = get_conn().get_container(container_name, **kwargs)
+    with connection() as conn:
+        _, page = conn.get_container(container_name, **kwargs)
     seed.extend(page)
 
     while len(page) == limit:
         # keep getting pages..
         kwargs['marker'] = seed[-1]['name']
-        _, page = get_conn().get_container(container_name, **kwargs)
+        with connection() as conn:
+            _, page = conn.get_container(container_name, **kwargs)
         seed.extend(page)
     return seed
 
 
-def upload_file(container, file_path):
-    connection = get_conn()
-    path, file_name = os.path.split(file_path)
+def get_container_list_for_prefixes(container, prefixes):
+    """
+    List the objects in container with names starting with one of the
+    prefixes, the prefixes are listed concurrently.
+    """
+    prefixes = list(prefixes)
+    if not prefixes:
+        return []
 
-    with open(file_path, 'rb') as f:
-        connection.put_object(
+    with ThreadPoolExecutor(
+            max_workers=min(settings.OBJECTSTORE_POOL_SIZE, len(prefixes))) as executor:
+        listings = executor.map(
+            lambda prefix: _get_full_container_list(container, prefix=prefix), prefixes)
+        return [object_ for listing in listings for object_ in listing]
+
+
+def move_object(container, old_name, new_name):
+    """
+    Rename object within container (server side copy, then delete).
+
+    Static large objects are moved by copying their manifest, the segments
+    stay where they are.
+    """
+    with connection() as conn:
+        headers = conn.head_object(container, old_name)
+        if headers.get('x-static-large-object', '').lower() == 'true':
+            _, content = conn.get_object(
+                container, old_name, query_string='multipart-manifest=get')
+            manifest = [
+                {'path': segment['name'], 'etag': segment['hash'],
+                 'size_bytes': segment['bytes']}
+                for segment in json.loads(content.decode('utf-8'))
+            ]
+            metadata = {
+                key: value for key, value in headers.items()
+                if key.lower().startswith('x-object-meta-')
+            }
+            conn.put_object(
+                container,
+                new_name,
+                contents=json.dumps(manifest),
+                content_type=headers.get('content-type', 'application/octet-stream'),
+                query_string='multipart-manifest=put',
+                headers=metadata
+            )
+        else:
+            conn.copy_object(
+                container, old_name, destination='/{}/{}'.format(container, new_name))
+
+        # Without multipart-manifest=delete, only the manifest is deleted.
+        conn.delete_object(container, old_name)
+
+    _add_to_inventory(container, new_name, removed=old_name)
+
+
+def _open_at(file_path, offset):
+    f = open(file_path, 'rb')
+    f.seek(offset)
+    return f
+
+
+def _upload_segment(segments_container, segment_name, length, open_contents):
+    """
+    Upload `length` bytes from (the file object returned by) `open_contents`
+    as a segment, retry on failure, return its ETag.
+    """
+    for attempt in range(1, settings.OBJECTSTORE_SEGMENT_RETRIES + 1):
+        try:
+            with open_contents() as f:
+                contents = LengthWrapper(f, length, md5=True)
+                with connection() as conn:
+                    etag = conn.put_object(
+                        segments_container,
+                        segment_name,
+                        contents=contents,
+                        content_length=length,
+                        content_type='application/octet-stream'
+                    )
+            if etag != contents.get_md5sum():
+                raise UploadError('ETag mismatch for segment {}'.format(segment_name))
+        except Exception:
+            log.exception(
+                'Upload of segment %s failed (attempt %d)', segment_name, attempt)
+            if attempt == settings.OBJECTSTORE_SEGMENT_RETRIES:
+                raise
+        else:
+            return etag
+
+
+def _delete_segments(segments_container, segment_names):
+    """Remove (uploaded) segments of a failed upload, as far as possible."""
+    for segment_name in segment_names:
+        try:
+            with connection() as conn:
+                conn.delete_object(segments_container, segment_name)
+        except ClientException:
+            pass
+
+
+def _head_object(container, file_name):
+    """Get headers of object, None if it does not exist."""
+    try:
+        with connection() as conn:
+            return conn.head_object(container, file_name)
+    except ClientException as e:
+        if e.http_status == 404:
+            return None
+        raise
+
+
+def _get_segments(container, file_name, headers=None):
+    """
+    Get the segments, (container, name) tuples, of static large object
+    `file_name` (with `headers`, if they are known already): none if it
+    does not exist or is a plain object.
+    """
+    headers = headers or _head_object(container, file_name)
+    if headers is None or headers.get('x-static-large-object', '').lower() != 'true':
+        return []
+    with connection() as conn:
+        _, content = conn.get_object(
+            container, file_name, query_string='multipart-manifest=get')
+
+    return [
+        tuple(segment['name'][1:].split('/', 1))
+        for segment in json.loads(content.decode('utf-8'))
+    ]
+
+
+def _delete_replaced_segments(file_name, segments):
+    """
+    Remove the segments of the object `file_name` replaced (see
+    `_get_segments`), new segments never reuse their names.
+    """
+    if segments:
+        log.info('Removing %d segments of the replaced %s', len(segments), file_name)
+    for segments_container in sorted(set(c for c, _ in segments)):
+        _delete_segments(
+            segments_container, [name for c, name in segments if c == segments_container])
+
+
+def _segments_container(container):
+    segments_container = container + '_segments'
+    with connection() as conn:
+        conn.put_container(segments_container)
+    return segments_container
+
+
+def _put_manifest(container, file_name, segments_container, segments, headers=None):
+    """
+    Tie uploaded segments, (name, length, etag) tuples, together as a static
+    large object.
+    """
+    manifest = [
+        {
+            'path': '/{}/{}'.format(segments_container, segment_name),
+            'etag': etag,
+            'size_bytes': length,
+        }
+        for segment_name, length, etag in segments
+    ]
+    with connection() as conn:
+        conn.put_object(
             container,
             file_name,
-            contents=f,
-            content_type='application/octet-stream'
+            contents=json.dumps(manifest),
+            content_type='application/octet-stream',
+            query_string='multipart-manifest=put',
+            headers=headers
         )
 
+
+def _upload_segmented(container, file_name, file_path, headers=None):
+    """
+    Upload file as a static large object: segments uploaded in parallel,
+    followed by the manifest that ties them together.
+    """
+    size = os.path.getsize(file_path)
+    segment_size = settings.OBJECTSTORE_SEGMENT_SIZE
+    segments_container = _segments_container(container)
+    # Do not overwrite the segments of a previous upload while it is in use.
+    prefix = '{}/slo/{:.6f}/{}/{}/'.format(file_name, time.time(), size, segment_size)
+
+    segments = [
+        (prefix + '{:08d}'.format(i), offset, min(segment_size, size - offset))
+        for i, offset in enumerate(range(0, size, segment_size))
+    ]
+    log.info(
+        'Uploading %s in %d segments of at most %d bytes',
+        file_name, len(segments), segment_size)
+
     try:
-        resp_headers = connection.head_object(container, file_name)
+        with ThreadPoolExecutor(
+                max_workers=settings.OBJECTSTORE_UPLOAD_CONCURRENCY) as executor:
+            etags = list(executor.map(
+                lambda segment: _upload_segment(
+                    segments_container, segment[0], segment[2],
+                    functools.partial(_open_at, file_path, segment[1])),
+                segments
+            ))
+    except Exception:
+        _delete_segments(segments_container, [name for name, _, _ in segments])
+        raise
+
+    _put_manifest(
+        container, file_name, segments_container,
+        [(name, length, etag) for (name, _, length), etag in zip(segments, etags)],
+        headers=headers)
+
+
+def _read_segment(stream, size):
+    """Read `size` bytes from `stream`, fewer only at its end."""
+    chunks = []
+    while size > 0:
+        chunk = stream.read(min(size, settings.OBJECTSTORE_CHUNK_SIZE))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def upload_stream(container, file_name, stream, check=None):
+    """
+    Upload everything read from `stream` (e.g. a pipe) as `file_name`.
+
+    The size need not be known up front: the stream is read one segment at a
+    time, segments are uploaded while the next is read (at most
+    OBJECTSTORE_UPLOAD_CONCURRENCY segments are kept in memory). A stream
+    that fits in one segment becomes a plain object. `check` is called once
+    the stream is exhausted, before the object becomes visible, it may raise
+    to abort the upload. The MD5 and SHA-256 of the contents are stored as
+    metadata (the ETag of a large object is not the MD5). The segments of a
+    large object it replaces are removed.
+
+    Returns the size and MD5 (hex) of the uploaded contents.
+    """
+    t0 = time.time()
+    segment_size = settings.OBJECTSTORE_SEGMENT_SIZE
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    replaced_segments = _get_segments(container, file_name)
+
+    data = _read_segment(stream, segment_size)
+    md5.update(data)
+    sha256.update(data)
+    n_bytes = len(data)
+
+    if n_bytes < segment_size:
+        if check:
+            check()
+        with connection() as conn:
+            conn.put_object(
+                container,
+                file_name,
+                contents=data,
+                etag=md5.hexdigest(),
+                content_type='application/octet-stream',
+                headers=_hash_headers(md5.hexdigest(), sha256.hexdigest())
+            )
+        _delete_replaced_segments(file_name, replaced_segments)
+        _record_transfer('upload', n_bytes, time.time() - t0)
+        _add_to_inventory(container, file_name)
+        return n_bytes, md5.hexdigest()
+
+    segments_container = _segments_container(container)
+    prefix = '{}/slo/{:.6f}/stream/{}/'.format(file_name, time.time(), segment_size)
+    # One segment is being read while the others are being uploaded.
+    slots = threading.BoundedSemaphore(settings.OBJECTSTORE_UPLOAD_CONCURRENCY)
+    segments = []
+
+    try:
+        with ThreadPoolExecutor(
+                max_workers=settings.OBJECTSTORE_UPLOAD_CONCURRENCY) as executor:
+            while data:
+                slots.acquire()
+                segment_name = prefix + '{:08d}'.format(len(segments))
+                future = executor.submit(
+                    _upload_segment, segments_container, segment_name, len(data),
+                    functools.partial(io.BytesIO, data))
+                future.add_done_callback(lambda _: slots.release())
+                segments.append((segment_name, len(data), future))
+
+                # Stop reading as soon as a segment cannot be uploaded.
+                for _, _, f in segments:
+                    if f.done() and f.exception():
+                        raise f.exception()
+
+                data = _read_segment(stream, segment_size)
+                md5.update(data)
+                sha256.update(data)
+                n_bytes += len(data)
+
+        segments = [(name, length, f.result()) for name, length, f in segments]
+        if check:
+            check()
+    except Exception:
+        _delete_segments(segments_container, [name for name, _, _ in segments])
+        raise
+
+    log.info('Uploaded %s in %d segments', file_name, len(segments))
+    _put_manifest(
+        container, file_name, segments_container, segments,
+        headers=_hash_headers(md5.hexdigest(), sha256.hexdigest()))
+    _delete_replaced_segments(file_name, replaced_segments)
+    _record_transfer('upload', n_bytes, time.time() - t0)
+    _add_to_inventory(container, file_name)
+    return n_bytes, md5.hexdigest()
+
+
+def _hash_headers(md5, sha256):
+    return {MD5_HEADER: md5, SHA256_HEADER: sha256}
+
+
+def _file_hashes(file_path):
+    """
+    Get MD5 and SHA-256 (hex) and size of file.
+    """
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    n_bytes = 0
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(settings.OBJECTSTORE_CHUNK_SIZE)
+            if not chunk:
+                break
+            md5.update(chunk)
+            sha256.update(chunk)
+            n_bytes += len(chunk)
+
+    return {'md5': md5.hexdigest(), 'sha256': sha256.hexdigest(), 'bytes': n_bytes}
+
+
+def _add_to_inventory(container, file_name, headers=None, removed=None):
+    """Record uploaded (or moved) object for the inventory, see `inventory.add`."""
+    if not inventory.is_enabled():
+        return
+    if headers is None:
+        with connection() as conn:
+            headers = conn.head_object(container, file_name)
+    inventory.add(container, file_name, headers, removed=removed)
+
+
+def _has_hashes(headers, hashes):
+    """Check whether object (its headers, None if absent) has these contents."""
+    return headers is not None and (
+        headers.get(MD5_HEADER.lower()) == hashes['md5'] and
+        headers.get(SHA256_HEADER.lower()) == hashes['sha256'] and
+        headers.get('content-length') == str(hashes['bytes'])
+    )
+
+
+def upload_file(container, file_path, file_name=None):
+    """
+    Upload file, as `file_name` (default: the name of the file).
+
+    The object store verifies the upload against the MD5 of the file. With
+    SKIP_UPLOADED, a file already uploaded (same hashes in the metadata of
+    the object) is not uploaded again. The segments of a large object it
+    replaces are removed.
+    """
+    file_name = file_name or os.path.basename(file_path)
+    hashes = _file_hashes(file_path)
+    existing_headers = _head_object(container, file_name)
+
+    if settings.SKIP_UPLOADED and _has_hashes(existing_headers, hashes):
+        metrics.inc('objectstore_uploads_skipped_total')
+        metrics.inc('objectstore_bytes_skipped_total', hashes['bytes'])
+        _add_to_inventory(container, file_name, existing_headers)
+        return True, 'File {} already uploaded, skipped'.format(file_path)
+
+    headers = _hash_headers(hashes['md5'], hashes['sha256'])
+    replaced_segments = _get_segments(container, file_name, existing_headers)
+    t0 = time.time()
+    if hashes['bytes'] > settings.OBJECTSTORE_SEGMENT_THRESHOLD:
+        _upload_segmented(container, file_name, file_path, headers=headers)
+    else:
+        with open(file_path, 'rb') as f, connection() as conn:
+            # With the ETag given the object store checks what it received.
+            conn.put_object(
+                container,
+                file_name,
+                contents=f,
+                etag=hashes['md5'],
+                content_type='application/octet-stream',
+                headers=headers
+            )
+    _delete_replaced_segments(file_name, replaced_segments)
+    _record_transfer('upload', hashes['bytes'], time.time() - t0)
+
+    try:
+        with connection() as conn:
+            uploaded_headers = conn.head_object(container, file_name)
     except ClientException as e:
-        if e.http_status == '404':
+        if e.http_status == 404:
             msg = 'File {} not uploaded'.format(file_path)
         else:
             msg = 'Error while checking existence of {}'.format(file_path)
         return False, msg
-    else:
-        return True, 'File {} uploaded succesfully'.format(file_path)
+
+    _add_to_inventory(container, file_name, uploaded_headers)
+    return True, 'File {} uploaded succesfully'.format(file_path)
+
+
+def upload(container, file_path, file_name=None):
+    """Describe upload of `file_path` to `container`, for `transfer_many`."""
+    return Transfer(
+        'upload', container, file_name or os.path.basename(file_path), file_path)
+
+
+def download(container, file_name, download_dir):
+    """Describe download of `file_name` to `download_dir`, for `transfer_many`."""
+    return Transfer('download', container, file_name, download_dir)
+
+
+def _transfer(transfer):
+    t0 = time.time()
+    try:
+        if transfer.direction == 'upload':
+            ok, result = upload_file(transfer.container, transfer.path, transfer.name)
+        else:
+            ok, result = True, copy_file_from_objectstore(
+                transfer.container, transfer.name, transfer.path)
+    except Exception as e:
+        log.exception('Failed to %s %s', transfer.direction, transfer.name)
+        ok, result = False, e
+
+    return TransferResult(transfer, ok, result, time.time() - t0)
+
+
+def transfer_many(transfers, concurrency=None):
+    """
+    Run uploads and downloads (see `upload` and `download`) concurrently.
+
+    Returns a TransferResult per transfer, in the order given. A failing
+    transfer does not stop the others: its result is not ok and holds the
+    exception (or, for uploads, the message of `upload_file`).
+    """
+    transfers = list(transfers)
+    if not transfers:
+        return []
+
+    concurrency = concurrency or settings.OBJECTSTORE_POOL_SIZE
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(transfers))) as executor:
+        return list(executor.map(_transfer, transfers))
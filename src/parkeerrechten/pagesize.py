@@ -0,0 +1,71 @@
+"""
+Adapt the number of records read from NPR per page to measured performance.
+"""
+import logging
+import os
+import resource
+
+LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
+logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Limit the change of page size per page to avoid oscillation.
+MAX_GROWTH = 2.0
+MAX_SHRINK = 0.5
+
+
+def current_rss():
+    """
+    Get resident set size of this process in bytes.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # Not on Linux, fall back to the peak RSS (in kilobytes).
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class AdaptivePageSize:
+    """
+    Choose page sizes that keep page reads near a target latency.
+
+    After every page the measured rows/s is used to size the next page so
+    that it takes `target_seconds` to read, within [`minimum`, `maximum`].
+    When the process RSS exceeds `max_rss_bytes` (if set) the page size is
+    halved instead.
+    """
+    def __init__(self, seed, minimum, maximum, target_seconds, max_rss_bytes=None):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.max_rss_bytes = max_rss_bytes
+        self.size = self._clamp(seed)
+
+    def _clamp(self, size):
+        return int(max(self.minimum, min(self.maximum, size)))
+
+    def record(self, n_rows, seconds):
+        """
+        Record the duration of reading a page, choose the next page size.
+        """
+        rss = current_rss()
+        rows_per_second = n_rows / seconds if seconds > 0 else float('inf')
+
+        if self.max_rss_bytes and rss > self.max_rss_bytes:
+            new_size = self.size * MAX_SHRINK
+        elif n_rows < self.size:
+            # Last (partial) page of a batch, nothing learned about its size.
+            new_size = self.size
+        else:
+            new_size = rows_per_second * self.target_seconds
+            new_size = max(self.size * MAX_SHRINK, min(self.size * MAX_GROWTH, new_size))
+
+        logger.info(
+            'Page of %d records took %.2f seconds (%.0f rows/s, RSS %.0f MB), '
+            'next page size: %d', n_rows, seconds, rows_per_second,
+            rss / 2**20, self._clamp(new_size))
+
+        self.size = self._clamp(new_size)
+        return self.size
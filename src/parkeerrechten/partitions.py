@@ -0,0 +1,70 @@
+"""
+Per batch partitions of the local (staging) table.
+
+A partitioned local table (BACKUP_LOCAL_TABLE_MODE=partitioned) is LIST
+partitioned by VER_BATCH_NAAM, with a partition <table>_<batch name> per
+batch, created when the import of the batch starts. Listing the batches then
+reads the partition catalogue instead of scanning the records, a batch is
+dumped from its partition and dropped with it once it is backed up.
+"""
+import logging
+import re
+
+from sqlalchemy.sql import text
+
+from . import namecheck
+
+LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
+logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+_BOUND = re.compile(r"^FOR VALUES IN \('([^']*)'\)$")
+
+
+def partition_name(table_name, batch_name):
+    if not namecheck.is_batch_name(batch_name, include_leeg=True):
+        raise ValueError('{} is not a batch name'.format(batch_name))
+    return '{}_{}'.format(table_name, batch_name)
+
+
+def is_partitioned(connection, table_name):
+    """Whether table exists and is a partitioned (PostgreSQL) table."""
+    if connection.dialect.name != 'postgresql':
+        return False
+    return bool(connection.execute(text(
+        '''SELECT COUNT(*) FROM pg_partitioned_table
+        WHERE partrelid = to_regclass(:table_name);'''
+    ), {'table_name': '"{}"'.format(table_name)}).scalar())
+
+
+def create_partition(connection, table_name, batch_name):
+    """Create partition of table for batch if needed, return its name."""
+    name = partition_name(table_name, batch_name)
+    connection.execute(
+        '''CREATE TABLE IF NOT EXISTS "{}" PARTITION OF "{}" FOR VALUES IN ('{}');'''.format(
+            name, table_name, batch_name))
+    return name
+
+
+def drop_partition(connection, table_name, batch_name):
+    name = partition_name(table_name, batch_name)
+    logger.info('Dropping partition %s', name)
+    connection.execute('''DROP TABLE IF EXISTS "{}";'''.format(name))
+
+
+def get_batch_names(connection, table_name):
+    """List the batches with a partition in table, from the catalogue."""
+    rows = connection.execute(text(
+        '''SELECT pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(:table_name);'''
+    ), {'table_name': '"{}"'.format(table_name)}).fetchall()
+
+    batch_names = []
+    for (bound,) in rows:
+        match = _BOUND.match(bound)
+        if match is None:
+            logger.warning('Ignoring partition of %s for %s', table_name, bound)
+            continue
+        batch_names.append(match.group(1))
+    return sorted(batch_names)
@@ -0,0 +1,275 @@
+"""
+Write pg_dump custom format archives of a table from a COPY stream.
+
+pg_dump only dumps whole tables, so dumping one batch used to mean copying
+its rows into a table of their own first. Instead, pg_dump dumps an empty
+table with the definition of the batch table (the template), and the data
+block at the end of that archive is replaced with the output of a
+COPY (SELECT ...) TO STDOUT of the batch. The result restores with
+pg_restore like any other dump.
+
+The template must be written to a pipe (not a file), so that pg_dump leaves
+its data block at the end of the archive. Of the archive format only the
+data block is written here:
+
+    BLK_DATA, dump id, (length, data)*, 0
+
+where the data is the COPY text (ending in the end of copy marker), zlib
+compressed when the template is.
+
+A table dumped from a (staging) schema of its own can be moved to another
+schema by rewriting the header and table of contents (TOC) of the archive,
+see `rename_schema`.
+"""
+import zlib
+
+MAGIC = b'PGDMP'
+FORMAT_CUSTOM = 1
+BLK_DATA = 1
+END_OF_COPY = b'\\.\n\n\n'
+CHUNK_SIZE = 2**16
+
+# Archive versions of which the TOC can be read (pg_dump 9.6 up to 17).
+MIN_VERSION = (1, 12)
+MAX_VERSION = (1, 16)
+OFFSET_POS_NOT_SET = 1
+OFFSET_POS_SET = 2
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def _write_int(value, int_size):
+    """Integer as written by pg_dump: a sign byte and int_size bytes (LE)."""
+    return bytes([1 if value < 0 else 0]) + abs(value).to_bytes(int_size, 'little')
+
+
+def _read_int(data, offset, int_size):
+    """Read integer at offset, return (value, next offset) or (None, None)."""
+    end = offset + 1 + int_size
+    if end > len(data) or data[offset] not in (0, 1):
+        return None, None
+    value = int.from_bytes(data[offset + 1:end], 'little')
+    return (-value if data[offset] else value), end
+
+
+def _parse_data_block(template, offset, int_size):
+    """
+    Parse the data block of an empty table at offset, it must end the
+    template. Returns (dump id, compressed) or None.
+    """
+    if template[offset] != BLK_DATA:
+        return None
+    dump_id, offset = _read_int(template, offset + 1, int_size)
+    if offset is None:
+        return None
+    length, offset = _read_int(template, offset, int_size)
+    if not length or length < 0:
+        return None
+    data, offset = template[offset:offset + length], offset + length
+    end, offset = _read_int(template, offset, int_size)
+    if end != 0 or offset != len(template):
+        return None
+
+    if data == END_OF_COPY:
+        return dump_id, False
+    try:
+        if zlib.decompress(data) == END_OF_COPY:
+            return dump_id, True
+    except zlib.error:
+        pass
+    return None
+
+
+def split_template(template):
+    """
+    Split pg_dump archive of an empty table into its head (everything before
+    the data block), the dump id of the data, whether it is compressed and
+    the size of integers in the archive.
+    """
+    if template[:len(MAGIC)] != MAGIC or template[10] != FORMAT_CUSTOM:
+        raise ArchiveError('Not a pg_dump custom format archive')
+    int_size = template[8]  # after the magic and three version bytes
+
+    # The data block is short, look for it at the end.
+    for offset in range(len(template) - 1, len(MAGIC), -1):
+        parsed = _parse_data_block(template, offset, int_size)
+        if parsed is not None:
+            dump_id, compressed = parsed
+            return template[:offset], dump_id, compressed, int_size
+
+    raise ArchiveError('No data block of an empty table at the end of the archive')
+
+
+class ArchiveWriter:
+    """
+    File-like object that writes an archive to `out`: the template head,
+    then the data written to it (COPY text) as its data block.
+
+    Call close() when all data is written (it does not close `out`).
+    """
+    def __init__(self, template, out):
+        head, dump_id, compressed, self.int_size = split_template(template)
+        self.out = out
+        self.compressor = zlib.compressobj() if compressed else None
+        self.buffer = bytearray()
+        self.n_bytes = 0
+
+        out.write(head)
+        out.write(bytes([BLK_DATA]) + _write_int(dump_id, self.int_size))
+
+    def _write_chunk(self, data):
+        self.out.write(_write_int(len(data), self.int_size))
+        self.out.write(data)
+
+    def _add(self, data, final=False):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+            if final:
+                data += self.compressor.flush()
+        self.buffer += data
+        if final or len(self.buffer) >= CHUNK_SIZE:
+            self._write_chunk(bytes(self.buffer))
+            self.buffer.clear()
+
+    def write(self, data):
+        self.n_bytes += len(data)
+        self._add(data)
+        return len(data)
+
+    def close(self):
+        self._add(END_OF_COPY, final=True)
+        self.out.write(_write_int(0, self.int_size))
+
+
+def _read_exact(stream, n_bytes):
+    data = b''
+    while len(data) < n_bytes:
+        chunk = stream.read(n_bytes - len(data))
+        if not chunk:
+            raise ArchiveError('Archive ends within its table of contents')
+        data += chunk
+    return data
+
+
+class _TocReader:
+    """Read the integers and strings of an archive header and TOC."""
+    def __init__(self, stream, int_size):
+        self.stream = stream
+        self.int_size = int_size
+
+    def read_int(self):
+        value, _ = _read_int(_read_exact(self.stream, 1 + self.int_size), 0, self.int_size)
+        if value is None:
+            raise ArchiveError('Invalid integer in the table of contents')
+        return value
+
+    def read_str(self):
+        length = self.read_int()
+        return None if length < 0 else _read_exact(self.stream, length)
+
+
+def _write_str(value, int_size):
+    if value is None:
+        return _write_int(-1, int_size)
+    return _write_int(len(value), int_size) + value
+
+
+class _RenamedArchive:
+    """File-like object: the rewritten head, then the rest of the stream."""
+    def __init__(self, head, stream):
+        self.head = bytes(head)
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.head:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            data, self.head = self.head + self.stream.read(), b''
+        else:
+            data, self.head = self.head[:size], self.head[size:]
+        return data
+
+
+def rename_schema(stream, old, new):
+    """
+    Read pg_dump custom format archive from `stream`, return a file-like
+    object reading the same archive with the objects of schema `old` in
+    schema `new` (restored there by pg_restore).
+
+    The namespace of every TOC entry and the schema qualified names in its
+    statements are rewritten. Data offsets in the TOC would no longer be
+    right, they are unset (pg_restore then reads the data in order, as it
+    does for an archive written to a pipe).
+    """
+    old, new = old.encode('utf-8'), new.encode('utf-8')
+    qualified = [(b'"' + old + b'".', new + b'.'), (old + b'.', new + b'.')]
+
+    def rename(value):
+        if value is not None:
+            for pattern, replacement in qualified:
+                value = value.replace(pattern, replacement)
+        return value
+
+    head = bytearray(_read_exact(stream, len(MAGIC) + 6))
+    if head[:len(MAGIC)] != MAGIC or head[10] != FORMAT_CUSTOM:
+        raise ArchiveError('Not a pg_dump custom format archive')
+    version = (head[5], head[6])
+    if not MIN_VERSION <= version <= MAX_VERSION:
+        raise ArchiveError('Unsupported archive version {}.{}'.format(*version))
+    int_size, off_size = head[8], head[9]
+    toc = _TocReader(stream, int_size)
+
+    def copy_int():
+        value = toc.read_int()
+        head.extend(_write_int(value, int_size))
+        return value
+
+    def copy_str(f=None):
+        value = toc.read_str()
+        head.extend(_write_str(f(value) if f else value, int_size))
+        return value
+
+    # Compression, creation time, database name and versions.
+    if version >= (1, 15):
+        head.extend(_read_exact(stream, 1))
+    else:
+        copy_int()
+    for _ in range(7):
+        copy_int()
+    for _ in range(3):
+        copy_str()
+
+    n_entries = toc.read_int()
+    head.extend(_write_int(n_entries, int_size))
+    for _ in range(n_entries):
+        copy_int()  # dump id
+        copy_int()  # has data
+        copy_str()  # table oid
+        copy_str()  # oid
+        copy_str()  # tag
+        copy_str()  # description
+        copy_int()  # section
+        copy_str(rename)  # definition
+        copy_str(rename)  # drop statement
+        copy_str(rename)  # copy statement
+        copy_str(lambda namespace: new if namespace == old else namespace)
+        copy_str()  # tablespace
+        if version >= (1, 14):
+            copy_str()  # table access method
+        if version >= (1, 16):
+            copy_int()  # relkind
+        copy_str()  # owner
+        copy_str()  # with oids
+        while copy_str() is not None:  # dependencies
+            pass
+
+        flag = _read_exact(stream, 1)[0]
+        offset = _read_exact(stream, off_size)
+        if flag == OFFSET_POS_SET:
+            flag, offset = OFFSET_POS_NOT_SET, bytes(off_size)
+        head.append(flag)
+        head.extend(offset)
+
+    return _RenamedArchive(head, stream)
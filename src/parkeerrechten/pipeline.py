@@ -0,0 +1,119 @@
+"""
+Overlap reading pages of records (from NPR) with storing them (locally).
+"""
+import logging
+import queue
+import threading
+import time
+
+LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
+logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class Pipeline:
+    """
+    Iterate over pages read by a background thread, at most `depth` ahead.
+
+    The reader thread consumes `iterator` and hands the pages over through
+    a bounded queue. When the queue is full the reader waits (backpressure),
+    so at most depth + 2 pages are held in memory: those in the queue, the one
+    the reader is waiting to hand over and the one being stored.
+
+    The time each side spent waiting for the other is recorded, the side that
+    waited least is the bottleneck.
+    """
+    def __init__(self, iterator, depth, name=''):
+        self.name = name
+        self.read_seconds = 0.0  # reader busy reading
+        self.reader_wait_seconds = 0.0  # reader waiting for free queue slot
+        self.write_seconds = 0.0  # consumer busy storing
+        self.writer_wait_seconds = 0.0  # consumer waiting for a page
+        self.n_pages = 0
+
+        self._iterator = iterator
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._read, name='pipeline-reader', daemon=True)
+
+    def _put(self, item):
+        """Put item in queue unless the consumer stopped, return success."""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            else:
+                return True
+        return False
+
+    def _read(self):
+        try:
+            while not self._stop.is_set():
+                t0 = time.perf_counter()
+                try:
+                    page = next(self._iterator)
+                except StopIteration:
+                    break
+                t1 = time.perf_counter()
+                self.read_seconds += t1 - t0
+
+                if not self._put(page):
+                    break
+                self.reader_wait_seconds += time.perf_counter() - t1
+        except Exception as e:
+            self._error = e
+        finally:
+            # Clean up the iterator (e.g. database cursor) in this thread.
+            if hasattr(self._iterator, 'close'):
+                self._iterator.close()
+            self._put(_DONE)
+
+    def __iter__(self):
+        self._thread.start()
+        try:
+            while True:
+                t0 = time.perf_counter()
+                page = self._queue.get()
+                t1 = time.perf_counter()
+                self.writer_wait_seconds += t1 - t0
+
+                if page is _DONE:
+                    break
+
+                self.n_pages += 1
+                yield page
+                self.write_seconds += time.perf_counter() - t1
+
+            if self._error is not None:
+                raise self._error
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the reader thread (e.g. when the consumer stops early)."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    @property
+    def bottleneck(self):
+        """Side of the pipeline that made the other side wait the most."""
+        if self.reader_wait_seconds > self.writer_wait_seconds:
+            return 'writer'
+        else:
+            return 'reader'
+
+    def log_report(self):
+        logger.info(
+            'Pipeline %s: %d pages, reading %.2fs (waited %.2fs for writer), '
+            'writing %.2fs (waited %.2fs for reader), bottleneck: %s',
+            self.name, self.n_pages,
+            self.read_seconds, self.reader_wait_seconds,
+            self.write_seconds, self.writer_wait_seconds,
+            self.bottleneck
+        )
@@ -9,6 +9,7 @@ import logging
 from tempfile import TemporaryDirectory
 import os
 import subprocess
+import time
 
 from sqlalchemy import create_engine
 from sqlalchemy.sql import text
@@ -18,6 +19,9 @@ from . import objectstore
 from . import backup
 from . import namecheck
 from . import commandline
+from . import metrics
+from . import pipeline
+from . import models
 
 DP_ENGINE = create_engine(settings.DATAPUNT_DB_URL)
 
@@ -26,10 +30,7 @@ logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
 logger = logging.getLogger('dump_database')
 
 
-def _pg_restore(file_name):
-    """
-    Construct pg_restore command line and execute it.
-    """
+def _pg_restore_command(file_name=None):
     # Note: For now the target database not parametrized, following must match what
     # is present in dump_database.py script.
     cmd = [
@@ -41,17 +42,130 @@ def _pg_restore(file_name):
         '--format=c',
         '--table={}'.format(settings.TARGET_TABLE),
         '--dbname=parkeerrechten',
-        file_name
     ]
+    # Without a file name pg_restore reads the dump from stdin.
+    return cmd if file_name is None else cmd + [file_name]
+
+
+def _pg_restore(file_name):
+    """
+    Construct pg_restore command line and execute it.
+    """
+    cmd = _pg_restore_command(file_name)
     logger.info('Running command: %s', cmd)
-    p = subprocess.Popen(cmd)
-    p.wait()
+    with metrics.timer('pg_restore_seconds'):
+        p = subprocess.Popen(cmd)
+        p.wait()
     logger.info('Return code: %d', p.returncode)
 
 
+def _download_chunks(batch_names):
+    """
+    Yield (batch name, chunk) pairs with the dumps of the batches, in order.
+
+    After the last chunk of a dump follows (batch name, None), or (batch
+    name, exception) when it could not be (completely) downloaded.
+    """
+    for batch_name in batch_names:
+        file_name = namecheck.file_name_for_batch_name(batch_name)
+        try:
+            for chunk in objectstore.iter_object(settings.OBJECT_STORE_CONTAINER, file_name):
+                yield batch_name, chunk
+        except Exception as e:
+            logger.exception('Download of %s failed', file_name)
+            yield batch_name, e
+        else:
+            yield batch_name, None
+
+
+def _restore_streamed(dp_conn, batch_names):
+    """
+    Stream the dumps from the object store into pg_restore, one at a time.
+
+    Downloading runs ahead of restoring: up to RESTORE_PREFETCH_BYTES of the
+    current and next dumps are buffered in memory. Returns the batches that
+    could not be downloaded.
+    """
+    depth = max(1, settings.RESTORE_PREFETCH_BYTES // settings.OBJECTSTORE_CHUNK_SIZE)
+    chunks = pipeline.Pipeline(_download_chunks(batch_names), depth, name='restore')
+
+    failed = []
+    p = None
+    try:
+        for batch_name, chunk in chunks:
+            if p is None:
+                cmd = _pg_restore_command()
+                logger.info('Running command: %s (streaming %s)', cmd, batch_name)
+                t0 = time.time()
+                p = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+            if isinstance(chunk, bytes):
+                try:
+                    p.stdin.write(chunk)
+                except BrokenPipeError:
+                    # pg_restore gave up, its return code tells.
+                    pass
+                continue
+
+            if chunk is not None:
+                # Do not let pg_restore finish with a partial dump.
+                p.kill()
+                failed.append(batch_name)
+            try:
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
+            p.wait()
+            metrics.observe('pg_restore_seconds', time.time() - t0)
+            logger.info('Return code: %d', p.returncode)
+            p = None
+    finally:
+        if p is not None:
+            p.kill()
+            p.wait()
+        chunks.log_report()
+
+    return failed
+
+
+def _restore_from_files(dp_conn, batch_names):
+    """
+    Download a few dumps concurrently, then restore those one by one. Returns
+    the batches that could not be downloaded.
+    """
+    group_size = settings.OBJECTSTORE_POOL_SIZE
+    failed = []
+    with TemporaryDirectory() as temp_dir:
+        for i in range(0, len(batch_names), group_size):
+            results = objectstore.transfer_many(
+                objectstore.download(
+                    settings.OBJECT_STORE_CONTAINER,
+                    namecheck.file_name_for_batch_name(batch_name),
+                    temp_dir
+                )
+                for batch_name in batch_names[i:i + group_size]
+            )
+
+            for result in results:
+                if not result.ok:
+                    logger.error(
+                        'Download of %s failed: %s', result.transfer.name, result.result)
+                    failed.append(namecheck.extract_batch_name(result.transfer.name))
+                    continue
+
+                dump_file = result.result
+                _pg_restore(os.path.join(temp_dir, dump_file))
+
+                os.remove(dump_file)
+
+    return failed
+
+
 def _restore_database(raw_args, dp_conn):
     """
     Restore the individual pg_dump files from the object store.
+
+    Returns the names of the batches whose dumps could not be downloaded.
     """
     args = commandline.parse_args(raw_args, include_orphans_option=False)
 
@@ -63,7 +177,8 @@ def _restore_database(raw_args, dp_conn):
         return
 
     # Check the object store for backups
-    batch_names = backup.get_batch_names_in_objectstore(include_leeg=True)
+    batch_names = backup.get_batch_names_in_objectstore(
+        include_leeg=True, start_date=args.startdate, end_date=args.enddate)
     batch_names = namecheck.filter_batch_names_by_date(
         batch_names, args.startdate, args.enddate)
 
@@ -71,23 +186,25 @@ def _restore_database(raw_args, dp_conn):
     logging.info('Starting restore')
     logging.info(
         '\n\nERRORS MESSAGES ABOUT PRE-EXISTING TABLE EXPECTED BELOW - HARMLESS\n\n')
-    with TemporaryDirectory() as temp_dir:
-        for i, batch_name in enumerate(batch_names):
-            file_name = namecheck.file_name_for_batch_name(batch_name)
-            dump_file = objectstore.copy_file_from_objectstore(
-                settings.OBJECT_STORE_CONTAINER, file_name, temp_dir)
-
-            _pg_restore(os.path.join(temp_dir, dump_file))
-
-            os.remove(dump_file)
+    if settings.RESTORE_MODE == 'stream':
+        failed = _restore_streamed(dp_conn, batch_names)
+    else:
+        failed = _restore_from_files(dp_conn, batch_names)
 
     _erase_fields(dp_conn, settings.TARGET_TABLE, settings.SENSITIVE_FIELDS)
 
+    if settings.BATCH_NAMES_QUERY == 'skipscan':
+        models.create_batch_name_index(dp_conn, settings.TARGET_TABLE)
+
     table_content = backup.get_batch_names_in_database(
         dp_conn, settings.TARGET_TABLE, include_leeg=True, require_table=False)
 
     logging.debug('Present after restore: %s', str(table_content))
 
+    if failed:
+        logger.error('Batches that could not be restored: %s', failed)
+    return failed
+
 
 def _erase_fields(dp_conn, table_name, fields):
     for field_name in fields:
@@ -97,8 +214,11 @@ def _erase_fields(dp_conn, table_name, fields):
 
 
 def main():
-    with DP_ENGINE.connect() as dp_conn:
-        _restore_database(sys.argv[1:], dp_conn)
+    with metrics.run('restore_database'):
+        with DP_ENGINE.connect() as dp_conn:
+            failed = _restore_database(sys.argv[1:], dp_conn)
+        if failed:
+            sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+"""
+Rebuild the inventory of the object store container from a full listing.
+"""
+import logging
+import sys
+
+from . import settings
+from . import objectstore
+from . import inventory
+
+LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
+logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    """
+    Script entrypoint, rebuild the inventory from scratch.
+    """
+    if not inventory.is_enabled():
+        logger.error(
+            'No inventory configured (BACKUP_INVENTORY_FILE, BACKUP_INVENTORY_OBJECT).')
+        sys.exit(1)
+
+    listing = inventory.resync(
+        settings.OBJECT_STORE_CONTAINER, objectstore._get_full_container_list,
+        objectstore.connection)
+    logger.info('Inventory now holds %d objects.', len(listing))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,15 +5,25 @@ Import Data from NPR to local database.
 import sys
 import time
 import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
-from sqlalchemy import create_engine, select, asc, Table, MetaData
+from sqlalchemy import create_engine, select, asc, MetaData
 from sqlalchemy.sql import literal, text
 
 from . import settings
 from . import models
+from . import copyload
+from . import pipeline
+from . import pagesize
+from . import schema
+from . import checkpoint
+from . import partitions
+from . import metrics
 from . import namecheck
 from . import backup
 from . import commandline
+from . import watermark
 
 NPR_ENGINE = create_engine(settings.NPR_DB_URL)
 DP_ENGINE = create_engine(settings.DATAPUNT_DB_URL)
@@ -40,14 +50,135 @@ def batched_selection_iterator(connection, selection, batch_size, offset=0):
         yield rows
 
 
+def keyset_selection_iterator(
+        connection, selection, key_column, batch_size, last_key=None,
+        page_sizer=None):
+    """
+    Given an SQLAlchemy connection + selection query, provide batched iterator.
+
+    Note: the selection must be ordered by `key_column` (ascending) and the
+    key must be unique. Instead of using OFFSET (which makes the database
+    re-scan all preceding rows for every page), each page resumes after the
+    last key value seen on the previous page.
+
+    If a `page_sizer` (see pagesize.AdaptivePageSize) is given, it chooses
+    the size of every page instead of `batch_size`.
+    """
+    while True:
+        if page_sizer is not None:
+            batch_size = page_sizer.size
+
+        s = selection
+        if last_key is not None:
+            s = s.where(key_column > last_key)
+        t0 = time.time()
+        rows = connection.execute(s.limit(batch_size)).fetchall()
+
+        # For quick test runs.
+        if not rows:
+            break
+
+        if page_sizer is not None:
+            page_sizer.record(len(rows), time.time() - t0)
+
+        last_key = rows[-1][key_column.name]
+        yield rows
+
+
+def streamed_selection_iterator(connection, selection, chunk_size):
+    """
+    Given an SQLAlchemy connection + selection query, provide chunked iterator.
+
+    Runs the selection once using a server-side cursor (where the database
+    driver supports one) and yields fixed size chunks of rows, so memory use
+    is bounded by the chunk size rather than by the size of the result.
+    """
+    result = connection.execution_options(stream_results=True).execute(selection)
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+
+            yield rows
+    finally:
+        result.close()
+
+
+def _measured(iterator, batch_name):
+    """
+    Pass pages through, recording NPR read latency and records fetched.
+    """
+    try:
+        while True:
+            t0 = time.time()
+            try:
+                rows = next(iterator)
+            except StopIteration:
+                return
+            metrics.observe('npr_query_seconds', time.time() - t0)
+            metrics.inc('records_fetched_total', len(rows), batch=batch_name)
+
+            yield rows
+    finally:
+        if hasattr(iterator, 'close'):
+            iterator.close()
+
+
+def _page_sizer():
+    """
+    Provide page sizer for adaptive page sizes if configured, else None.
+    """
+    if settings.PAGE_SIZE_MODE == 'adaptive':
+        return pagesize.AdaptivePageSize(
+            seed=settings.BATCH_SIZE,
+            minimum=settings.PAGE_SIZE_MIN,
+            maximum=settings.PAGE_SIZE_MAX,
+            target_seconds=settings.PAGE_TARGET_SECONDS,
+            max_rss_bytes=settings.PAGE_MAX_RSS_MB * 2**20,
+        )
+    elif settings.PAGE_SIZE_MODE == 'static':
+        return None
+    else:
+        raise ValueError('Unknown page size mode: {}'.format(settings.PAGE_SIZE_MODE))
+
+
+def _selection_iterator(connection, selection, key_column):
+    """
+    Provide batched iterator over selection, as configured in the settings.
+    """
+    if settings.FETCH_MODE == 'stream':
+        return streamed_selection_iterator(
+            connection, selection, settings.STREAM_CHUNK_SIZE)
+    elif settings.FETCH_MODE == 'paged':
+        return keyset_selection_iterator(
+            connection, selection, key_column, settings.BATCH_SIZE,
+            page_sizer=_page_sizer())
+    else:
+        raise ValueError('Unknown fetch mode: {}'.format(settings.FETCH_MODE))
+
+
+def _local_loader(dp_table):
+    """
+    Provide function that stores rows in the local database table, as
+    configured in the settings.
+    """
+    if settings.LOAD_MODE == 'copy':
+        return copyload.CopyLoader(dp_table).load
+    elif settings.LOAD_MODE == 'insert':
+        def insert(connection, rows):
+            connection.execute(dp_table.insert(), rows)
+        return insert
+    else:
+        raise ValueError('Unknown load mode: {}'.format(settings.LOAD_MODE))
+
+
 def get_and_store_batch(npr_conn, dp_conn, batch_name):
     """
     Retrieve records from NPR, store them in local database in batches.
     """
     # set-up query for NPR
-    md = MetaData()
-    view = Table(
-        settings.NPR_TABLE, md, autoload=True, autoload_with=npr_conn)
+    view = schema.get_table(npr_conn, settings.NPR_TABLE)
 
     selection = (
         select([view])
@@ -56,21 +187,159 @@ def get_and_store_batch(npr_conn, dp_conn, batch_name):
     )
 
     # Set up table in local database if needed
-    md = MetaData()
-    dp_table = models.get_backup_table_def(md, settings.LOCAL_TABLE)
-    md.create_all(dp_conn)
+    dp_table = _create_local_table(dp_conn)
+
+    # A partitioned table gets a partition for the batch, listed as an
+    # incomplete batch (by its checkpoint) until the import completes.
+    if partitions.is_partitioned(dp_conn, settings.LOCAL_TABLE):
+        with dp_conn.begin():
+            partitions.create_partition(dp_conn, settings.LOCAL_TABLE, batch_name)
+            if checkpoint.get_resume_key(dp_conn, batch_name) is None:
+                checkpoint.save(dp_conn, batch_name, None)
 
-    it = batched_selection_iterator(npr_conn, selection, settings.BATCH_SIZE, 0)
-    for i, rows in enumerate(it):
-        dp_conn.execute(dp_table.insert(), rows)
+    # Resume after the last committed record of an interrupted import.
+    last_key = checkpoint.get_resume_key(dp_conn, batch_name)
+    if last_key is not None:
         logger.info(
-            '{} records were stored for batch {} (iteration no: {}).'.format(
-                len(rows), batch_name, i
+            'Resuming import of batch %s after VERW_RECHT_ID %s',
+            batch_name, last_key)
+        selection = selection.where(view.c.VERW_RECHT_ID > last_key)
+
+    n_records = 0
+    store_rows = _local_loader(dp_table)
+    it = _measured(
+        _selection_iterator(npr_conn, selection, view.c.VERW_RECHT_ID), batch_name)
+    if settings.PIPELINE_DEPTH > 0:
+        # Read the next pages from NPR while storing the current one.
+        it = pipeline.Pipeline(it, settings.PIPELINE_DEPTH, name=batch_name)
+
+    try:
+        for i, rows in enumerate(it):
+            # Store records and high-water mark atomically.
+            last_key = rows[-1]['VERW_RECHT_ID']
+            with dp_conn.begin():
+                store_rows(dp_conn, rows)
+                checkpoint.save(dp_conn, batch_name, last_key)
+            n_records += len(rows)
+            metrics.inc('records_stored_total', len(rows), batch=batch_name)
+            logger.info(
+                '{} records were stored for batch {} (iteration no: {}).'.format(
+                    len(rows), batch_name, i
+                )
             )
-        )
 
-        if settings.DEBUG:
-            break
+            if settings.DEBUG:
+                break
+    finally:
+        if settings.PIPELINE_DEPTH > 0:
+            it.close()
+            it.log_report()
+
+    checkpoint.save(dp_conn, batch_name, last_key, complete=True)
+
+    return n_records
+
+
+def _create_local_table(dp_conn):
+    """
+    Set up table in local database if needed, return its definition.
+    """
+    if not dp_conn.dialect.has_table(dp_conn, settings.LOCAL_TABLE):
+        # Checkpoints refer to records in the local table, start afresh.
+        checkpoint.drop_table(dp_conn)
+
+    md = MetaData()
+    dp_table = models.get_backup_table_def(
+        md, settings.LOCAL_TABLE, partitioned=settings.LOCAL_TABLE_MODE == 'partitioned')
+    md.create_all(dp_conn)
+    checkpoint.create_table(dp_conn)
+
+    return dp_table
+
+
+def _index_local_table(dp_conn):
+    """
+    Index the batch names of the (bulk loaded) local table for the loose
+    index scan, if used. A partitioned table lists its partitions instead.
+    """
+    if settings.BATCH_NAMES_QUERY != 'skipscan':
+        return
+    if partitions.is_partitioned(dp_conn, settings.LOCAL_TABLE):
+        return
+    models.create_batch_name_index(dp_conn, settings.LOCAL_TABLE)
+
+
+BatchOutcome = namedtuple(
+    'BatchOutcome', ['batch_name', 'n_records', 'seconds', 'error'])
+
+
+def _import_batch(npr_engine, dp_engine, batch_name):
+    """
+    Import one batch using connections of its own, report the outcome.
+
+    A failed batch keeps its committed records and checkpoint, the next run
+    resumes it.
+    """
+    t0 = time.time()
+    try:
+        with npr_engine.connect() as npr_conn, dp_engine.connect() as dp_conn:
+            n_records = get_and_store_batch(npr_conn, dp_conn, batch_name)
+    except Exception as e:
+        logger.exception('Importing batch %s failed.', batch_name)
+        return BatchOutcome(batch_name, 0, time.time() - t0, e)
+    else:
+        return BatchOutcome(batch_name, n_records, time.time() - t0, None)
+
+
+def _import_batches_in_parallel(npr_conn, dp_conn, batch_names, n_workers):
+    """
+    Import batches using a pool of workers, return the per batch outcomes.
+
+    Each worker takes its own NPR and local database connections from
+    connection pools that are bounded by the number of workers.
+    """
+    # Make sure the workers do not race to create the local table.
+    _create_local_table(dp_conn)
+
+    npr_engine = create_engine(
+        npr_conn.engine.url, pool_size=n_workers, max_overflow=0)
+    dp_engine = create_engine(
+        dp_conn.engine.url, pool_size=n_workers, max_overflow=0)
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            outcomes = list(executor.map(
+                lambda batch_name: _import_batch(npr_engine, dp_engine, batch_name),
+                batch_names
+            ))
+    finally:
+        npr_engine.dispose()
+        dp_engine.dispose()
+
+    logger.info('Summary of import with %d workers:', n_workers)
+    for outcome in outcomes:
+        if outcome.error is None:
+            logger.info(
+                'Batch %s: %d records in %.2f seconds',
+                outcome.batch_name, outcome.n_records, outcome.seconds)
+        else:
+            logger.error(
+                'Batch %s: FAILED after %.2f seconds (%r)',
+                outcome.batch_name, outcome.seconds, outcome.error)
+
+    return outcomes
+
+
+def _listed_from_watermark(args, dp_conn):
+    """
+    Whether all NPR batches from the watermark on were listed, only then can
+    the watermark move (a backfill window leaves it alone).
+    """
+    if args.orphans or args.enddate is not None:
+        return False
+    if args.startdate is None:
+        return True
+    current = watermark.get(dp_conn)
+    return current is not None and args.startdate <= current
 
 
 def _run_import(raw_args, npr_conn, dp_conn):
@@ -84,21 +353,30 @@ def _run_import(raw_args, npr_conn, dp_conn):
     logger.info('Backed-up batches in data store: %s', on_objectstore)
 
     in_local_db = backup.get_batch_names_in_database(
-        dp_conn, settings.LOCAL_TABLE, include_leeg=True, require_table=False
+        dp_conn, settings.LOCAL_TABLE, include_leeg=True, require_table=False,
+        completed_only=True
     )
     logger.info('Backed-up batches in local db: %s', in_local_db)
 
     backed_up = on_objectstore + in_local_db
 
     # Check what is requested by the user:
+    npr_batch_names = []
     if args.orphans:
         batch_names = ['Leeg']
     else:
-        # What is available in the NPR database in requested date range.
-        batch_names = backup.get_batch_names_in_database(
-            npr_conn, settings.NPR_TABLE, False)
+        # What is available in the NPR database in requested date range
+        # (NPR has no index to help, so only query that range). Without a
+        # --startdate only list from the watermark on, if we keep one.
+        start_date = args.startdate
+        if start_date is None and watermark.is_enabled():
+            start_date = watermark.get(dp_conn)
+            logger.info('Listing NPR batches from watermark %s', start_date)
+        npr_batch_names = backup.get_batch_names_in_database(
+            npr_conn, settings.NPR_TABLE, False,
+            start_date=start_date, end_date=args.enddate)
         batch_names = namecheck.filter_batch_names_by_date(
-            batch_names, args.startdate, args.enddate)
+            npr_batch_names, args.startdate, args.enddate)
 
     # We want batches that are requested and not yet backed up (these
     # are the set of candidates to back up).
@@ -111,17 +389,33 @@ def _run_import(raw_args, npr_conn, dp_conn):
     logger.info(
         'Backing up following batches: %s', batch_names[:settings.N_DAYS_PER_RUN])
 
-    for batch_name in batch_names[:settings.N_DAYS_PER_RUN]:
-        get_and_store_batch(npr_conn, dp_conn, batch_name)
+    failed = []
+    if args.workers > 1:
+        outcomes = _import_batches_in_parallel(
+            npr_conn, dp_conn, batch_names[:settings.N_DAYS_PER_RUN], args.workers)
+        failed = [o.batch_name for o in outcomes if o.error is not None]
+    else:
+        for batch_name in batch_names[:settings.N_DAYS_PER_RUN]:
+            get_and_store_batch(npr_conn, dp_conn, batch_name)
+
+    if watermark.is_enabled() and _listed_from_watermark(args, dp_conn):
+        new_watermark = watermark.next_watermark(
+            npr_batch_names, batch_names[settings.N_DAYS_PER_RUN:] + failed)
+        if new_watermark is not None:
+            logger.info('New watermark for listing NPR batches: %s', new_watermark)
+            watermark.save(dp_conn, new_watermark)
 
     if batch_names:
         sql = '''select count(*) from "{}"'''.format(settings.LOCAL_TABLE)
         result = dp_conn.execute(text(sql)).fetchall()
         logger.info(
             'There are now %s records in the local postgres db', result[0])
+        _index_local_table(dp_conn)
     else:
         logger.info('No new backups were needed.')
 
+    return failed
+
 
 def main():
     """
@@ -130,11 +424,16 @@ def main():
     logger.info('Starting NPR parkeerrechten import script.')
     logger.info('Script was called with: %s', sys.argv)
     t0 = time.time()
-    # Establish needed database connections (Datapunt local, NPR remote):
-    with NPR_ENGINE.connect() as npr_conn, DP_ENGINE.connect() as dp_conn:
-        _run_import(sys.argv[1:], npr_conn, dp_conn)
-    dt = time.time() - t0
-    logger.info('The script took %.2f seconds to run', dt)
+    with metrics.run('run_import'):
+        # Establish needed database connections (Datapunt local, NPR remote):
+        with NPR_ENGINE.connect() as npr_conn, DP_ENGINE.connect() as dp_conn:
+            failed = _run_import(sys.argv[1:], npr_conn, dp_conn)
+        dt = time.time() - t0
+        logger.info('The script took %.2f seconds to run', dt)
+
+        if failed:
+            logger.error('Failed to import batches: %s', failed)
+            sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,114 @@
+"""
+Table definitions for NPR and local tables, reflected at most once.
+
+Reflecting a table costs several catalogue queries, which is slow for the
+remote NPR database. Definitions are cached per process and, when a snapshot
+directory is configured, the reflected columns are persisted so that later
+processes need not reflect at all. If the columns match the static definition
+in `models.get_backup_table_def`, that definition is used.
+"""
+import json
+import logging
+import os
+import threading
+
+from sqlalchemy import Table, MetaData
+
+from . import settings
+from . import models
+
+LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
+logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def column_signature(table):
+    """
+    List the column names and Python types of a table definition.
+    """
+    signature = []
+    for column in table.columns:
+        try:
+            type_name = column.type.python_type.__name__
+        except NotImplementedError:
+            type_name = None
+        signature.append([column.name, type_name])
+
+    return signature
+
+
+def _snapshot_path(table_name):
+    return os.path.join(settings.SCHEMA_SNAPSHOT_DIR, table_name + '.json')
+
+
+def _load_snapshot(table_name):
+    if not settings.SCHEMA_SNAPSHOT_DIR:
+        return None
+
+    try:
+        with open(_snapshot_path(table_name), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_snapshot(table_name, signature):
+    if not settings.SCHEMA_SNAPSHOT_DIR:
+        return
+
+    os.makedirs(settings.SCHEMA_SNAPSHOT_DIR, exist_ok=True)
+    with open(_snapshot_path(table_name), 'w') as f:
+        json.dump(signature, f)
+
+
+def _reflect(connection, table_name):
+    logger.info('Reflecting table definition of %s', table_name)
+    table = Table(
+        table_name, MetaData(), autoload=True, autoload_with=connection)
+    _save_snapshot(table_name, column_signature(table))
+
+    return table
+
+
+def _define_table(connection, table_name):
+    static = models.get_backup_table_def(MetaData(), table_name)
+
+    reflected = None
+    signature = _load_snapshot(table_name)
+    if signature is None:
+        reflected = _reflect(connection, table_name)
+        signature = column_signature(reflected)
+
+    if signature == column_signature(static):
+        return static
+
+    logger.warning(
+        'Columns of %s do not match the static definition, using reflected '
+        'definition instead.', table_name)
+    if reflected is None:
+        reflected = _reflect(connection, table_name)
+
+    return reflected
+
+
+def get_table(connection, table_name):
+    """
+    Get the SQLAlchemy table definition for `table_name`.
+
+    Note: raises NoSuchTableError if the table has to be reflected and does
+    not exist (this is not cached).
+    """
+    key = (str(connection.engine.url), table_name)
+    with _lock:
+        if key not in _cache:
+            _cache[key] = _define_table(connection, table_name)
+        return _cache[key]
+
+
+def clear_cache():
+    """Forget all cached table definitions (not the snapshots)."""
+    with _lock:
+        _cache.clear()
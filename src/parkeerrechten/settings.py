@@ -55,3 +55,124 @@ DEBUG = True if os.environ.get('DEBUGRUN', '') == 'TRUE' else False
 
 BATCH_SIZE = int(os.environ['BACKUP_BATCH_SIZE']) if not DEBUG else 10
 BASENAME = os.environ['BACKUP_FILE_BASENAME']
+
+# How records are read from NPR: 'paged' runs one query per page, 'stream'
+# runs one server-side cursor query per batch and reads it in chunks.
+FETCH_MODE = os.environ.get('BACKUP_FETCH_MODE', 'paged')
+STREAM_CHUNK_SIZE = int(os.environ.get('BACKUP_STREAM_CHUNK_SIZE', '5000')) if not DEBUG else 10
+
+# How records are stored locally: 'copy' uses COPY FROM STDIN, 'insert' uses
+# (executemany) INSERT statements.
+LOAD_MODE = os.environ.get('BACKUP_LOAD_MODE', 'copy')
+
+# Number of pages read ahead from NPR while storing locally (0 disables).
+PIPELINE_DEPTH = int(os.environ.get('BACKUP_PIPELINE_DEPTH', '0'))
+
+# Directory with persisted table definitions (so NPR need not be reflected
+# every run), leave empty to only cache definitions in memory.
+SCHEMA_SNAPSHOT_DIR = os.environ.get('BACKUP_SCHEMA_SNAPSHOT_DIR', '')
+
+# checkpoints of the import into the temporary database
+CHECKPOINT_TABLE = 'VW_0363_CHECKPOINT'
+
+# How the import finds the batches in NPR: 'full' (list all batches every
+# run) or 'watermark' (list only the batches from the watermark on, kept in
+# WATERMARK_TABLE in the local database, plus the --startdate window).
+NPR_DISCOVERY = os.environ.get('BACKUP_NPR_DISCOVERY', 'full')
+WATERMARK_TABLE = 'VW_0363_WATERMARK'
+
+# Page size for reads from NPR: 'static' uses BACKUP_BATCH_SIZE for every
+# page, 'adaptive' starts there and adjusts the size of the next page to hit
+# the target read latency (halving it when RSS exceeds the memory ceiling,
+# 0 disables the ceiling).
+PAGE_SIZE_MODE = os.environ.get('BACKUP_PAGE_SIZE_MODE', 'static')
+PAGE_SIZE_MIN = int(os.environ.get('BACKUP_PAGE_SIZE_MIN', '1000'))
+PAGE_SIZE_MAX = int(os.environ.get('BACKUP_PAGE_SIZE_MAX', '200000'))
+PAGE_TARGET_SECONDS = float(os.environ.get('BACKUP_PAGE_TARGET_SECONDS', '10'))
+PAGE_MAX_RSS_MB = int(os.environ.get('BACKUP_PAGE_MAX_RSS_MB', '0'))
+
+# Directory for Prometheus textfile (<job>.prom) and JSON (<job>.json) run
+# reports, leave empty to not write them.
+METRICS_DIR = os.environ.get('BACKUP_METRICS_DIR', '')
+
+# Inventory of the object store container, kept in a local file and/or in an
+# object in the container (leave both empty to list the full container).
+INVENTORY_FILE = os.environ.get('BACKUP_INVENTORY_FILE', '')
+INVENTORY_OBJECT = os.environ.get('BACKUP_INVENTORY_OBJECT', '')
+
+# Local journal of the objects uploaded (or moved) since the last refresh of
+# the inventory (default: INVENTORY_FILE + '.journal', else in /tmp/backups).
+INVENTORY_JOURNAL = os.environ.get('BACKUP_INVENTORY_JOURNAL', '')
+
+# Number of objects asked for per container listing request (Swift allows
+# at most 10000).
+OBJECTSTORE_LISTING_LIMIT = int(os.environ.get('BACKUP_OBJECTSTORE_LISTING_LIMIT', '10000'))
+
+# Size of the chunks in which objects are downloaded (bytes).
+OBJECTSTORE_CHUNK_SIZE = int(os.environ.get('BACKUP_OBJECTSTORE_CHUNK_SIZE', str(2**20)))
+
+# Files larger than the threshold are uploaded as static large objects, in
+# segments (sizes in bytes) that are uploaded (and retried) concurrently.
+OBJECTSTORE_SEGMENT_THRESHOLD = int(
+    os.environ.get('BACKUP_OBJECTSTORE_SEGMENT_THRESHOLD', str(256 * 2**20)))
+OBJECTSTORE_SEGMENT_SIZE = int(
+    os.environ.get('BACKUP_OBJECTSTORE_SEGMENT_SIZE', str(64 * 2**20)))
+OBJECTSTORE_UPLOAD_CONCURRENCY = int(
+    os.environ.get('BACKUP_OBJECTSTORE_UPLOAD_CONCURRENCY', '4'))
+OBJECTSTORE_SEGMENT_RETRIES = int(os.environ.get('BACKUP_OBJECTSTORE_SEGMENT_RETRIES', '3'))
+
+# Number of object store connections shared by concurrent transfers (also the
+# number of dumps uploaded or downloaded at the same time).
+OBJECTSTORE_POOL_SIZE = int(os.environ.get('BACKUP_OBJECTSTORE_POOL_SIZE', '4'))
+
+# How dumps get to the object store: 'file' (pg_dump to /tmp/backups, then
+# upload) or 'stream' (pipe pg_dump straight into the object store).
+DUMP_MODE = os.environ.get('BACKUP_DUMP_MODE', 'file')
+
+# Number of batches dumped (and uploaded) at the same time. Above 1 every
+# batch is staged in a schema of its own instead of the shared TARGET_TABLE
+# (exported batches are not staged at all).
+DUMP_CONCURRENCY = int(os.environ.get('BACKUP_DUMP_CONCURRENCY', '1'))
+
+# How a batch is staged for pg_dump: 'table' (copy its rows into a table of
+# their own) or 'export' (dump an empty table once, fill a copy of that dump's
+# data with a COPY of each batch, no copy of the rows is written).
+DUMP_STAGING = os.environ.get('BACKUP_DUMP_STAGING', 'table')
+
+# Kind of local (staging) table created by the import: 'heap' (one table) or
+# 'partitioned' (a partition per batch, dumped and dropped per batch).
+LOCAL_TABLE_MODE = os.environ.get('BACKUP_LOCAL_TABLE_MODE', 'heap')
+
+# How batch names are found in the local and restored tables: 'distinct'
+# (SELECT DISTINCT) or 'skipscan' (a loose index scan, on the index created
+# after bulk loading, PostgreSQL only, so not for NPR).
+BATCH_NAMES_QUERY = os.environ.get('BACKUP_BATCH_NAMES_QUERY', 'distinct')
+
+# How dumps get from the object store to pg_restore: 'file' (download to a
+# temporary directory first) or 'stream' (pipe into pg_restore, downloading
+# ahead up to RESTORE_PREFETCH_BYTES).
+RESTORE_MODE = os.environ.get('BACKUP_RESTORE_MODE', 'file')
+RESTORE_PREFETCH_BYTES = int(
+    os.environ.get('BACKUP_RESTORE_PREFETCH_BYTES', str(256 * 2**20)))
+
+# Directory to keep downloaded dumps in for later restores (empty disables),
+# least recently used dumps are evicted above the maximum size (bytes).
+DOWNLOAD_CACHE_DIR = os.environ.get('BACKUP_DOWNLOAD_CACHE_DIR', '')
+DOWNLOAD_CACHE_MAX_BYTES = int(
+    os.environ.get('BACKUP_DOWNLOAD_CACHE_MAX_BYTES', str(10 * 2**30)))
+
+# Names of the dumps in the object store: 'flat' (YYYYMMDD_<basename>.dump)
+# or 'sharded' (YYYY/MM/YYYYMMDD_<basename>.dump), see migrate_object_layout.
+OBJECT_LAYOUT = os.environ.get('BACKUP_OBJECT_LAYOUT', 'flat')
+
+# Use a directory as (fake) object store, e.g. for benchmarks: see fakeswift.py
+# for the latency (seconds per request), bandwidth (bytes per second per
+# transfer, 0 is unlimited) it adds and the largest listing it allows.
+OBJECTSTORE_FAKE_DIR = os.environ.get('BACKUP_OBJECTSTORE_FAKE_DIR', '')
+OBJECTSTORE_FAKE_LATENCY = float(os.environ.get('BACKUP_OBJECTSTORE_FAKE_LATENCY', '0'))
+OBJECTSTORE_FAKE_BANDWIDTH = int(os.environ.get('BACKUP_OBJECTSTORE_FAKE_BANDWIDTH', '0'))
+OBJECTSTORE_FAKE_PAGE_LIMIT = int(os.environ.get('BACKUP_OBJECTSTORE_FAKE_PAGE_LIMIT', '10000'))
+
+# Skip the upload of a dump when the object store holds it already (same
+# hashes in the metadata of the object), set to TRUE to enable.
+SKIP_UPLOADED = os.environ.get('BACKUP_SKIP_UPLOADED', '') == 'TRUE'
@@ -0,0 +1,63 @@
+"""
+Watermark of the batch discovery in NPR.
+
+Listing the batches in NPR is the most expensive query we make (NPR has no
+index on VER_BATCH_NAAM). Daily batches are only ever added, by date, so the
+import records the newest batch before which everything in NPR is handled
+(imported, or found already backed up) and next runs only list the batches
+from there on. The watermark is kept in the local database per NPR table, it
+survives the dump (which drops the local table and checkpoints).
+"""
+from sqlalchemy import MetaData, select
+from sqlalchemy.dialects.postgresql import insert
+
+from . import settings
+from . import models
+
+
+def _get_table():
+    return models.get_watermark_table_def(MetaData(), settings.WATERMARK_TABLE)
+
+
+def is_enabled():
+    return settings.NPR_DISCOVERY == 'watermark'
+
+
+def get(dp_conn):
+    """Get the watermark of the NPR table, None if there is none."""
+    if not dp_conn.dialect.has_table(dp_conn, settings.WATERMARK_TABLE):
+        return None
+
+    table = _get_table()
+    row = dp_conn.execute(
+        select([table.c.VER_BATCH_NAAM])
+        .where(table.c.TABLE_NAME == settings.NPR_TABLE)
+    ).fetchone()
+
+    return None if row is None else row[0]
+
+
+def save(dp_conn, batch_name):
+    """Record batch_name as the watermark of the NPR table."""
+    table = _get_table()
+    table.create(dp_conn, checkfirst=True)
+    statement = insert(table).values(
+        TABLE_NAME=settings.NPR_TABLE, VER_BATCH_NAAM=batch_name)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.TABLE_NAME],
+        set_={'VER_BATCH_NAAM': statement.excluded.VER_BATCH_NAAM}
+    )
+    dp_conn.execute(statement)
+
+
+def next_watermark(npr_batch_names, pending):
+    """
+    Get the new watermark after a run: the oldest batch still pending (not
+    attempted, or failed), else the newest batch seen in NPR. Returns None
+    when NPR had no batches.
+    """
+    if pending:
+        return min(pending)
+    if npr_batch_names:
+        return max(npr_batch_names)
+    return None
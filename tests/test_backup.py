@@ -0,0 +1,45 @@
+import pytest
+from sqlalchemy import create_engine, MetaData
+
+from parkeerrechten import settings
+from parkeerrechten import models
+from parkeerrechten import backup
+
+TABLE = 'TEST_BATCH_NAMES'
+
+
+@pytest.fixture
+def dp_conn():
+    with create_engine(settings.DATAPUNT_DB_URL).connect() as conn:
+        conn.execute('DROP TABLE IF EXISTS "{}";'.format(TABLE))
+        md = MetaData()
+        table = models.get_backup_table_def(md, TABLE)
+        md.create_all(conn)
+        batch_names = ['20170803', '20170801', 'Leeg', None, '20170802', '20170801']
+        conn.execute(table.insert(), [
+            {'VERW_RECHT_ID': i, 'VER_BATCH_NAAM': batch_names[i % len(batch_names)]}
+            for i in range(600)
+        ])
+        yield conn
+        conn.execute('DROP TABLE IF EXISTS "{}";'.format(TABLE))
+
+
+@pytest.mark.parametrize('query', ['distinct', 'skipscan'])
+def test_get_batch_names_in_database(dp_conn, query, monkeypatch):
+    monkeypatch.setattr(settings, 'BATCH_NAMES_QUERY', query)
+    models.create_batch_name_index(dp_conn, TABLE)
+    models.create_batch_name_index(dp_conn, TABLE)  # exists already
+
+    assert backup.get_batch_names_in_database(dp_conn, TABLE, include_leeg=True) == [
+        '20170801', '20170802', '20170803', 'Leeg']
+    assert backup.get_batch_names_in_database(dp_conn, TABLE) == [
+        '20170801', '20170802', '20170803']
+
+    # Limited to a window.
+    assert backup.get_batch_names_in_database(
+        dp_conn, TABLE, include_leeg=True, start_date='20170802') == [
+            '20170802', '20170803', 'Leeg']
+    assert backup.get_batch_names_in_database(
+        dp_conn, TABLE, start_date='20170802', end_date='20170802') == ['20170802']
+    assert backup.get_batch_names_in_database(
+        dp_conn, TABLE, start_date='20170804', end_date='20170810') == []
@@ -71,3 +71,15 @@ def test_end_before_start():
             ],
             include_orphans_option=True
         )
+
+
+def test_workers():
+    args = commandline.parse_args([], include_orphans_option=False)
+    assert args.workers == 1
+
+    args = commandline.parse_args(['--workers', '4'], include_orphans_option=False)
+    assert args.workers == 4
+
+    with pytest.raises(commandline.ValidationError):
+        args = commandline.parse_args(
+            ['--workers', '0'], include_orphans_option=False)
@@ -0,0 +1,61 @@
+# noqa
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import create_engine, MetaData, select, asc
+from sqlalchemy.sql import text
+
+from parkeerrechten import settings
+from parkeerrechten import models
+from parkeerrechten import copyload
+
+
+@pytest.fixture(scope='module')
+def dp_conn():
+    with create_engine(settings.DATAPUNT_DB_URL).connect() as conn:
+        yield conn
+
+
+def test_format_value():
+    assert copyload.format_value(None) == '\\N'
+    assert copyload.format_value(Decimal('1E+1')) == '10'
+    assert copyload.format_value(Decimal('-1.30')) == '-1.30'
+    assert copyload.format_value(363) == '363'
+    assert copyload.format_value('Amstelveenseweg') == 'Amstelveenseweg'
+
+
+def test_format_value_escapes():
+    assert copyload.format_value('a\tb') == 'a\\tb'
+    assert copyload.format_value('a\nb\rc') == 'a\\nb\\rc'
+    assert copyload.format_value('C:\\N') == 'C:\\\\N'
+    assert copyload.format_value('Çalışkan €') == 'Çalışkan €'
+
+
+def test_copy_loader(dp_conn):
+    """
+    Round trip awkward values through COPY, compare with what went in.
+    """
+    dp_conn.execute(text(
+        '''DROP TABLE IF EXISTS "{}";'''.format(settings.LOCAL_TABLE)
+    ))
+    md = MetaData()
+    table = models.get_backup_table_def(md, settings.LOCAL_TABLE)
+    md.create_all(dp_conn)
+
+    empty = {column.name: None for column in table.columns}
+    rows = [
+        dict(empty, VERW_RECHT_ID=Decimal('1'), GEBIED_OMS='Çalışkan €\\N',
+             BEDRAG_V_RECHT=Decimal('-1.30'), GEB_BEH_V_RECHT=363),
+        dict(empty, VERW_RECHT_ID=Decimal('2'), GEBIED_OMS='tab\there\nnewline',
+             VER_BATCH_NAAM='Leeg'),
+        dict(empty, VERW_RECHT_ID=Decimal('3'), GEBIED_OMS=''),
+    ]
+
+    loader = copyload.CopyLoader(table)
+    assert loader.load(dp_conn, rows[:2]) == 2
+    # The buffer is re-used, nothing of the previous page may leak through.
+    assert loader.load(dp_conn, rows[2:]) == 1
+
+    stored = dp_conn.execute(
+        select([table]).order_by(asc(table.c.VERW_RECHT_ID))).fetchall()
+    assert [dict(row) for row in stored] == rows
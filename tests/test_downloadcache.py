@@ -0,0 +1,62 @@
+import os
+import time
+
+from parkeerrechten import downloadcache
+from parkeerrechten import metrics
+
+
+def _counter(name):
+    for entry in metrics.report()['counters']:
+        if entry['name'] == metrics.PREFIX + name:
+            return entry['value']
+    return 0
+
+
+def _add(cache, tmpdir, name, etag, size):
+    file_path = os.path.join(str(tmpdir), name)
+    with open(file_path, 'wb') as f:
+        f.write(b'x' * size)
+    cache.store(name, etag, file_path)
+
+
+def test_lookup_by_name_and_etag(tmpdir):
+    metrics.reset()
+    cache = downloadcache.DownloadCache(os.path.join(str(tmpdir), 'cache'), 10000)
+    _add(cache, tmpdir, '20170801_TEST.dump', 'etag-1', 1000)
+
+    assert cache.lookup('20170801_TEST.dump', 'etag-1') is not None
+    assert cache.lookup('20170801_TEST.dump', 'etag-2') is None  # replaced object
+    assert cache.lookup('20170802_TEST.dump', 'etag-1') is None
+
+    assert _counter('download_cache_hits_total') == 1
+    assert _counter('download_cache_misses_total') == 2
+    assert _counter('download_cache_bytes_saved_total') == 1000
+
+
+def test_lru_eviction(tmpdir):
+    cache = downloadcache.DownloadCache(os.path.join(str(tmpdir), 'cache'), 2500)
+    for day in ['01', '02']:
+        _add(cache, tmpdir, '201708{}_TEST.dump'.format(day), 'etag', 1000)
+        time.sleep(0.01)
+
+    # Use the oldest, then add a third file: the least recently used goes.
+    cache.lookup('20170801_TEST.dump', 'etag')
+    time.sleep(0.01)
+    _add(cache, tmpdir, '20170803_TEST.dump', 'etag', 1000)
+
+    assert cache.lookup('20170801_TEST.dump', 'etag') is not None
+    assert cache.lookup('20170802_TEST.dump', 'etag') is None
+    assert cache.lookup('20170803_TEST.dump', 'etag') is not None
+
+
+def test_failed_write_not_cached(tmpdir):
+    cache = downloadcache.DownloadCache(os.path.join(str(tmpdir), 'cache'), 2500)
+    try:
+        with cache.writer('20170801_TEST.dump', 'etag') as f:
+            f.write(b'partial')
+            raise OSError('Connection reset by peer')
+    except OSError:
+        pass
+
+    assert cache.lookup('20170801_TEST.dump', 'etag') is None
+    assert os.listdir(cache.directory) == []
@@ -0,0 +1,265 @@
+import functools
+import json
+import os
+import subprocess
+from unittest.mock import patch
+
+import pytest
+from sqlalchemy import create_engine, MetaData
+
+from parkeerrechten import settings
+from parkeerrechten import models
+from parkeerrechten import dump_database
+from parkeerrechten import partitions
+from parkeerrechten import backup
+from parkeerrechten import checkpoint
+
+
+def _fake_pg_dump(n_bytes, return_code):
+    return ['sh', '-c', 'head -c {} /dev/urandom; exit {}'.format(n_bytes, return_code)]
+
+
+@pytest.mark.parametrize('n_bytes', [1000, 250000])
+def test_stream_dump_aborted_on_pg_dump_failure(n_bytes, monkeypatch):
+    monkeypatch.setattr(settings, 'OBJECTSTORE_SEGMENT_SIZE', 40000)
+    with patch('parkeerrechten.dump_database._pg_dump_command',
+               return_value=_fake_pg_dump(n_bytes, 1)), \
+            patch('parkeerrechten.objectstore._put_manifest') as put_manifest, \
+            patch('parkeerrechten.objectstore._upload_segment', return_value='x'), \
+            patch('parkeerrechten.objectstore._delete_segments'), \
+            patch('parkeerrechten.objectstore._segments_container'), \
+            patch('parkeerrechten.objectstore.connection') as connection:
+        with pytest.raises(subprocess.CalledProcessError):
+            dump_database._pg_dump_to_objectstore('20170801_TEST.dump')
+
+    # The dump never became visible in the object store.
+    assert not put_manifest.called
+    assert not connection.return_value.__enter__.return_value.put_object.called
+
+
+def test_stream_dump():
+    uploaded = {}
+
+    def upload_stream(container, file_name, stream, check=None):
+        uploaded[file_name] = stream.read()
+        check()
+        return len(uploaded[file_name]), 'md5'
+
+    with patch('parkeerrechten.dump_database._pg_dump_command',
+               return_value=_fake_pg_dump(250000, 0)), \
+            patch('parkeerrechten.objectstore.upload_stream', side_effect=upload_stream):
+        dump_database._pg_dump_to_objectstore('20170801_TEST.dump')
+
+    # All of the pg_dump output was uploaded.
+    assert len(uploaded['20170801_TEST.dump']) == 250000
+
+
+def test_export_to_objectstore():
+    """
+    An exported batch restores to the rows of the batch (only).
+    """
+    engine = create_engine(settings.DATAPUNT_DB_URL)
+    engine.execute('DROP TABLE IF EXISTS "{}";'.format(settings.LOCAL_TABLE))
+    md = MetaData()
+    table = models.get_backup_table_def(md, settings.LOCAL_TABLE)
+    md.create_all(engine)
+    engine.execute(table.insert(), [
+        {'VERW_RECHT_ID': i, 'VER_BATCH_NAAM': batch_name, 'VERK_PUNT_OMS': 'tab\there'}
+        for i, batch_name in enumerate(['20170801', '20170802', '20170801'])
+    ])
+
+    uploaded = {}
+
+    def upload_stream(container, file_name, stream, check=None):
+        uploaded[file_name] = stream.read()
+        check()
+        return len(uploaded[file_name]), 'md5'
+
+    try:
+        with engine.connect() as dp_conn:
+            template = dump_database._export_template(dp_conn)
+        with patch('parkeerrechten.objectstore.upload_stream', side_effect=upload_stream):
+            dump_database._export_to_objectstore('20170801_TEST.dump', '20170801', template)
+        # Nothing is left staged.
+        assert not engine.has_table(settings.TARGET_TABLE)
+        assert not engine.execute(
+            "SELECT 1 FROM pg_namespace WHERE nspname LIKE 'dump_%%';").fetchall()
+    finally:
+        engine.execute('DROP TABLE "{}";'.format(settings.LOCAL_TABLE))
+
+    # pg_restore without a database writes the SQL to restore.
+    sql = subprocess.run(
+        ['pg_restore', '--format=c', '--file=-'],
+        input=uploaded['20170801_TEST.dump'], stdout=subprocess.PIPE, check=True
+    ).stdout.decode('utf-8')
+    assert 'COPY public."{}"'.format(settings.TARGET_TABLE) in sql
+    rows = sql.split(' FROM stdin;\n')[1].split('\\.\n')[0].splitlines()
+    assert [row.split('\t')[0] for row in rows] == ['0', '2']
+    assert all('tab\\there' in row for row in rows)
+
+
+def test_staged_batch_is_dumped_as_public_table(tmpdir):
+    """
+    A batch staged in a schema of its own restores into public, like any
+    other dump.
+    """
+    engine = create_engine(settings.DATAPUNT_DB_URL)
+    engine.execute('DROP TABLE IF EXISTS "{}";'.format(settings.LOCAL_TABLE))
+    md = MetaData()
+    table = models.get_backup_table_def(md, settings.LOCAL_TABLE)
+    md.create_all(engine)
+    engine.execute(table.insert(), [
+        {'VERW_RECHT_ID': i, 'VER_BATCH_NAAM': batch_name}
+        for i, batch_name in enumerate(['20170801', '20170802', '20170801'])
+    ])
+
+    dump_file = str(tmpdir.join('20170801_TEST.dump'))
+    try:
+        assert dump_database._dump_in_schema(
+            '20170801', functools.partial(dump_database._pg_dump, dump_file)) == 2
+        assert dump_database._count_rows('20170801') == 2
+    finally:
+        engine.execute('DROP TABLE "{}";'.format(settings.LOCAL_TABLE))
+
+    sql = subprocess.run(
+        ['pg_restore', '--format=c', '--file=-', dump_file],
+        stdout=subprocess.PIPE, check=True
+    ).stdout.decode('utf-8')
+    assert 'CREATE TABLE public."{}"'.format(settings.TARGET_TABLE) in sql
+    assert 'COPY public."{}"'.format(settings.TARGET_TABLE) in sql
+    assert 'dump_20170801' not in sql
+    rows = sql.split(' FROM stdin;\n')[1].split('\\.\n')[0].splitlines()
+    assert [row.split('\t')[0] for row in rows] == ['0', '2']
+
+
+def test_failed_batches_keep_their_partition():
+    """
+    Of a partitioned table only the partitions (and checkpoints) of the
+    batches that failed are kept.
+    """
+    engine = create_engine(settings.DATAPUNT_DB_URL)
+    engine.execute('DROP TABLE IF EXISTS "{}";'.format(settings.LOCAL_TABLE))
+    checkpoint.drop_table(engine)
+    md = MetaData()
+    models.get_backup_table_def(md, settings.LOCAL_TABLE, partitioned=True)
+    md.create_all(engine)
+    checkpoint.create_table(engine)
+    batch_names = ['20170801', '20170802', '20170803']
+    for batch_name in batch_names:
+        partitions.create_partition(engine, settings.LOCAL_TABLE, batch_name)
+        checkpoint.save(engine, batch_name, 1, complete=True)
+
+    failed = [dump_database._dump_file_path('20170802')]
+    try:
+        with engine.connect() as dp_conn, \
+                patch('parkeerrechten.dump_database._dump_via_files', return_value=failed):
+            assert dump_database._back_up_batches(dp_conn, batch_names, True) == failed
+            assert partitions.get_batch_names(dp_conn, settings.LOCAL_TABLE) == ['20170802']
+            checkpoints = engine.execute(
+                'SELECT "VER_BATCH_NAAM" FROM "{}";'.format(settings.CHECKPOINT_TABLE))
+            assert [row[0] for row in checkpoints] == ['20170802']
+    finally:
+        engine.execute('DROP TABLE "{}";'.format(settings.LOCAL_TABLE))
+        checkpoint.drop_table(engine)
+
+
+@pytest.mark.parametrize('partitioned', [False, True])
+def test_incomplete_batches_are_kept(partitioned):
+    """
+    Backing up must not throw away the rows and checkpoint of an import
+    that has yet to resume.
+    """
+    engine = create_engine(settings.DATAPUNT_DB_URL)
+    engine.execute('DROP TABLE IF EXISTS "{}";'.format(settings.LOCAL_TABLE))
+    checkpoint.drop_table(engine)
+    md = MetaData()
+    table = models.get_backup_table_def(md, settings.LOCAL_TABLE, partitioned=partitioned)
+    md.create_all(engine)
+    checkpoint.create_table(engine)
+    for i, batch_name in enumerate(['20170801', '20170802']):
+        if partitioned:
+            partitions.create_partition(engine, settings.LOCAL_TABLE, batch_name)
+        engine.execute(table.insert(), {'VERW_RECHT_ID': i, 'VER_BATCH_NAAM': batch_name})
+    checkpoint.save(engine, '20170801', 0, complete=True)
+    checkpoint.save(engine, '20170802', 1)
+
+    try:
+        with engine.connect() as dp_conn, \
+                patch('parkeerrechten.dump_database._dump_via_files', return_value=[]):
+            assert dump_database._back_up_batches(dp_conn, ['20170801'], True) == []
+            assert backup.get_batch_names_in_database(
+                dp_conn, settings.LOCAL_TABLE) == ['20170802']
+            assert checkpoint.get_resume_key(dp_conn, '20170802') == 1
+            assert checkpoint.get_incomplete_batch_names(dp_conn) == ['20170802']
+    finally:
+        engine.execute('DROP TABLE "{}";'.format(settings.LOCAL_TABLE))
+        checkpoint.drop_table(engine)
+
+
+def test_failed_pg_dump_leaves_no_file(tmpdir):
+    dump_file = str(tmpdir.join('20170801_TEST.dump'))
+    with patch('parkeerrechten.dump_database._pg_dump_command',
+               return_value=_fake_pg_dump(1000, 1)):
+        with pytest.raises(subprocess.CalledProcessError):
+            dump_database._pg_dump(dump_file)
+    assert tmpdir.listdir() == []
+
+    with patch('parkeerrechten.dump_database._pg_dump_command',
+               return_value=_fake_pg_dump(1000, 0)):
+        dump_database._pg_dump(dump_file)
+    assert [p.basename for p in tmpdir.listdir()] == ['20170801_TEST.dump']
+
+
+def test_dump_of_previous_run_is_uploaded(tmpdir):
+    """
+    A dump left by a previous run is uploaded as is, so an upload that did
+    reach the object store is recognised (and skipped).
+    """
+    dump_file = str(tmpdir.join('20170801_TEST.dump'))
+    with open(dump_file, 'wb') as f:
+        f.write(b'dump')
+    dump_database._record_dump(dump_file, '20170801', 3)
+
+    with patch('parkeerrechten.dump_database._dump_file_path', return_value=dump_file), \
+            patch('parkeerrechten.dump_database._count_rows', return_value=3), \
+            patch('parkeerrechten.dump_database._dump_in_schema') as dump_in_schema, \
+            patch('parkeerrechten.objectstore.upload_file',
+                  return_value=(True, 'skipped')) as upload_file:
+        assert dump_database._back_up_batch('20170801', True) is None
+
+    assert not dump_in_schema.called
+    assert upload_file.call_args[0][1] == dump_file
+    assert tmpdir.listdir() == []
+
+
+@pytest.mark.parametrize('record', [None, ('20170801', 2), ('20170802', 3)])
+def test_other_dump_of_previous_run_is_replaced(tmpdir, record):
+    """
+    A dump left on disk without a record, or made of other rows, is dumped
+    again.
+    """
+    dump_file = str(tmpdir.join('20170801_TEST.dump'))
+    with open(dump_file, 'wb') as f:
+        f.write(b'dump')
+    if record is not None:
+        dump_database._record_dump(dump_file, *record)
+
+    def dump_in_schema(batch_name, pg_dump):
+        assert not os.path.exists(dump_file)
+        with open(dump_file, 'wb') as f:
+            f.write(b'new dump')
+        return 3
+
+    with patch('parkeerrechten.dump_database._dump_file_path', return_value=dump_file), \
+            patch('parkeerrechten.dump_database._count_rows', return_value=3), \
+            patch('parkeerrechten.dump_database._dump_in_schema',
+                  side_effect=dump_in_schema) as dump_in_schema_mock, \
+            patch('parkeerrechten.objectstore.upload_file', return_value=(False, 'error')):
+        assert dump_database._back_up_batch('20170801', True) == dump_file
+
+    assert dump_in_schema_mock.called
+    # The new dump is kept (its upload failed), with its record.
+    with open(dump_file, 'rb') as f:
+        assert f.read() == b'new dump'
+    with open(dump_file + '.json') as f:
+        assert json.load(f) == {'batch_name': '20170801', 'staging': 'table', 'rows': 3}
@@ -0,0 +1,198 @@
+"""
+The object store functions against the directory backed stand-in.
+"""
+import os
+import time
+from unittest.mock import patch
+
+import pytest
+from swiftclient.exceptions import ClientException
+
+from parkeerrechten import fakeswift
+from parkeerrechten import inventory
+from parkeerrechten import objectstore
+from parkeerrechten import settings
+
+CONTAINER = 'parkeerrechten_pgdumps'
+
+
+@pytest.fixture
+def fake_store(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        settings, 'OBJECTSTORE_FAKE_DIR', os.path.join(str(tmpdir), 'store'))
+    objectstore.get_pool.cache_clear()
+    objectstore._new_conn().put_container(CONTAINER)
+    yield settings.OBJECTSTORE_FAKE_DIR
+    objectstore.get_pool.cache_clear()
+
+
+def _write(tmpdir, name, size):
+    file_path = os.path.join(str(tmpdir), name)
+    with open(file_path, 'wb') as f:
+        f.write(os.urandom(size))
+    return file_path
+
+
+def test_upload_and_download(fake_store, tmpdir, monkeypatch):
+    monkeypatch.setattr(settings, 'OBJECTSTORE_SEGMENT_THRESHOLD', 100000)
+    monkeypatch.setattr(settings, 'OBJECTSTORE_SEGMENT_SIZE', 40000)
+
+    # A plain and a segmented upload.
+    for name, size in [('20170801_TEST.dump', 1000), ('20170802_TEST.dump', 250000)]:
+        file_path = _write(tmpdir, name, size)
+        ok, _ = objectstore.upload_file(CONTAINER, file_path, '2017/08/' + name)
+        assert ok
+
+        download_dir = os.path.join(str(tmpdir), 'downloads')
+        path = objectstore.copy_file_from_objectstore(
+            CONTAINER, '2017/08/' + name, download_dir)
+        with open(path, 'rb') as downloaded, open(file_path, 'rb') as original:
+            assert downloaded.read() == original.read()
+
+    names = [o['name'] for o in objectstore._get_full_container_list(CONTAINER)]
+    assert names == ['2017/08/20170801_TEST.dump', '2017/08/20170802_TEST.dump']
+    sizes = [o['bytes'] for o in objectstore._get_full_container_list(CONTAINER)]
+    assert sizes == [1000, 250000]
+
+    # Moving a large object keeps its segments.
+    objectstore.move_object(CONTAINER, '2017/08/20170802_TEST.dump', '20170802_TEST.dump')
+    content = b''.join(objectstore.iter_object(CONTAINER, '20170802_TEST.dump'))
+    assert len(content) == 250000
+
+
+def test_listing_pages(fake_store, tmpdir, monkeypatch):
+    monkeypatch.setattr(settings, 'OBJECTSTORE_LISTING_LIMIT', 7)
+    for day in range(1, 22):
+        objectstore.upload_file(
+            CONTAINER, _write(tmpdir, 'x', 10), '201708{:02d}_TEST.dump'.format(day))
+
+    # Full pages are followed by the next, a last (partial or empty) page
+    # ends the listing.
+    with patch('parkeerrechten.fakeswift.FakeSwiftConnection.get_container',
+               autospec=True, side_effect=fakeswift.FakeSwiftConnection.get_container) as get:
+        assert len(objectstore._get_full_container_list(CONTAINER)) == 21
+        assert get.call_count == 4
+        assert len(objectstore._get_full_container_list(CONTAINER, prefix='2017081')) == 10
+        assert get.call_count == 4 + 2
+
+    # Like Swift, the stand-in refuses a limit above its maximum.
+    monkeypatch.setattr(settings, 'OBJECTSTORE_FAKE_PAGE_LIMIT', 5)
+    objectstore.get_pool.cache_clear()
+    with pytest.raises(ClientException) as e:
+        objectstore._get_full_container_list(CONTAINER)
+    assert e.value.http_status == 412
+
+
+@pytest.mark.parametrize('size', [1000, 250000])
+def test_identical_upload_skipped(fake_store, tmpdir, size, monkeypatch):
+    monkeypatch.setattr(settings, 'OBJECTSTORE_SEGMENT_THRESHOLD', 100000)
+    monkeypatch.setattr(settings, 'OBJECTSTORE_SEGMENT_SIZE', 40000)
+    monkeypatch.setattr(settings, 'SKIP_UPLOADED', True)
+    file_path = _write(tmpdir, '20170801_TEST.dump', size)
+
+    ok, msg = objectstore.upload_file(CONTAINER, file_path)
+    assert ok and 'uploaded succesfully' in msg
+
+    # The metadata of the object records the hashes.
+    headers = objectstore._new_conn().head_object(CONTAINER, '20170801_TEST.dump')
+    hashes = objectstore._file_hashes(file_path)
+    assert headers[objectstore.SHA256_HEADER.lower()] == hashes['sha256']
+
+    ok, msg = objectstore.upload_file(CONTAINER, file_path)
+    assert ok and 'skipped' in msg
+
+    # A changed dump is uploaded again.
+    _write(tmpdir, '20170801_TEST.dump', size)
+    ok, msg = objectstore.upload_file(CONTAINER, file_path)
+    assert ok and 'uploaded succesfully' in msg
+    content = b''.join(objectstore.iter_object(CONTAINER, '20170801_TEST.dump'))
+    with open(file_path, 'rb') as f:
+        assert content == f.read()
+
+
+def test_corrupted_upload_rejected(tmpdir):
+    conn = fakeswift.FakeSwiftConnection(str(tmpdir))
+    conn.put_container(CONTAINER)
+    with pytest.raises(fakeswift.ClientException) as excinfo:
+        conn.put_object(CONTAINER, 'x', contents=b'x', etag='0' * 32)
+    assert excinfo.value.http_status == 422
+    assert conn.get_container(CONTAINER)[1] == []
+
+    # A rejected upload leaves the object it would replace alone.
+    conn.put_object(CONTAINER, 'x', contents=b'old')
+    with pytest.raises(fakeswift.ClientException):
+        conn.put_object(CONTAINER, 'x', contents=b'new', etag='0' * 32)
+    assert conn.get_object(CONTAINER, 'x')[1] == b'old'
+    assert [o['name'] for o in conn.get_container(CONTAINER)[1]] == ['x']
+
+
+def test_latency_and_bandwidth(tmpdir):
+    conn = fakeswift.FakeSwiftConnection(str(tmpdir), latency=0.05, bandwidth=10**6)
+    conn.put_container(CONTAINER)
+
+    t0 = time.time()
+    conn.put_object(CONTAINER, 'x', contents=b'x' * 100000)
+    conn.head_object(CONTAINER, 'x')
+    # Two requests, 100 kB at 1 MB/s.
+    assert time.time() - t0 >= 0.2
+    assert conn.n_requests == 3
+
+
+def test_replaced_segments_removed(fake_store, tmpdir, monkeypatch):
+    """
+    Overwriting a large object leaves no segments of the old one behind.
+    """
+    monkeypatch.setattr(settings, 'OBJECTSTORE_SEGMENT_THRESHOLD', 100000)
+    monkeypatch.setattr(settings, 'OBJECTSTORE_SEGMENT_SIZE', 40000)
+    conn = objectstore._new_conn()
+
+    def segment_names():
+        _, listing = conn.get_container(CONTAINER + '_segments')
+        return [o['name'] for o in listing]
+
+    objectstore.upload_file(CONTAINER, _write(tmpdir, '20170801_TEST.dump', 250000))
+    first = segment_names()
+    assert len(first) == 7
+
+    # Replaced by a large object, by a streamed one, then by a plain object.
+    objectstore.upload_file(CONTAINER, _write(tmpdir, '20170801_TEST.dump', 150000))
+    assert len(segment_names()) == 4 and not set(first) & set(segment_names())
+
+    objectstore.upload_stream(CONTAINER, '20170801_TEST.dump', open(
+        _write(tmpdir, '20170801_TEST.dump', 90000), 'rb'))
+    assert len(segment_names()) == 3
+
+    objectstore.upload_file(CONTAINER, _write(tmpdir, '20170801_TEST.dump', 1000))
+    assert segment_names() == []
+
+
+def test_uploads_and_moves_in_inventory(fake_store, tmpdir, monkeypatch):
+    """
+    Uploads and moves reach the inventory, also when their names sort
+    before its listing marker.
+    """
+    monkeypatch.setattr(
+        settings, 'INVENTORY_FILE', os.path.join(str(tmpdir), 'inventory.json'))
+    conn = objectstore._new_conn()
+    for day in ['01', '02', '04']:
+        conn.put_object(CONTAINER, '201708{}_TEST.dump'.format(day), contents=b'x')
+
+    def names(listing=None):
+        if listing is None:
+            listing = inventory.get_container_list(
+                CONTAINER, objectstore._get_full_container_list, objectstore.connection)
+        return [o['name'] for o in listing]
+
+    assert names() == ['20170801_TEST.dump', '20170802_TEST.dump', '20170804_TEST.dump']
+
+    objectstore.upload_file(
+        CONTAINER, _write(tmpdir, '20170803_TEST.dump', 1000))
+    objectstore.upload_stream(CONTAINER, '20170805_TEST.dump', open(
+        _write(tmpdir, '20170805_TEST.dump', 1000), 'rb'))
+    objectstore.move_object(CONTAINER, '20170801_TEST.dump', '20170801_OTHER.dump')
+
+    assert names() == [
+        '20170801_OTHER.dump', '20170802_TEST.dump', '20170803_TEST.dump',
+        '20170804_TEST.dump', '20170805_TEST.dump']
+    assert names() == names(inventory.resync(
+        CONTAINER, objectstore._get_full_container_list, objectstore.connection))
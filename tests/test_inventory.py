@@ -0,0 +1,131 @@
+import json
+import os
+import threading
+
+import pytest
+
+from parkeerrechten import inventory
+from parkeerrechten import settings
+
+CONTAINER = 'parkeerrechten_pgdumps'
+
+
+def _object(batch_name):
+    return {
+        'name': '{}_{}.dump'.format(batch_name, settings.BACKUP_FILE_BASENAME),
+        'bytes': 1000,
+        'hash': 'abc',
+        'last_modified': '2017-08-02T02:00:00.000000',
+    }
+
+
+def _headers(object_):
+    return {
+        'content-length': str(object_['bytes']),
+        'etag': '"{}"'.format(object_['hash']),
+        'last-modified': 'Wed, 02 Aug 2017 02:00:00 GMT',
+    }
+
+
+class FakeContainer:
+    """Sorted container listing that honours the marker."""
+    def __init__(self, objects):
+        self.objects = objects
+        self.calls = []
+
+    def list(self, container, marker=None, **kwargs):
+        self.calls.append(marker)
+        listing = sorted(self.objects, key=lambda o: o['name'])
+        return [o for o in listing if marker is None or o['name'] > marker]
+
+
+@pytest.fixture
+def inventory_file(tmpdir, monkeypatch):
+    monkeypatch.setattr(
+        settings, 'INVENTORY_FILE', os.path.join(str(tmpdir), 'inventory.json'))
+    return settings.INVENTORY_FILE
+
+
+def test_disabled():
+    fake = FakeContainer([_object('20170801')])
+    assert inventory.get_container_list(CONTAINER, fake.list, None) == fake.objects
+    assert fake.calls == [None]
+
+
+def test_incremental_refresh(inventory_file):
+    fake = FakeContainer([_object('20170801'), _object('20170802'), _object('Leeg')])
+
+    # No manifest yet: full listing.
+    listing = inventory.get_container_list(CONTAINER, fake.list, None)
+    assert len(listing) == 3
+
+    # A new dump appears, only objects after the last dated dump are listed.
+    fake.objects.append(_object('20170803'))
+    listing = inventory.get_container_list(CONTAINER, fake.list, None)
+
+    assert [o['name'] for o in listing] == sorted(o['name'] for o in fake.objects)
+    assert fake.calls == [None, _object('20170802')['name']]
+
+    with open(inventory_file) as f:
+        manifest = json.load(f)
+    assert manifest['marker'] == _object('20170803')['name']
+
+
+def test_resync(inventory_file):
+    fake = FakeContainer([_object('20170801'), _object('20170802')])
+
+    inventory.get_container_list(CONTAINER, fake.list, None)
+
+    # Deletions go unnoticed by the incremental refresh ...
+    del fake.objects[0]
+    assert len(inventory.get_container_list(CONTAINER, fake.list, None)) == 2
+
+    # ... until the inventory is rebuilt.
+    assert inventory.resync(CONTAINER, fake.list, None) == fake.objects
+    assert len(inventory.get_container_list(CONTAINER, fake.list, None)) == 1
+
+
+def test_add_is_journaled(inventory_file):
+    """
+    Additions leave the manifest alone, the next refresh merges them (also
+    when their names sort before the marker).
+    """
+    fake = FakeContainer([_object('20170801'), _object('20170803')])
+    inventory.get_container_list(CONTAINER, fake.list, None)
+    with open(inventory_file) as f:
+        manifest = f.read()
+
+    fake.objects.append(_object('20170802'))
+    inventory.add(CONTAINER, _object('20170802')['name'], _headers(_object('20170802')))
+    moved = dict(_object('20170801'), name='20170801_OTHER.dump')
+    inventory.add(
+        CONTAINER, moved['name'], _headers(moved), removed=_object('20170801')['name'])
+    with open(inventory_file) as f:
+        assert f.read() == manifest
+
+    listing = inventory.get_container_list(CONTAINER, fake.list, None)
+    assert [o['name'] for o in listing] == [
+        '20170801_OTHER.dump', _object('20170802')['name'], _object('20170803')['name']]
+    assert listing[1] == _object('20170802')
+    with open(inventory_file + '.journal') as f:
+        assert f.read() == ''
+
+
+def test_concurrent_adds_are_kept(inventory_file):
+    fake = FakeContainer([_object('20170831')])
+    inventory.get_container_list(CONTAINER, fake.list, None)
+    batch_names = ['201708{:02d}'.format(day) for day in range(1, 31)]
+
+    def add(batch_name):
+        inventory.add(CONTAINER, _object(batch_name)['name'], _headers(_object(batch_name)))
+        inventory.refresh(CONTAINER, fake.list, None)
+
+    threads = [threading.Thread(target=add, args=(b,)) for b in batch_names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    listing = inventory.get_container_list(CONTAINER, fake.list, None)
+    assert [o['name'] for o in listing] == [
+        _object(batch_name)['name'] for batch_name in batch_names + ['20170831']]
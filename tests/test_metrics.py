@@ -0,0 +1,66 @@
+# noqa
+import json
+import os
+
+import pytest
+
+from parkeerrechten import metrics
+from parkeerrechten import settings
+
+
+@pytest.fixture
+def metrics_dir(tmpdir):
+    metrics.reset()
+    settings.METRICS_DIR = str(tmpdir)
+    yield str(tmpdir)
+    settings.METRICS_DIR = ''
+    metrics.reset()
+
+
+def test_render_prometheus(metrics_dir):
+    metrics.inc('records_fetched_total', 10, batch='20170801')
+    metrics.inc('records_fetched_total', 5, batch='20170801')
+    metrics.observe('npr_query_seconds', 0.3)
+    metrics.observe('npr_query_seconds', 20)
+
+    lines = metrics.render_prometheus().splitlines()
+    assert '# TYPE parkeerrechten_records_fetched_total counter' in lines
+    assert 'parkeerrechten_records_fetched_total{batch="20170801"} 15' in lines
+    assert '# TYPE parkeerrechten_npr_query_seconds histogram' in lines
+    assert 'parkeerrechten_npr_query_seconds_bucket{le="0.25"} 0' in lines
+    assert 'parkeerrechten_npr_query_seconds_bucket{le="0.5"} 1' in lines
+    assert 'parkeerrechten_npr_query_seconds_bucket{le="30"} 2' in lines
+    assert 'parkeerrechten_npr_query_seconds_bucket{le="+Inf"} 2' in lines
+    assert 'parkeerrechten_npr_query_seconds_count 2' in lines
+
+
+def test_run_reports(metrics_dir):
+    with metrics.run('run_import'):
+        with metrics.timer('pg_dump_seconds'):
+            pass
+
+    with open(os.path.join(metrics_dir, 'run_import.prom')) as f:
+        assert 'parkeerrechten_run_success{job="run_import"} 1' in f.read()
+
+    with open(os.path.join(metrics_dir, 'run_import.json')) as f:
+        report = json.load(f)
+    assert report['job'] == 'run_import'
+    assert report['histograms'][0]['name'] == 'parkeerrechten_pg_dump_seconds'
+    assert report['histograms'][0]['count'] == 1
+
+
+def test_failed_run(metrics_dir):
+    with pytest.raises(SystemExit):
+        with metrics.run('dump_database'):
+            raise SystemExit(1)
+
+    with open(os.path.join(metrics_dir, 'dump_database.prom')) as f:
+        assert 'parkeerrechten_run_success{job="dump_database"} 0' in f.read()
+
+    # Exiting early with exit code 0 is a success.
+    with pytest.raises(SystemExit):
+        with metrics.run('dump_database'):
+            raise SystemExit(0)
+
+    with open(os.path.join(metrics_dir, 'dump_database.prom')) as f:
+        assert 'parkeerrechten_run_success{job="dump_database"} 1' in f.read()
@@ -0,0 +1,56 @@
+from unittest.mock import patch
+
+from parkeerrechten import backup
+from parkeerrechten import migrate_layout
+from parkeerrechten import settings
+
+BASENAME = settings.BACKUP_FILE_BASENAME
+
+
+def _dump(name):
+    return name + '_' + BASENAME + '.dump'
+
+
+def test_plan_moves():
+    names = [
+        _dump('20170801'), '2017/08/' + _dump('20170802'), _dump('Leeg'), 'other.txt']
+
+    assert migrate_layout.plan_moves(names, 'sharded') == [
+        (_dump('20170801'), '2017/08/' + _dump('20170801'))]
+    assert migrate_layout.plan_moves(names, 'flat') == [
+        ('2017/08/' + _dump('20170802'), _dump('20170802'))]
+
+
+def test_migrate():
+    listing = [{'name': _dump('20170801')}, {'name': _dump('20170901')}]
+    with patch('parkeerrechten.objectstore._get_full_container_list',
+               return_value=listing), \
+            patch('parkeerrechten.objectstore.move_object') as move_object:
+        assert migrate_layout.migrate('container', 'sharded') == 0
+
+    assert sorted(call[0] for call in move_object.call_args_list) == [
+        ('container', _dump('20170801'), '2017/08/' + _dump('20170801')),
+        ('container', _dump('20170901'), '2017/09/' + _dump('20170901')),
+    ]
+
+
+def test_prefix_pruned_listing():
+    def list_prefix(container, prefix):
+        return [
+            {'name': prefix + _dump(prefix.replace('/', '') + day)}
+            for day in ['01', '15']
+        ]
+
+    settings.OBJECT_LAYOUT = 'sharded'
+    try:
+        with patch('parkeerrechten.objectstore._get_full_container_list',
+                   side_effect=list_prefix) as listing:
+            batch_names = backup.get_batch_names_in_objectstore(
+                include_leeg=True, start_date='20170710', end_date='20170901')
+    finally:
+        settings.OBJECT_LAYOUT = 'flat'
+
+    # Only the months in the range were listed.
+    assert sorted(call[1]['prefix'] for call in listing.call_args_list) == [
+        '2017/07/', '2017/08/', '2017/09/']
+    assert sorted(batch_names) == ['20170715', '20170801', '20170815', '20170901']
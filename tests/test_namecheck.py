@@ -48,3 +48,26 @@ def test_extract_batch_name():
 
 def test_file_name_for_batch():
     assert namecheck.file_name_for_batch_name(TEST_BATCH_NAME) == TEST_BATCH_FILE
+
+
+def test_sharded_layout():
+    sharded_file = '2017/06/' + TEST_BATCH_FILE
+    assert namecheck.file_name_for_batch_name(
+        TEST_BATCH_NAME, layout='sharded') == sharded_file
+    assert namecheck.file_name_for_batch_name(
+        'Leeg', layout='sharded') == 'Leeg_' + settings.BACKUP_FILE_BASENAME + '.dump'
+
+    assert namecheck.is_batch_file(sharded_file, False)
+    assert namecheck.is_sharded(sharded_file)
+    assert namecheck.extract_batch_name(sharded_file) == TEST_BATCH_NAME
+
+    # Files in the wrong directory are not batch files.
+    assert not namecheck.is_batch_file('2017/07/' + TEST_BATCH_FILE, False)
+    assert not namecheck.is_batch_file('2017/06/Leeg_TEST.dump', True)
+
+
+def test_month_prefixes():
+    assert namecheck.month_prefixes('20161115', '20170210') == [
+        '2016/11/', '2016/12/', '2017/01/', '2017/02/']
+    assert namecheck.month_prefixes('20170201', '20170228') == ['2017/02/']
+    assert namecheck.month_prefixes(None, '20170228') is None
@@ -0,0 +1,398 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import tracemalloc
+from unittest.mock import MagicMock, patch
+
+import pytest
+from swiftclient.exceptions import ClientException
+
+from parkeerrechten import objectstore
+from parkeerrechten import downloadcache
+from parkeerrechten import settings
+
+CONTAINER = 'parkeerrechten_pgdumps'
+BLOCK = bytes(range(256)) * 256  # 64 KiB
+
+
+def _fake_pool(conn, size=4):
+    """Patch the connection pool to hand out (shared) fake connection `conn`."""
+    pool = objectstore.ConnectionPool(size, factory=lambda **kwargs: conn)
+    return patch('parkeerrechten.objectstore.get_pool', return_value=pool)
+
+
+class FakeConnection:
+    """
+    Serves objects of `size` bytes, generated while they are downloaded.
+    """
+    def __init__(self, size, etag=None):
+        self.size = size
+        self.etag = etag
+
+    def _body(self):
+        for offset in range(0, self.size, len(BLOCK)):
+            yield BLOCK[:self.size - offset]
+
+    def get_object(self, container, name, resp_chunk_size=None):
+        if self.etag is None:
+            md5 = hashlib.md5()
+            for block in self._body():
+                md5.update(block)
+            self.etag = md5.hexdigest()
+
+        headers = {'etag': self.etag, 'content-length': str(self.size)}
+
+        def chunks():
+            # Re-chunk the body like swiftclient does.
+            buffer = b''
+            for block in self._body():
+                buffer += block
+                while len(buffer) >= resp_chunk_size:
+                    yield buffer[:resp_chunk_size]
+                    buffer = buffer[resp_chunk_size:]
+            if buffer:
+                yield buffer
+
+        return headers, chunks()
+
+    def head_object(self, container, name):
+        return {'etag': self.etag}
+
+    def get_auth(self):
+        return 'https://objectstore.example/v1/AUTH_x', 'token'
+
+    def close(self):
+        pass
+
+
+def _peak_memory_of_download(size, download_dir):
+    fake = FakeConnection(size)
+    fake.get_object(CONTAINER, 'x', 1)  # compute ETag
+    with _fake_pool(fake):
+        tracemalloc.start()
+        try:
+            path = objectstore.copy_file_from_objectstore(
+                CONTAINER, '20170801_TEST.dump', download_dir)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    assert os.path.getsize(path) == size
+    return peak
+
+
+def test_download_memory_independent_of_size(tmpdir, monkeypatch):
+    monkeypatch.setattr(settings, 'OBJECTSTORE_CHUNK_SIZE', 2**16)
+    small = _peak_memory_of_download(2**20, str(tmpdir))
+    large = _peak_memory_of_download(2**25, str(tmpdir))
+
+    # Memory use is a few chunks, whatever the size of the object.
+    assert small < 1 * 2**20
+    assert large < 1 * 2**20
+    assert large < small * 2
+
+
+def test_download_etag_mismatch(tmpdir):
+    with _fake_pool(FakeConnection(2**20, etag='0' * 32)):
+        with pytest.raises(objectstore.DownloadError):
+            objectstore.copy_file_from_objectstore(
+                CONTAINER, '20170801_TEST.dump', str(tmpdir))
+
+    # Neither a partial download nor a temporary file is left behind.
+    assert os.listdir(str(tmpdir)) == []
+
+
+class FakeSwift:
+    """
+    Keeps uploaded objects in memory, the first upload of segments named in
+    `failing` fails.
+    """
+    def __init__(self, failing=()):
+        self.objects = {}
+        self.headers = {}
+        self.failing = set(failing)
+        self.attempts = {}
+
+    def put_container(self, container):
+        pass
+
+    def put_object(self, container, name, contents, content_length=None,
+                   content_type=None, query_string=None, **kwargs):
+        if hasattr(contents, 'read'):
+            data = b''
+            while True:
+                chunk = contents.read(2**16)
+                if not chunk:
+                    break
+                data += chunk
+        else:
+            data = contents.encode('utf-8') if isinstance(contents, str) else contents
+
+        segment_number = name.rsplit('/', 1)[-1]
+        self.attempts[segment_number] = self.attempts.get(segment_number, 0) + 1
+        if segment_number in self.failing:
+            self.failing.remove(segment_number)
+            raise ConnectionError('Connection reset by peer')
+
+        self.objects[(container, name)] = (data, query_string)
+        if kwargs.get('headers'):
+            self.headers[(container, name)] = kwargs['headers']
+        return hashlib.md5(data).hexdigest()
+
+    def head_object(self, container, name):
+        return {}
+
+    def get_object(self, container, name, **kwargs):
+        if (container, name) not in self.objects:
+            raise ClientException('Not found', http_status=404)
+        return {}, self.objects[(container, name)][0]
+
+    def delete_object(self, container, name):
+        self.objects.pop((container, name), None)
+
+    def get_auth(self):
+        return 'https://objectstore.example/v1/AUTH_x', 'token'
+
+    def close(self):
+        pass
+
+
+def test_segmented_upload(tmpdir, monkeypatch):
+    monkeypatch.setattr(settings, 'OBJECTSTORE_SEGMENT_THRESHOLD', 100000)
+    monkeypatch.setattr(settings, 'OBJECTSTORE_SEGMENT_SIZE', 40000)
+    file_path = os.path.join(str(tmpdir), '20170801_TEST.dump')
+    content = os.urandom(250000)
+    with open(file_path, 'wb') as f:
+        f.write(content)
+
+    fake = FakeSwift(failing=['00000003'])
+    with _fake_pool(fake):
+        ok, msg = objectstore.upload_file(CONTAINER, file_path)
+    assert ok
+
+    # Only the failing segment was uploaded twice.
+    assert fake.attempts['00000003'] == 2
+    assert all(n == 1 for segment, n in fake.attempts.items() if segment != '00000003')
+
+    # The manifest lists the segments, which add up to the file.
+    data, query_string = fake.objects[(CONTAINER, '20170801_TEST.dump')]
+    assert query_string == 'multipart-manifest=put'
+    manifest = json.loads(data.decode('utf-8'))
+    assert len(manifest) == 7
+    segments = [
+        fake.objects[tuple(segment['path'][1:].split('/', 1))][0] for segment in manifest]
+    assert b''.join(segments) == content
+    assert [hashlib.md5(s).hexdigest() for s in segments] == [s['etag'] for s in manifest]
+
+
+def test_segmented_upload_fails(tmpdir, monkeypatch):
+    monkeypatch.setattr(settings, 'OBJECTSTORE_SEGMENT_THRESHOLD', 100000)
+    monkeypatch.setattr(settings, 'OBJECTSTORE_SEGMENT_SIZE', 40000)
+    monkeypatch.setattr(settings, 'OBJECTSTORE_SEGMENT_RETRIES', 1)
+    file_path = os.path.join(str(tmpdir), '20170801_TEST.dump')
+    with open(file_path, 'wb') as f:
+        f.write(os.urandom(250000))
+
+    fake = FakeSwift(failing=['00000003'])
+    with _fake_pool(fake):
+        with pytest.raises(ConnectionError):
+            objectstore.upload_file(CONTAINER, file_path)
+
+    # No manifest was written and the other segments were cleaned up.
+    assert fake.objects == {}
+
+
+class AuthenticatingConnection:
+    """Records how it was created and how many are in use at the same time."""
+    in_use = 0
+    max_in_use = 0
+    lock = threading.Lock()
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def get_auth(self):
+        return 'https://objectstore.example/v1/AUTH_x', 'token-of-first-login'
+
+    def head_object(self, container, name):
+        cls = AuthenticatingConnection
+        with cls.lock:
+            cls.in_use += 1
+            cls.max_in_use = max(cls.max_in_use, cls.in_use)
+        time.sleep(0.01)
+        with cls.lock:
+            cls.in_use -= 1
+        return {}
+
+    def close(self):
+        pass
+
+
+def test_connection_pool():
+    created = []
+
+    def factory(**kwargs):
+        created.append(AuthenticatingConnection(**kwargs))
+        return created[-1]
+
+    pool = objectstore.ConnectionPool(3, factory=factory)
+
+    def work():
+        for _ in range(5):
+            with pool.connection() as conn:
+                conn.head_object(CONTAINER, 'x')
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Never more connections than the pool size, and these are reused.
+    assert AuthenticatingConnection.max_in_use <= 3
+    assert len(created) <= 3
+
+    # Only the first connection logs in, the others reuse its token.
+    assert created[0].kwargs == {}
+    assert all(
+        conn.kwargs.get('preauthtoken') == 'token-of-first-login'
+        for conn in created[1:])
+
+
+def test_transfer_many(tmpdir):
+    file_paths = []
+    for i in range(5):
+        file_path = os.path.join(str(tmpdir), '2017080{}_TEST.dump'.format(i + 1))
+        with open(file_path, 'wb') as f:
+            f.write(os.urandom(1000))
+        file_paths.append(file_path)
+
+    class FailingSwift(FakeSwift):
+        def put_object(self, container, name, *args, **kwargs):
+            if name == '20170803_TEST.dump':
+                raise ConnectionError('Connection reset by peer')
+            return super().put_object(container, name, *args, **kwargs)
+
+    fake = FailingSwift()
+    with _fake_pool(fake):
+        results = objectstore.transfer_many(
+            objectstore.upload(CONTAINER, file_path) for file_path in file_paths)
+
+    # One result per transfer, in order, only the failing one is not ok.
+    assert [r.transfer.path for r in results] == file_paths
+    assert [r.ok for r in results] == [True, True, False, True, True]
+    assert isinstance(results[2].result, ConnectionError)
+    assert len(fake.objects) == 4
+
+
+def test_upload_stream(tmpdir, monkeypatch):
+    monkeypatch.setattr(settings, 'OBJECTSTORE_SEGMENT_SIZE', 40000)
+    content = os.urandom(250000)
+
+    fake = FakeSwift()
+    with _fake_pool(fake):
+        n_bytes, md5 = objectstore.upload_stream(
+            CONTAINER, '20170801_TEST.dump', io.BytesIO(content))
+    assert n_bytes == len(content)
+    assert md5 == hashlib.md5(content).hexdigest()
+
+    data, query_string = fake.objects[(CONTAINER, '20170801_TEST.dump')]
+    assert query_string == 'multipart-manifest=put'
+    manifest = json.loads(data.decode('utf-8'))
+    segments = [
+        fake.objects[tuple(segment['path'][1:].split('/', 1))][0] for segment in manifest]
+    assert b''.join(segments) == content
+    assert fake.headers[(CONTAINER, '20170801_TEST.dump')] == {
+        objectstore.MD5_HEADER: md5,
+        objectstore.SHA256_HEADER: hashlib.sha256(content).hexdigest()}
+
+    # Small streams become plain objects.
+    with _fake_pool(fake):
+        objectstore.upload_stream(CONTAINER, '20170802_TEST.dump', io.BytesIO(b'abc'))
+    assert fake.objects[(CONTAINER, '20170802_TEST.dump')] == (b'abc', None)
+
+
+def test_upload_stream_aborted(tmpdir, monkeypatch):
+    monkeypatch.setattr(settings, 'OBJECTSTORE_SEGMENT_SIZE', 40000)
+
+    def check():
+        raise RuntimeError('pg_dump failed')
+
+    fake = FakeSwift()
+    with _fake_pool(fake):
+        for size in [1000, 250000]:
+            with pytest.raises(RuntimeError):
+                objectstore.upload_stream(
+                    CONTAINER, '20170801_TEST.dump', io.BytesIO(os.urandom(size)),
+                    check=check)
+
+    # Neither an object nor segments were left behind.
+    assert fake.objects == {}
+
+
+def test_iter_object():
+    fake = FakeConnection(2**20)
+    with _fake_pool(fake):
+        content = b''.join(objectstore.iter_object(CONTAINER, '20170801_TEST.dump'))
+    assert len(content) == 2**20
+
+    with _fake_pool(FakeConnection(2**20, etag='0' * 32)):
+        with pytest.raises(objectstore.DownloadError):
+            for _ in objectstore.iter_object(CONTAINER, '20170801_TEST.dump'):
+                pass
+
+
+def test_download_cache(tmpdir, monkeypatch):
+    cache_dir = os.path.join(str(tmpdir), 'cache')
+    fake = FakeConnection(2**20)
+    fake.get_object(CONTAINER, 'x', 1)  # compute ETag
+    downloads = []
+    get_object = fake.get_object
+
+    def counting_get_object(container, name, resp_chunk_size=None):
+        downloads.append(name)
+        return get_object(container, name, resp_chunk_size)
+    fake.get_object = counting_get_object
+
+    monkeypatch.setattr(settings, 'DOWNLOAD_CACHE_DIR', cache_dir)
+    downloadcache.get_cache.cache_clear()
+    try:
+        with _fake_pool(fake):
+            for i in range(2):
+                path = objectstore.copy_file_from_objectstore(
+                    CONTAINER, '20170801_TEST.dump', os.path.join(str(tmpdir), str(i)))
+                assert os.path.getsize(path) == 2**20
+            for i in range(2):
+                content = b''.join(
+                    objectstore.iter_object(CONTAINER, '20170802_TEST.dump'))
+                assert len(content) == 2**20
+    finally:
+        downloadcache.get_cache.cache_clear()
+
+    # Each object was downloaded only once.
+    assert downloads == ['20170801_TEST.dump', '20170802_TEST.dump']
+
+
+def test_move_large_object():
+    conn = MagicMock()
+    conn.head_object.return_value = {
+        'x-static-large-object': 'True', 'x-object-meta-content-md5': 'abc'}
+    conn.get_object.return_value = ({}, json.dumps([
+        {'name': '/c_segments/a/slo/00000000', 'hash': 'etag', 'bytes': 10}
+    ]).encode('utf-8'))
+
+    with _fake_pool(conn):
+        objectstore.move_object('c', 'a', '2017/08/a')
+
+    # The manifest is copied (its segments stay put), the old one removed.
+    args, kwargs = conn.put_object.call_args
+    assert args == ('c', '2017/08/a')
+    assert json.loads(kwargs['contents']) == [
+        {'path': '/c_segments/a/slo/00000000', 'etag': 'etag', 'size_bytes': 10}]
+    assert kwargs['query_string'] == 'multipart-manifest=put'
+    assert kwargs['headers'] == {'x-object-meta-content-md5': 'abc'}
+    conn.delete_object.assert_called_once_with('c', 'a')
+    assert not conn.copy_object.called
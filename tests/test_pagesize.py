@@ -0,0 +1,46 @@
+# noqa
+from unittest.mock import patch
+
+from parkeerrechten import pagesize
+
+
+def test_current_rss():
+    assert pagesize.current_rss() > 0
+
+
+@patch('parkeerrechten.pagesize.current_rss')
+def test_grow_and_shrink(rss_mock):
+    rss_mock.return_value = 100 * 2**20
+    sizer = pagesize.AdaptivePageSize(
+        seed=1000, minimum=100, maximum=10000, target_seconds=1.0)
+    assert sizer.size == 1000
+
+    # Fast pages: grow, but at most doubling per page, up to the maximum.
+    assert sizer.record(1000, 0.01) == 2000
+    assert sizer.record(2000, 0.01) == 4000
+    assert sizer.record(4000, 0.01) == 8000
+    assert sizer.record(8000, 0.01) == 10000
+
+    # Slow page: shrink towards the target latency.
+    assert sizer.record(10000, 1.6) == 6250
+
+    # A partial (last) page tells us nothing.
+    assert sizer.record(10, 0.5) == 6250
+
+    # Very slow pages: at most halving per page, down to the minimum.
+    for _ in range(10):
+        sizer.record(sizer.size, 1000)
+    assert sizer.size == 100
+
+
+@patch('parkeerrechten.pagesize.current_rss')
+def test_memory_ceiling(rss_mock):
+    sizer = pagesize.AdaptivePageSize(
+        seed=1000, minimum=100, maximum=10000, target_seconds=1.0,
+        max_rss_bytes=500 * 2**20)
+
+    rss_mock.return_value = 600 * 2**20
+    assert sizer.record(1000, 0.01) == 500
+
+    rss_mock.return_value = 400 * 2**20
+    assert sizer.record(500, 0.01) == 1000
@@ -0,0 +1,52 @@
+import pytest
+from sqlalchemy import create_engine, MetaData
+
+from parkeerrechten import settings
+from parkeerrechten import models
+from parkeerrechten import backup
+from parkeerrechten import partitions
+
+TABLE = 'TEST_PARTITIONED'
+
+
+@pytest.fixture
+def dp_conn():
+    with create_engine(settings.DATAPUNT_DB_URL).connect() as conn:
+        conn.execute('DROP TABLE IF EXISTS "{}";'.format(TABLE))
+        yield conn
+        conn.execute('DROP TABLE IF EXISTS "{}";'.format(TABLE))
+
+
+def test_partitions(dp_conn):
+    md = MetaData()
+    table = models.get_backup_table_def(md, TABLE, partitioned=True)
+    md.create_all(dp_conn)
+    assert partitions.is_partitioned(dp_conn, TABLE)
+    assert not partitions.is_partitioned(dp_conn, settings.NPR_TABLE)
+
+    for batch_name in ['20170802', 'Leeg', '20170801']:
+        assert partitions.create_partition(dp_conn, TABLE, batch_name) == \
+            '{}_{}'.format(TABLE, batch_name)
+    # Creating a partition again is harmless.
+    partitions.create_partition(dp_conn, TABLE, '20170801')
+    dp_conn.execute(table.insert(), [
+        {'VERW_RECHT_ID': 1, 'VER_BATCH_NAAM': '20170801'},
+        {'VERW_RECHT_ID': 2, 'VER_BATCH_NAAM': 'Leeg'},
+    ])
+
+    # Rows go to the partition of their batch.
+    assert dp_conn.execute(
+        'SELECT COUNT(*) FROM "{}_20170801";'.format(TABLE)).scalar() == 1
+
+    assert partitions.get_batch_names(dp_conn, TABLE) == ['20170801', '20170802', 'Leeg']
+    assert backup.get_batch_names_in_database(dp_conn, TABLE, include_leeg=False) == [
+        '20170801', '20170802']
+
+    partitions.drop_partition(dp_conn, TABLE, '20170801')
+    assert partitions.get_batch_names(dp_conn, TABLE) == ['20170802', 'Leeg']
+    assert dp_conn.execute('SELECT COUNT(*) FROM "{}";'.format(TABLE)).scalar() == 1
+
+
+def test_partition_name():
+    with pytest.raises(ValueError):
+        partitions.partition_name(TABLE, "20170801'; DROP TABLE x; --")
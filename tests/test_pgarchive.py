@@ -0,0 +1,78 @@
+import io
+import zlib
+
+import pytest
+
+from parkeerrechten import pgarchive
+
+INT_SIZE = 4
+
+
+def _int(value):
+    return pgarchive._write_int(value, INT_SIZE)
+
+
+def _template(compressed):
+    """Archive of an empty table as pg_dump writes it to a pipe."""
+    head = pgarchive.MAGIC + bytes([1, 15, 0, INT_SIZE, 8, 1]) + b'header and TOC'
+    data = zlib.compress(pgarchive.END_OF_COPY) if compressed else pgarchive.END_OF_COPY
+    block = bytes([pgarchive.BLK_DATA]) + _int(2543) + _int(len(data)) + data + _int(0)
+    return head, head + block
+
+
+def _read_chunks(archive, offset):
+    chunks = []
+    while True:
+        length, offset = pgarchive._read_int(archive, offset, INT_SIZE)
+        if length == 0:
+            assert offset == len(archive)
+            return chunks
+        chunks.append(archive[offset:offset + length])
+        offset += length
+
+
+@pytest.mark.parametrize('compressed', [True, False])
+def test_archive_writer(compressed):
+    head, template = _template(compressed)
+
+    class Out(list):
+        write = list.append
+
+    out = Out()
+    writer = pgarchive.ArchiveWriter(template, out)
+    rows = [b'%d\tsome text\n' % i for i in range(20000)]
+    for row in rows:
+        writer.write(row)
+    writer.close()
+    archive = b''.join(out)
+
+    # Same head and dump id, the rows as data.
+    assert archive.startswith(head + bytes([pgarchive.BLK_DATA]) + _int(2543))
+    data = b''.join(_read_chunks(archive, len(head) + 1 + 1 + INT_SIZE))
+    if compressed:
+        data = zlib.decompress(data)
+    assert data == b''.join(rows) + pgarchive.END_OF_COPY
+    assert writer.n_bytes == len(b''.join(rows))
+
+
+def test_split_template_errors():
+    _, template = _template(True)
+    with pytest.raises(pgarchive.ArchiveError):
+        pgarchive.split_template(b'PK' + template[2:])
+    # A table with rows is no template.
+    with pytest.raises(pgarchive.ArchiveError):
+        pgarchive.split_template(template.replace(
+            zlib.compress(pgarchive.END_OF_COPY), zlib.compress(b'1\n\\.\n\n\n')))
+
+
+def test_rename_schema_errors():
+    _, template = _template(True)
+    with pytest.raises(pgarchive.ArchiveError):
+        pgarchive.rename_schema(io.BytesIO(b'PK' + template[2:]), 'dump_x', 'public')
+    # Archive of a version of which the TOC is not known.
+    with pytest.raises(pgarchive.ArchiveError):
+        pgarchive.rename_schema(
+            io.BytesIO(template[:5] + bytes([1, 17]) + template[7:]), 'dump_x', 'public')
+    # Truncated archive (e.g. pg_dump failed).
+    with pytest.raises(pgarchive.ArchiveError):
+        pgarchive.rename_schema(io.BytesIO(template[:8]), 'dump_x', 'public')
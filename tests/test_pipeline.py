@@ -0,0 +1,79 @@
+# noqa
+import threading
+import time
+
+import pytest
+
+from parkeerrechten import pipeline
+
+
+def test_pipeline_preserves_pages():
+    pages = [[i] * 3 for i in range(20)]
+    p = pipeline.Pipeline(iter(pages), depth=2)
+
+    assert list(p) == pages
+    assert p.n_pages == 20
+
+
+def test_pipeline_backpressure():
+    """
+    The reader may not run more than depth + 1 pages ahead of the consumer.
+    """
+    n_read = []
+
+    def pages():
+        for i in range(50):
+            n_read.append(i)
+            yield [i]
+
+    p = pipeline.Pipeline(pages(), depth=3)
+    for i, page in enumerate(p):
+        time.sleep(0.005)
+        # depth pages in the queue, one waiting to be put in the queue:
+        assert len(n_read) <= i + 1 + 3 + 1
+
+
+def test_pipeline_bottleneck():
+    def slow_pages():
+        for i in range(5):
+            time.sleep(0.05)
+            yield [i]
+
+    p = pipeline.Pipeline(slow_pages(), depth=2)
+    list(p)
+    assert p.bottleneck == 'reader'
+
+    p = pipeline.Pipeline(iter([[i] for i in range(5)]), depth=1)
+    for page in p:
+        time.sleep(0.05)
+    assert p.bottleneck == 'writer'
+
+
+def test_pipeline_reader_error():
+    def failing_pages():
+        yield [1]
+        raise RuntimeError('Network blip')
+
+    p = pipeline.Pipeline(failing_pages(), depth=2)
+    with pytest.raises(RuntimeError):
+        list(p)
+
+
+def test_pipeline_close_early():
+    closed = threading.Event()
+
+    def endless_pages():
+        try:
+            while True:
+                yield [1]
+        finally:
+            closed.set()
+
+    p = pipeline.Pipeline(endless_pages(), depth=2)
+    for page in p:
+        break
+    p.close()
+
+    # The reader stopped and cleaned up its iterator.
+    assert closed.is_set()
+    assert not p._thread.is_alive()
@@ -1,5 +1,4 @@
 import os
-import errno
 import csv
 import logging
 import shutil
@@ -15,6 +14,7 @@ from parkeerrechten import models
 from parkeerrechten import run_import
 from parkeerrechten import dump_database
 from parkeerrechten import namecheck
+from parkeerrechten import partitions
 from parkeerrechten import restore_database
 
 _CSV_FILENAME = os.path.join(os.path.dirname(__file__), 'test-data.csv')
@@ -71,11 +71,18 @@ def _empty_out_local_db(conn):
     ))
 
 
+@pytest.mark.parametrize('restore_mode,dump_concurrency,dump_staging,local_table_mode', [
+    ('file', 1, 'table', 'heap'), ('stream', 1, 'table', 'heap'),
+    ('file', 4, 'table', 'heap'), ('stream', 4, 'table', 'heap'),
+    ('file', 1, 'export', 'heap'), ('stream', 4, 'export', 'heap'),
+    ('file', 1, 'table', 'partitioned'), ('stream', 4, 'export', 'partitioned')])
 @patch('parkeerrechten.backup.get_batch_names_in_objectstore')
 @patch('parkeerrechten.objectstore.upload_file')
 @patch('parkeerrechten.objectstore.copy_file_from_objectstore')
+@patch('parkeerrechten.objectstore.iter_object')
 def test_full_import_process_plus_restore(
-        copy_mock, upload_mock, objectstore_mock, npr_conn, dp_conn):
+        iter_mock, copy_mock, upload_mock, objectstore_mock, restore_mode,
+        dump_concurrency, dump_staging, local_table_mode, npr_conn, dp_conn):
     """
     Run full import process in test context.
 
@@ -88,6 +95,7 @@ def test_full_import_process_plus_restore(
     def empty_list(*args, **kwargs):
         return []
     objectstore_mock.side_effect = empty_list
+    upload_mock.return_value = (True, 'File uploaded succesfully')
 
     # Validate inputs.
     assert isinstance(dp_conn, Connection)
@@ -106,32 +114,47 @@ def test_full_import_process_plus_restore(
     )).fetchall()
     assert r[0][0] == 100
 
-    # Clean up the local database.
+    # Clean up the local database (and dumps of other test runs).
     _empty_out_local_db(dp_conn)
-    try:
-        os.makedirs(_BACKUP_DIR)
-    except OSError as e:
-        if e.errno != errno.EEXIST:
-            raise
+    shutil.rmtree(_BACKUP_DIR, ignore_errors=True)
+    os.makedirs(_BACKUP_DIR)
 
     # Copy records from the NPR stand in to the local database, the
     # repeated imports result in grabbing the full data set.
-    run_import._run_import(['--orphans'], npr_conn, dp_conn)
-    run_import._run_import([], npr_conn, dp_conn)
-    run_import._run_import([], npr_conn, dp_conn)
-    run_import._run_import([], npr_conn, dp_conn)
-    run_import._run_import([], npr_conn, dp_conn)
+    settings.LOCAL_TABLE_MODE = local_table_mode
+    try:
+        run_import._run_import(['--orphans'], npr_conn, dp_conn)
+        run_import._run_import([], npr_conn, dp_conn)
+        run_import._run_import([], npr_conn, dp_conn)
+        run_import._run_import([], npr_conn, dp_conn)
+        run_import._run_import([], npr_conn, dp_conn)
+    finally:
+        settings.LOCAL_TABLE_MODE = 'heap'
 
     r = dp_conn.execute(text(
         '''SELECT COUNT(*) FROM "{}";'''.format(settings.LOCAL_TABLE)
     )).fetchall()
     assert r[0][0] == 100
     logger.debug('There are now {} records.'.format(r[0][0]))
+    assert partitions.is_partitioned(dp_conn, settings.LOCAL_TABLE) == (
+        local_table_mode == 'partitioned')
     logger.debug('... done.')
 
     # Call into the database dumping code, keep the dumped files for later.
     logger.debug('RUNNING TO DATABASE DUMPING STEP')
-    dump_database._dump_database(dp_conn, remove_dumps=False)
+    settings.DUMP_CONCURRENCY = dump_concurrency
+    settings.DUMP_STAGING = dump_staging
+    try:
+        dump_database._dump_database(dp_conn, remove_dumps=False)
+    finally:
+        settings.DUMP_CONCURRENCY = 1
+        settings.DUMP_STAGING = 'table'
+
+    # Concurrent dumping leaves no staging schemas behind.
+    r = dp_conn.execute(text(
+        '''SELECT COUNT(*) FROM pg_namespace WHERE nspname LIKE 'dump_%';'''
+    )).fetchall()
+    assert r[0][0] == 0
 
     # ------
 
@@ -160,10 +183,19 @@ def test_full_import_process_plus_restore(
         return os.path.join(temp_dir, file_name)
     copy_mock.side_effect = copy_local_database_dump
 
+    def iter_local_database_dump(_, file_name):
+        with open(os.path.join(_BACKUP_DIR, file_name), 'rb') as f:
+            yield from iter(lambda: f.read(1000), b'')
+    iter_mock.side_effect = iter_local_database_dump
+    settings.RESTORE_MODE = restore_mode
+
     # empyt out local DB, re-use connection to restore to that db
     _empty_out_local_db(dp_conn)
 
-    restore_database._restore_database([], dp_conn)
+    try:
+        restore_database._restore_database([], dp_conn)
+    finally:
+        settings.RESTORE_MODE = 'file'
     objectstore_mock.side_effect = list_local_database_dumps
 
     r = dp_conn.execute(text(
@@ -171,6 +203,10 @@ def test_full_import_process_plus_restore(
     )).fetchall()
     assert r[0][0] == 100
     logging.debug('RESULTS: %s' % r)
+    r = dp_conn.execute(text(
+        '''SELECT COUNT(*) FROM pg_namespace WHERE nspname LIKE 'dump_%';'''
+    )).fetchall()
+    assert r[0][0] == 0
 
     # --- check that we did really erase the "KENM_RECHTV_INT" field ---
     for sf in settings.SENSITIVE_FIELDS:
@@ -180,3 +216,34 @@ def test_full_import_process_plus_restore(
         )).fetchall()
         logging.debug('Field values: %s' % r)
         assert r[0][0] == None
+
+
+def test_streamed_restore_download_failure(tmpdir, dp_conn):
+    """
+    A dump that fails to download halfway is not restored, others are.
+    """
+    restored = str(tmpdir)
+
+    def iter_object(_, file_name):
+        yield b'first chunk,'
+        if file_name.startswith('20170802'):
+            raise OSError('Connection reset by peer')
+        yield b'second chunk'
+
+    # Stand-in for pg_restore that keeps what it reads if it gets to finish.
+    def pg_restore_command():
+        return ['sh', '-c', 'cat > {}/tmp && mv {}/tmp {}/$$'.format(
+            restored, restored, restored)]
+
+    with patch('parkeerrechten.objectstore.iter_object', side_effect=iter_object), \
+            patch('parkeerrechten.restore_database._pg_restore_command',
+                  side_effect=pg_restore_command):
+        failed = restore_database._restore_streamed(
+            dp_conn, ['20170801', '20170802', '20170803'])
+
+    assert failed == ['20170802']
+    contents = []
+    for file_name in os.listdir(restored):
+        with open(os.path.join(restored, file_name), 'rb') as f:
+            contents.append(f.read())
+    assert contents == [b'first chunk,second chunk'] * 2
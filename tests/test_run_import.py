@@ -5,7 +5,7 @@ import logging
 from unittest.mock import patch
 
 import pytest
-from sqlalchemy import create_engine, Table, MetaData, select
+from sqlalchemy import create_engine, Table, MetaData, select, asc
 from sqlalchemy.sql import text
 from sqlalchemy.engine.base import Connection
 
@@ -13,6 +13,8 @@ from parkeerrechten import settings
 from parkeerrechten import models
 from parkeerrechten import run_import
 from parkeerrechten import dump_database
+from parkeerrechten import backup
+from parkeerrechten import watermark
 
 _CSV_FILENAME = os.path.join(os.path.dirname(__file__), 'test-data.csv')
 
@@ -113,6 +115,81 @@ def test_batched_iterator(npr_conn, dp_conn):
     logger.debug('... done!')
 
 
+def test_keyset_iterator(npr_conn, dp_conn):
+    """
+    Test the keyset (seek) based batched copying from one database to another.
+    """
+    logger.debug('Testing keyset selection iterator ...')
+
+    # Load data and clean up local database.
+    _load_test_data(npr_conn)
+    _empty_out_local_db(dp_conn)
+
+    npr_table = Table(
+        settings.NPR_TABLE, MetaData(), autoload=True, autoload_with=npr_conn)
+
+    md = MetaData()
+    dp_table = models.get_backup_table_def(md, settings.LOCAL_TABLE)
+    md.create_all(dp_conn)
+
+    # The keyset iterator needs a selection ordered by the key column.
+    selection = select([npr_table]).order_by(asc(npr_table.c.VERW_RECHT_ID))
+    iterator = run_import.keyset_selection_iterator(
+        npr_conn, selection, npr_table.c.VERW_RECHT_ID, batch_size=10)
+
+    seen = []
+    for i, rows in enumerate(iterator):
+        seen.extend(row['VERW_RECHT_ID'] for row in rows)
+        dp_conn.execute(dp_table.insert(), rows)
+
+    # Same 100 records as with the offset based iterator, in key order and
+    # without duplicates.
+    assert i == 9
+    assert seen == sorted(set(seen))
+
+    r = dp_conn.execute(text(
+        '''SELECT COUNT(*) FROM "{}";'''.format(settings.LOCAL_TABLE)
+    )).fetchall()
+    assert r[0][0] == 100
+    logger.debug('... done!')
+
+
+def test_streamed_iterator(npr_conn, dp_conn):
+    """
+    Test the server-side cursor based copying from one database to another.
+    """
+    logger.debug('Testing streamed selection iterator ...')
+
+    # Load data and clean up local database.
+    _load_test_data(npr_conn)
+    _empty_out_local_db(dp_conn)
+
+    npr_table = Table(
+        settings.NPR_TABLE, MetaData(), autoload=True, autoload_with=npr_conn)
+
+    md = MetaData()
+    dp_table = models.get_backup_table_def(md, settings.LOCAL_TABLE)
+    md.create_all(dp_conn)
+
+    # One query, read in chunks of 30 records: 3 full chunks + 1 partial.
+    selection = select([npr_table]).order_by(asc(npr_table.c.VERW_RECHT_ID))
+    iterator = run_import.streamed_selection_iterator(
+        npr_conn, selection, chunk_size=30)
+
+    sizes = []
+    for rows in iterator:
+        sizes.append(len(rows))
+        dp_conn.execute(dp_table.insert(), rows)
+
+    assert sizes == [30, 30, 30, 10]
+
+    r = dp_conn.execute(text(
+        '''SELECT COUNT(*) FROM "{}";'''.format(settings.LOCAL_TABLE)
+    )).fetchall()
+    assert r[0][0] == 100
+    logger.debug('... done!')
+
+
 @patch('parkeerrechten.backup.get_batch_names_in_objectstore')
 @patch('parkeerrechten.objectstore.upload_file')
 def test_full_import_process(upload_mock, objectstore_mock, npr_conn, dp_conn):
@@ -128,6 +205,7 @@ def test_full_import_process(upload_mock, objectstore_mock, npr_conn, dp_conn):
     def empty_list(*args, **kwargs):
         return []
     objectstore_mock.side_effect = empty_list
+    upload_mock.return_value = (True, 'File uploaded succesfully')
 
     # Validate inputs.
     assert isinstance(dp_conn, Connection)
@@ -173,3 +251,111 @@ def test_full_import_process(upload_mock, objectstore_mock, npr_conn, dp_conn):
     logger.debug('RUNNING TO DATABASE DUMPING STEP')
     dump_database._dump_database(dp_conn)
 
+
+@patch('parkeerrechten.backup.get_batch_names_in_objectstore')
+def test_parallel_import(objectstore_mock, npr_conn, dp_conn):
+    """
+    Import with several workers, one failing batch must not affect others.
+    """
+    objectstore_mock.return_value = []
+    settings.DEBUG = False
+    settings.BATCH_SIZE = 2
+
+    _load_test_data(npr_conn)
+    _empty_out_local_db(dp_conn)
+
+    local_loader = run_import._local_loader
+    n_pages = {}
+
+    def failing_local_loader(dp_table):
+        # Fail halfway through batch 20170805, after its first page.
+        store_rows = local_loader(dp_table)
+
+        def failing_store_rows(connection, rows):
+            batch_name = rows[0]['VER_BATCH_NAAM']
+            n_pages[batch_name] = n_pages.get(batch_name, 0) + 1
+            if batch_name == '20170805' and n_pages[batch_name] == 2:
+                raise RuntimeError('Network blip')
+            store_rows(connection, rows)
+        return failing_store_rows
+
+    with patch('parkeerrechten.run_import._local_loader') as loader_mock:
+        loader_mock.side_effect = failing_local_loader
+        failed = run_import._run_import(['--workers', '4'], npr_conn, dp_conn)
+
+    # The first 10 batches were attempted, only the failing one is incomplete.
+    assert failed == ['20170805']
+    in_local_db = backup.get_batch_names_in_database(
+        dp_conn, settings.LOCAL_TABLE, completed_only=True)
+    assert in_local_db == [
+        '20170801', '20170802', '20170803', '20170804', '20170806',
+        '20170807', '20170808', '20170809', '20170810'
+    ]
+    r = dp_conn.execute(text(
+        '''SELECT COUNT(*) FROM "{}" WHERE "VER_BATCH_NAAM" = '20170805';'''.format(
+            settings.LOCAL_TABLE)
+    )).fetchall()
+    assert r[0][0] == 2
+
+    # The next runs resume the failed batch, and import the rest.
+    for _ in range(3):
+        assert run_import._run_import(['--workers', '4'], npr_conn, dp_conn) == []
+
+    r = dp_conn.execute(text(
+        '''SELECT COUNT(*) FROM "{}";'''.format(settings.LOCAL_TABLE)
+    )).fetchall()
+    assert r[0][0] == 100 - 16  # everything except the orphans
+
+
+@patch('parkeerrechten.backup.get_batch_names_in_objectstore')
+def test_watermark_discovery(objectstore_mock, npr_conn, dp_conn):
+    """
+    List NPR batches from the watermark on, a backfill leaves it alone.
+    """
+    objectstore_mock.return_value = []
+    settings.DEBUG = False
+    settings.BATCH_SIZE = 10
+    settings.NPR_DISCOVERY = 'watermark'
+
+    _load_test_data(npr_conn)
+    _empty_out_local_db(dp_conn)
+    dp_conn.execute(text(
+        '''DROP TABLE IF EXISTS "{}";'''.format(settings.WATERMARK_TABLE)
+    ))
+
+    listing = backup.get_batch_names_in_database
+    start_dates = []
+
+    def spy(connection, table_name, *args, **kwargs):
+        if table_name == settings.NPR_TABLE:
+            start_dates.append(kwargs.get('start_date'))
+        return listing(connection, table_name, *args, **kwargs)
+
+    try:
+        with patch('parkeerrechten.backup.get_batch_names_in_database') as listing_mock:
+            listing_mock.side_effect = spy
+
+            # First run lists everything, the oldest batch not imported
+            # becomes the watermark.
+            run_import._run_import([], npr_conn, dp_conn)
+            assert start_dates == [None]
+            assert watermark.get(dp_conn) == '20170811'
+
+            # Next runs list from the watermark on, until everything is in.
+            run_import._run_import([], npr_conn, dp_conn)
+            run_import._run_import([], npr_conn, dp_conn)
+            assert start_dates == [None, '20170811', '20170822']
+            assert watermark.get(dp_conn) == '20170825'
+
+            # A backfill window is listed as requested, the watermark stays.
+            _empty_out_local_db(dp_conn)
+            run_import._run_import(
+                ['--startdate', '20170801', '--enddate', '20170802'], npr_conn, dp_conn)
+            assert start_dates[-1] == '20170801'
+            assert watermark.get(dp_conn) == '20170825'
+    finally:
+        settings.NPR_DISCOVERY = 'full'
+
+    in_local_db = backup.get_batch_names_in_database(
+        dp_conn, settings.LOCAL_TABLE, completed_only=True)
+    assert in_local_db == ['20170801', '20170802']
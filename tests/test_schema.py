@@ -0,0 +1,82 @@
+# noqa
+import json
+import os
+from unittest.mock import patch
+
+import pytest
+from sqlalchemy import create_engine, MetaData, Column, types
+from sqlalchemy.exc import NoSuchTableError
+from sqlalchemy.sql import text
+
+from parkeerrechten import settings
+from parkeerrechten import models
+from parkeerrechten import schema
+
+TEST_TABLE = 'VW_0363_SCHEMA_TEST'
+
+
+@pytest.fixture(scope='module')
+def dp_conn():
+    with create_engine(settings.DATAPUNT_DB_URL).connect() as conn:
+        yield conn
+
+
+@pytest.fixture
+def test_table(dp_conn):
+    md = MetaData()
+    models.get_backup_table_def(md, TEST_TABLE)
+    md.create_all(dp_conn)
+    schema.clear_cache()
+
+    yield TEST_TABLE
+
+    schema.clear_cache()
+    dp_conn.execute(text('''DROP TABLE IF EXISTS "{}";'''.format(TEST_TABLE)))
+
+
+def test_reflect_once(dp_conn, test_table):
+    with patch('parkeerrechten.schema.Table', wraps=schema.Table) as table_mock:
+        first = schema.get_table(dp_conn, test_table)
+        second = schema.get_table(dp_conn, test_table)
+    assert table_mock.call_count == 1
+
+    # Columns match, so we get the static definition.
+    assert first is second
+    assert first.c.VERW_RECHT_ID.type.precision == 10
+
+
+def test_snapshot(dp_conn, test_table, tmpdir):
+    settings.SCHEMA_SNAPSHOT_DIR = str(tmpdir)
+    try:
+        schema.get_table(dp_conn, test_table)
+        with open(os.path.join(str(tmpdir), test_table + '.json')) as f:
+            assert json.load(f)[0] == ['VERW_RECHT_ID', 'Decimal']
+
+        # A new process need not reflect, the snapshot matches.
+        schema.clear_cache()
+        with patch('parkeerrechten.schema.Table') as table_mock:
+            table = schema.get_table(dp_conn, test_table)
+        assert table_mock.call_count == 0
+        assert table.name == test_table
+    finally:
+        settings.SCHEMA_SNAPSHOT_DIR = ''
+
+
+def test_columns_differ(dp_conn):
+    md = MetaData()
+    table = models.get_backup_table_def(md, TEST_TABLE)
+    table.append_column(Column('EXTRA', types.Integer()))
+    md.create_all(dp_conn)
+    schema.clear_cache()
+
+    try:
+        table = schema.get_table(dp_conn, TEST_TABLE)
+        assert 'EXTRA' in table.c
+    finally:
+        schema.clear_cache()
+        dp_conn.execute(text('''DROP TABLE "{}";'''.format(TEST_TABLE)))
+
+
+def test_no_such_table(dp_conn):
+    with pytest.raises(NoSuchTableError):
+        schema.get_table(dp_conn, 'DOES_NOT_EXIST')